@@ -166,23 +166,23 @@ _skip = None
 _skip = set(globals()) - set('__doc__')
 
 from .columns import (Column, Integer, Boolean, Float, Decimal, DateTime,
-    Date, Time, String, Text, Json, PrimaryKey, ManyToOne, OneToOne,
+    Date, Time, String, Text, Json, PrimaryKey, Version, ManyToOne, OneToOne,
     ForeignModel, OneToMany, MODELS, MODELS_REFERENCED, SKIP_ON_DELETE)
 from .exceptions import (ORMError, UniqueKeyViolation, InvalidOperation,
     QueryError, ColumnError, MissingColumn, InvalidColumnValue, RestrictError,
-    DataRaceError, EntityDeletedError)
+    DataRaceError, EntityDeletedError, BulkError)
 from .index import GeneralIndex, GeoIndex, Pattern, Prefix, Suffix
 from .model import _ModelMetaclass, Model
 from .query import NOT_NULL, Query
-from .util import (ClassProperty, _connect, session,
+from .util import (ClassProperty, _connect, session, pipelined_saves,
     _prefix_score, _script_load, _encode_unique_constraint,
     FULL_TEXT, CASE_INSENSITIVE, SIMPLE, SIMPLE_CI, IDENTITY, IDENTITY_CI)
 
-VERSION = '0.38.0'
+VERSION = '0.39.0'
 
 COLUMN_TYPES = [Column, Integer, Boolean, Float, Decimal, DateTime, Date,
-Time, String, Text, Json, PrimaryKey, ManyToOne, ForeignModel, OneToMany,
-OneToOne]
+Time, String, Text, Json, PrimaryKey, Version, ManyToOne, ForeignModel,
+OneToMany, OneToOne]
 
 NUMERIC_TYPES = six.integer_types + (float, _Decimal, datetime, date, dtime)
 
@@ -191,7 +191,7 @@ __all__ = [x for x in set(globals()) if x not in _skip and not x.startswith('_')
 # silence pyflakes
 MODELS, MODELS_REFERENCED
 SKIP_ON_DELETE
-ColumnError, DataRaceError, EntityDeletedError, InvalidColumnValue,
+BulkError, ColumnError, DataRaceError, EntityDeletedError, InvalidColumnValue,
 InvalidOperation, MissingColumn, ORMError, QueryError, RestrictError,
 UniqueKeyViolation
 Pattern, Suffix, GeneralIndex, Prefix, Model, _ModelMetaclass, Query, NOT_NULL
@@ -13,6 +13,8 @@ from decimal import Decimal as _Decimal
 from functools import wraps
 from itertools import product
 import json
+import os
+import threading
 
 import six
 
@@ -33,10 +35,16 @@ ON_DELETE = ('no action', 'restrict', 'cascade', 'set null', 'set default')
 six.string_types_ex = six.string_types
 if six.PY3:
     six.string_types_ex += (bytes,)
+_IMMUTABLE = (float, _Decimal, datetime, date, dtime, tuple, frozenset,
+    type(None)) + six.integer_types + six.string_types_ex
 
 def is_numeric(allowed):
     return any(isinstance(i, allowed) for i in _NUMERIC)
 
+def is_mutable(allowed):
+    allowed = (allowed,) if isinstance(allowed, type) else allowed
+    return any(not issubclass(a, _IMMUTABLE) for a in allowed)
+
 def is_string(allowed):
     allowed = (allowed,) if isinstance(allowed, type) else allowed
     return any(issubclass(a, i) for a,i in product(allowed, six.string_types_ex))
@@ -170,6 +178,9 @@ class Column(object):
         * *keygen2* - pass a function that takes your column name and the dict
           representing the current entity's complete data - can be used for
           creating multi-column indexes
+        * *deferred* - store the column's data in its own key instead of the
+          entity's hash, and only fetch it the first time it is accessed (see
+          the deferred column notes below)
 
     String/Text arguments:
 
@@ -213,6 +224,24 @@ class Column(object):
           not be able to use any prefix, so will scan the entire index for
           matches (aka: expensive)
 
+    Deferred columns:
+
+        Large ``Text``, ``String``, or ``Json`` columns can be defined with
+        ``deferred=True``, which stores their data at ``<namespace>:<id>:<column>``
+        instead of in the entity's hash. They are not fetched by
+        ``Model.get()``, ``.refresh()``, or queries, but will be fetched the
+        first time they are accessed. When one entity's deferred column is
+        accessed, the same column is fetched for all other entities loaded by
+        the same ``Model.get()`` call (or the same page of query results) that
+        haven't fetched it yet, in a single round trip::
+
+            class Document(Model):
+                title = Text(index=True, keygen=FULL_TEXT)
+                content = Json(deferred=True)
+
+        Deferred columns can't be indexed or unique, and are not included in
+        ``.to_dict()`` until they have been fetched.
+
     There are 3 types of string indexes that rom currently supports:
 
         * *SIMPLE*/*SIMPLE_CI* - sorting only with ``query.order_by('x')`` -
@@ -234,24 +263,33 @@ class Column(object):
 
     '''
     _allowed = ()
+    # values that can be modified in-place are compared on every save, None
+    # treats columns as mutable unless all _allowed types are immutable
+    _mutable = None
 
-    __slots__ = '_required _default _init _unique _index _model _attr _keygen _prefix _suffix'.split()
+    __slots__ = '_required _default _init _unique _index _model _attr _keygen _keygen2 _prefix _suffix _deferred'.split()
 
-    def __init__(self, required=False, default=NULL, unique=False, index=False, keygen=None, prefix=False, suffix=False, keygen2=None):
+    def __init__(self, required=False, default=NULL, unique=False, index=False, keygen=None, prefix=False, suffix=False, keygen2=None, deferred=False):
         self._required = required
         self._default = default
         self._unique = unique
         self._index = index
         self._prefix = prefix
         self._suffix = suffix
+        self._deferred = deferred
         self._init = False
         self._model = None
         self._attr = None
         self._keygen = None
+        # keygen2 functions read the whole entity
+        self._keygen2 = bool(keygen2)
 
         if (keygen or keygen2) and not (index or prefix or suffix):
             raise ColumnError("Explicit keygen provided, but no index type spcified (index, prefix, and suffix all False)")
 
+        if deferred and (unique or index or prefix or suffix):
+            raise ColumnError("Deferred columns cannot be unique or indexed")
+
         if not self._allowed and not hasattr(self, '_fmodel') and not hasattr(self, '_ftable'):
             raise ColumnError("Missing valid class-level _allowed attribute on %r"%(type(self),))
 
@@ -336,6 +374,12 @@ class Column(object):
         if not obj._init:
             self._init_(obj, *value)
             return
+        if self._attr in obj._unloaded:
+            if self._deferred and value is not None:
+                # the old value is only needed for the data race check
+                obj._load_digest(self._attr)
+            else:
+                obj._load_unloaded(self._attr)
         try:
             if value is None:
                 try:
@@ -351,22 +395,30 @@ class Column(object):
         self._validate(value)
         obj._data[self._attr] = value
         obj._modified = True
+        obj._dirty.add(self._attr)
         session.add(obj)
 
     def __get__(self, obj, objtype):
         try:
             return obj._data[self._attr]
         except KeyError:
+            if self._attr in obj._unloaded:
+                # column wasn't fetched with the rest of the entity
+                obj._load_unloaded(self._attr, page=True)
+                return obj._data.get(self._attr)
             AttributeError("%s.%s does not exist"%(self._model, self._attr))
 
     def __delete__(self, obj):
         if self._required:
             raise InvalidOperation("%s.%s cannot be null"%(self._model, self._attr))
+        if self._attr in obj._unloaded:
+            obj._load_unloaded(self._attr)
         try:
             obj._data.pop(self._attr)
         except KeyError:
             raise AttributeError("%s.%s does not exist"%(self._model, self._attr))
         obj._modified = True
+        obj._dirty.add(self._attr)
         session.add(obj)
 
 class Integer(Column):
@@ -586,6 +638,7 @@ class Json(Column):
             col = Json()
     '''
     _allowed = (dict, list, tuple)
+    _mutable = True
     def _to_redis(self, value):
         return json.dumps(value, sort_keys=True)
     def _from_redis(self, value):
@@ -608,10 +661,31 @@ class PrimaryKey(Column):
         class MyModel(Model):
             id = PrimaryKey()
     '''
+    __slots__ = Column.__slots__ + ['_lock', '_blocks']
     _allowed = six.integer_types
 
     def __init__(self, index=False):
         Column.__init__(self, required=False, default=None, unique=False, index=index)
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def _next_id(self, obj, key):
+        size = obj._id_block_size
+        conn = _connect(obj)
+        if not size:
+            return conn.incr(key)
+        # hand out ids from a block reserved with INCRBY, shared by all threads,
+        # but not by forked processes or with other Redis servers/dbs; blocks
+        # are kept per counter key, as models without their own primary key
+        # all share the PrimaryKey column inherited from Model
+        owner = (os.getpid(), repr(conn.connection_pool))
+        with self._lock:
+            bowner, id, last = self._blocks.get(key, (None, 1, 0))
+            if id > last or bowner != owner:
+                last = conn.incrby(key, size)
+                id = last - size + 1
+            self._blocks[key] = (owner, id + 1, last)
+            return id
 
     def _init_(self, obj, model, attr, value, loading):
         self._model = model
@@ -619,7 +693,7 @@ class PrimaryKey(Column):
         if value is None:
             if loading:
                 raise InvalidColumnValue("Cannot set none primary key on object loading")
-            value = _connect(obj).incr('%s:%s:'%(model, attr))
+            value = self._next_id(obj, '%s:%s:'%(model, attr))
             obj._modified = True
         else:
             value = int(value)
@@ -632,6 +706,39 @@ class PrimaryKey(Column):
             return
         raise InvalidOperation("Cannot update primary key value")
 
+class Version(Integer):
+    '''
+    A version number for the entity, starting at 1 and incremented by every
+    save. Saving an entity of a model with a Version column checks that the
+    version in Redis is still the one that was loaded, instead of sending and
+    comparing the previous value of every changed column, which keeps the
+    size of updates to large ``Text``/``Json`` columns down.
+
+    No arguments are accepted, and the value can't be set. Only one Version
+    column is allowed per model.
+
+    Used via::
+
+        class Document(Model):
+            version = Version()
+            body = Text()
+
+    .. note:: Any other save of the same entity (even one changing different
+      columns) will cause a ``DataRaceError`` for entities saved concurrently,
+      as will ``Model.incr()``, which also increments the version.
+    '''
+    def __init__(self):
+        Column.__init__(self, required=False, default=None)
+
+    def __set__(self, obj, value):
+        if not obj._init:
+            self._init_(obj, *value)
+            return
+        raise InvalidOperation("Cannot update version value")
+
+    def __delete__(self, obj):
+        raise InvalidOperation("Cannot update version value")
+
 class ManyToOne(Column):
     '''
     This ManyToOne column allows for one model to reference another model.
@@ -663,6 +770,12 @@ class ManyToOne(Column):
       that you can find entities referencing specific id ranges or even sort by
       referenced ids.
 
+    .. note:: Referenced entities are not fetched when an entity is loaded,
+      only the first time that the column is accessed. You can read the
+      referenced id without fetching the referenced entity via
+      ``entity.<column>_id`` (unless your model already has an attribute with
+      that name), and you can assign an id instead of an entity.
+
     '''
     __slots__ = Column.__slots__ + ['_ftable', '_on_delete']
     def __init__(self, ftable, on_delete=NO_ACTION_DEFAULT, required=False, default=NULL):
@@ -681,7 +794,14 @@ class ManyToOne(Column):
             raise ORMError("Missing foreign table %r referenced by %s.%s"%(self._ftable, self._model, self._attr))
         if isinstance(value, model):
             return value
-        return model.get(value)
+        # the referenced entity is fetched on first access
+        return int(value)
+
+    def __get__(self, obj, objtype):
+        value = Column.__get__(self, obj, objtype)
+        if isinstance(value, six.integer_types):
+            value = obj._data[self._attr] = MODELS[self._ftable].get(value)
+        return value
 
     def _validate(self, value):
         try:
@@ -690,6 +810,9 @@ class ManyToOne(Column):
             raise ORMError("Missing foreign table %r referenced by %s.%s"%(self._ftable, self._model, self._attr))
         if not self._required and value is None:
             return
+        if isinstance(value, six.integer_types) and not isinstance(value, bool):
+            # not yet fetched
+            return
         if not isinstance(value, model):
             raise InvalidColumnValue("%s.%s has type %r but must be of type %r"%(
                 self._model, self._attr, type(value), model))
@@ -809,13 +932,18 @@ class OneToMany(Column):
         class MyModel(Model):
             col = OneToMany('OtherModelName')
             ocol = OneToMany('ModelName')
+
+    If you are going to access a ``OneToMany`` column on many entities, you
+    can fetch the referring entities for all of them at once with
+    ``Query.prefetch_related()`` or ``Model.get(..., prefetch=[...])``.
     '''
-    __slots__ = '_model _attr _ftable _required _unique _index _prefix _suffix _keygen _column'.split()
+    __slots__ = '_model _attr _ftable _required _unique _index _prefix _suffix _deferred _keygen _keygen2 _column'.split()
     def __init__(self, ftable, column=None):
         if column in ON_DELETE or column is NO_ACTION_DEFAULT:
             raise ColumnError("OneToMany lost its on_delete argument - pass it to the ManyToOne instead")
         self._ftable = ftable
         self._required = self._unique = self._index = self._prefix = self._suffix = False
+        self._deferred = self._keygen2 = False
         self._model = self._attr = self._keygen = None
         self._column = column
 
@@ -832,21 +960,28 @@ class OneToMany(Column):
             return
         raise InvalidOperation("Cannot assign to OneToMany relationships")
 
-    def __get__(self, obj, objtype):
+    def _reverse(self):
+        # Returns the foreign model and its column that references this model
         try:
             model = MODELS[self._ftable]
         except KeyError:
             raise ORMError("Missing foreign table %r referenced by %s.%s"%(self._ftable, self._model, self._attr))
 
         if self._column:
-            return model.get_by(**{self._column: getattr(obj, obj._pkey)})
+            return model, self._column
 
         for attr, col in model._columns.items():
             if isinstance(col, (ManyToOne, OneToOne)) and col._ftable == self._model:
-                return model.get_by(**{attr: getattr(obj, obj._pkey)})
+                return model, attr
 
         raise ORMError("Reverse ManyToOne or OneToOne relationship not found for %s.%s -> %s"%(self._model, self._attr, self._ftable))
 
+    def __get__(self, obj, objtype):
+        model, attr = self._reverse()
+        if self._attr in obj._prefetched:
+            return list(obj._prefetched[self._attr])
+        return model.get_by(**{attr: getattr(obj, obj._pkey)})
+
     def __delete__(self, obj):
         raise InvalidOperation("Cannot delete OneToMany relationships")
 
@@ -2,7 +2,8 @@
 __all__ = '''
     ORMError UniqueKeyViolation InvalidOperation
     QueryError ColumnError MissingColumn
-    InvalidColumnValue RestrictError DataRaceError EntityDeletedError'''.split()
+    InvalidColumnValue RestrictError DataRaceError EntityDeletedError
+    BulkError'''.split()
 
 class ORMError(Exception):
     'Base class for all ORM-related errors'
@@ -39,3 +40,7 @@ class InvalidColumnValue(ColumnError):
 
 class BulkError(ORMError):
     'Raised when using session.commit(fast=True) or equivalent, and there is at least one error.'
+    @property
+    def errors(self):
+        'A list of (entity, exception) pairs for the entities that failed'
+        return self.args[1]
@@ -9,23 +9,31 @@ Released under the LGPL license version 2.1 and version 3 (you can choose
 which you'd like to be bound under).
 '''
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from hashlib import sha1
+from itertools import islice
 import json
 import warnings
+import weakref
 
 from redis import client
 import six
 
-from .columns import (Column, Text, PrimaryKey, ManyToOne, OneToOne, OneToMany,
-    MODELS, MODELS_REFERENCED, _on_delete, SKIP_ON_DELETE)
+from .columns import (Column, Integer, Float, Text, PrimaryKey, Version,
+    ManyToOne, OneToOne, OneToMany, MODELS, MODELS_REFERENCED, NULL, _on_delete,
+    SKIP_ON_DELETE, is_mutable)
 from .exceptions import (ORMError, UniqueKeyViolation, InvalidOperation,
     QueryError, ColumnError, InvalidColumnValue, DataRaceError,
-    EntityDeletedError)
+    EntityDeletedError, BulkError, RestrictError)
 from .index import GeneralIndex, GeoIndex
 from .query import Query, NUMERIC_TYPES
 from .util import (ClassProperty, _connect, session,
-    _prefix_score, _script_load, _encode_unique_constraint,
-    STRING_SORT_KEYGENS)
+    _prefix_score, _script_load, _encode_unique_constraint, _iter_fetched,
+    _pipelined, STRING_SORT_KEYGENS)
+
+# how Model._from_rows() loads each column
+_COLUMN_INIT = six.get_unbound_function(Column._init_)
+_LOAD_PKEY, _LOAD_CONVERT, _LOAD_INIT = range(3)
 
 _skip = None
 _skip = set(globals()) - set(['__doc__'])
@@ -46,10 +54,14 @@ class _ModelMetaclass(type):
         dict['_cunique'] = cunique = set()
         dict['_prefix'] = prefix = set()
         dict['_suffix'] = suffix = set()
+        dict['_deferred'] = deferred = set()
+        dict['_mutable'] = mutable = set()
+        dict['_keygen2'] = keygen2 = set()
         dict['_geo'] = geo = {}
 
         dict['_columns'] = columns = {}
         pkey = None
+        version = None
 
         # load all columns from any base classes to allow for validation
         odict = {}
@@ -72,6 +84,8 @@ class _ModelMetaclass(type):
         for attr, col in dict.items():
             if isinstance(col, Column):
                 columns[attr] = col
+                col._attr = attr
+                col._model = dict['_namespace']
                 if col._required:
                     required.add(attr)
                 if col._index:
@@ -82,6 +96,12 @@ class _ModelMetaclass(type):
                     suffix.add(attr)
                 if col._unique:
                     unique.add(attr)
+                if col._deferred:
+                    deferred.add(attr)
+                if col._mutable or (col._mutable is None and is_mutable(col._allowed)):
+                    mutable.add(attr)
+                if col._keygen2:
+                    keygen2.add(attr)
 
             if isinstance(col, PrimaryKey):
                 if pkey:
@@ -90,6 +110,12 @@ class _ModelMetaclass(type):
                     )
                 pkey = attr
 
+            if isinstance(col, Version):
+                if version:
+                    raise ColumnError("Only one version column allowed, you have: %s %s"%(
+                        version, attr))
+                version = attr
+
             if isinstance(col, OneToMany) and not col._column and col._ftable in MODELS:
                 # Check to make sure that the foreign ManyToOne/OneToMany table
                 # doesn't have multiple references to this table to require an
@@ -144,15 +170,49 @@ class _ModelMetaclass(type):
                 if col not in columns:
                     raise ColumnError("Multi-column unique index %r references non-existant column %r"%(
                         comp, col))
+                if col in deferred:
+                    raise ColumnError("Multi-column unique index %r references deferred column %r"%(
+                        comp, col))
             seen[key] = comp
             cunique.add(key)
 
+        # read referenced ids without fetching the referenced entities
+        for attr, col in columns.items():
+            if isinstance(col, ManyToOne):
+                fattr = attr + '_id'
+                if fattr not in dict and not any(hasattr(b, fattr) for b in bases):
+                    dict[fattr] = _foreign_id(attr)
+
+        # precompute how to load each column for Model._from_rows()
+        dict['_converters'] = converters = []
+        for attr, col in sorted(columns.items()):
+            if isinstance(col, OneToMany):
+                continue
+            if isinstance(col, PrimaryKey):
+                kind = _LOAD_PKEY
+            elif six.get_unbound_function(type(col)._init_) is _COLUMN_INIT:
+                kind = _LOAD_CONVERT
+            else:
+                kind = _LOAD_INIT
+            converters.append((attr, attr.encode('latin-1'), col, kind))
+
         dict['_pkey'] = pkey
+        dict['_version'] = version
         dict['_gindex'] = GeneralIndex(dict['_namespace'])
 
         MODELS[dict['_namespace']] = MODELS[name] = model = type.__new__(cls, name, bases, dict)
         return model
 
+def _foreign_id(attr):
+    def get(self):
+        if attr in self._unloaded:
+            self._load_unloaded(attr)
+        value = self._data.get(attr)
+        if value is None or isinstance(value, six.integer_types):
+            return value
+        return getattr(value, value._pkey)
+    return property(get, doc="The id referenced by the %r column"%(attr,))
+
 class AttrDict(dict):
     def __getattr__(self, attr):
         return self.get(attr)
@@ -217,20 +277,109 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         unique constrant is None in Python, the unique constraint won't apply.
         This is the typical behavior of nulls in unique constraints inside both
         MySQL and Postgres.
+
+    **Fetching many entities**
+
+    By default, ``Model.get()`` fetches all requested entities with a single
+    transactional pipeline. For very large fetches, you can bound the time
+    that Redis spends on any one request and the memory used for replies by
+    setting these class attributes on your model:
+
+        * *_fetch_chunk_size* - the number of entities to fetch per pipeline
+          (default ``None``, all entities in one pipeline)
+        * *_fetch_transaction* - whether each pipeline is wrapped in
+          MULTI/EXEC (default ``True``)
+        * *_fetch_overlap* - whether to fetch the next chunk in a background
+          thread while the current chunk is turned into entities (default
+          ``False``)
+
+    Usage::
+
+        class Event(Model):
+            _fetch_chunk_size = 1000
+            _fetch_transaction = False
+
+            name = Text()
+
+    .. note:: Without a transaction, entities fetched in different chunks may
+        reflect different points in time.
+
+    **Allocating ids in blocks**
+
+    By default, every new entity gets its id with an ``INCR`` call to Redis
+    when it is created. If you create entities at a high rate, you can set
+    the *_id_block_size* class attribute to reserve that many ids at a time
+    with ``INCRBY``, which are then handed out locally (safely shared between
+    threads)::
+
+        class Event(Model):
+            _id_block_size = 100
+
+            name = Text()
+
+    Forked processes (and models given a different connection) reserve their
+    own blocks.
+
+    .. note:: Ids reserved but not handed out when your process exits are never
+        used, and ids are no longer ordered by creation time across processes.
+
+    **Asynchronous index updates**
+
+    For models that are written much more often than they are queried, you can
+    set the *_async_indexes* class attribute to ``True``. Writes then only
+    store the entity's data and unique constraints, and append the entity's
+    index changes to a Redis stream (``<namespace>::stream``). The index
+    changes are applied in the order they were written by a
+    ``rom.util.IndexWorker`` running in a thread or in its own process::
+
+        class Click(Model):
+            _async_indexes = True
+
+            url = Text(index=True, keygen=SIMPLE)
+            at = Float(index=True)
+
+        worker = rom.util.IndexWorker([Click])
+        worker.start()
+
+    Until a change has been applied, queries (and ``.count()``) won't see
+    it. ``rom.util.index_lag(Click)`` returns the number of changes waiting
+    to be applied, and how long the oldest one has been waiting.
+
+    .. note:: Requires Redis 5.0 or later.
     '''
+    _fetch_chunk_size = None
+    _fetch_transaction = True
+    _fetch_overlap = False
+    _id_block_size = None
+    _async_indexes = False
+
     def __init__(self, **kwargs):
         self._new = not kwargs.pop('_loading', False)
+        id = kwargs.pop('_id', None)
         model = self._namespace
         self._data = {}
         self._last = {}
         self._modified = False
+        self._dirty = set()
         self._deleted = False
         self._init = False
+        self._page = None
+        self._prefetched = {}
+        self._unloaded = set(kwargs.pop('_unloaded', ()))
+        if not self._new:
+            # deferred columns are only fetched when they are accessed
+            self._unloaded.update(attr for attr in self._deferred if attr not in kwargs)
         for attr in self._columns:
+            if attr in self._unloaded:
+                continue
             cval = kwargs.get(attr, None)
             data = (model, attr, cval, not self._new)
             if self._new and attr == self._pkey and cval:
                 raise InvalidColumnValue("Cannot pass primary key on object creation")
+            if attr == self._pkey and id is not None:
+                # id allocated ahead of time by bulk_create() or upsert_many()
+                data = (model, attr, id, False)
+                self._modified = True
             setattr(self, attr, data)
             if cval != None:
                 if not isinstance(cval, six.string_types):
@@ -279,15 +428,294 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
     def _pk(self):
         return '%s:%s'%(self._namespace, getattr(self, self._pkey))
 
+    def _load_unloaded(self, attr=None, page=False):
+        '''
+        Fetches any columns that were left out when this entity was loaded with
+        ``Model.get(..., columns=[...])`` or ``Query.only(...)``.
+
+        Deferred columns are only fetched when explicitly requested with
+        ``attr``. If ``page`` is true, the deferred column is also fetched for
+        any other entities that were loaded alongside this one and haven't
+        fetched it yet.
+        '''
+        entities = [self]
+        if attr is None or attr not in self._deferred:
+            attrs = sorted(a for a in self._unloaded if a not in self._deferred)
+        else:
+            attrs = [attr]
+            if page and self._page:
+                entities = [ent for ent in (ref() for ref in self._page)
+                    if ent is not None and attr in ent._unloaded]
+                if self not in entities:
+                    entities.append(self)
+        if attrs:
+            _load_columns(entities, attrs)
+
     @classmethod
-    def _apply_changes(cls, old, new, full=False, delete=False, is_new=False):
-        conn = _connect(cls)
+    def _projection(cls, columns):
+        # Returns the columns to fetch from the entity hash (primary key
+        # first, so that we can tell when an entity doesn't exist), the
+        # deferred columns to fetch, and the columns to leave unloaded.
+        if isinstance(columns, six.string_types):
+            columns = [columns]
+        fetch = [cls._pkey]
+        dfetch = []
+        for attr in columns:
+            col = cls._columns.get(attr)
+            if col is None:
+                raise QueryError("Cannot fetch non-existent column %r"%(attr,))
+            if attr in cls._deferred:
+                if attr not in dfetch:
+                    dfetch.append(attr)
+            elif attr not in fetch and not isinstance(col, OneToMany):
+                fetch.append(attr)
+        unloaded = set(attr for attr, col in cls._columns.items()
+            if attr not in fetch and attr not in dfetch and not isinstance(col, OneToMany))
+        return fetch, dfetch, unloaded
+
+    @classmethod
+    def _from_rows(cls, rows, unloaded=()):
+        '''
+        Builds entities from rows of data fetched from Redis (dictionaries
+        with str or bytes keys and values, like ``HGETALL`` replies), in one
+        pass over the precomputed per-column converters, instead of going
+        through ``Model.__init__()`` and the column descriptors. Models that
+        override ``__init__()`` are constructed normally.
+        '''
+        if six.get_unbound_function(cls.__init__) is not six.get_unbound_function(Model.__init__):
+            return [cls(_loading=True, _unloaded=unloaded, **_decoded(row)) for row in rows]
+
+        model = cls._namespace
+        converters = cls._converters
+        deferred = cls._deferred
+        new = object.__new__
+        out = []
+        for row in rows:
+            ent = new(cls)
+            ent._new = ent._modified = ent._deleted = ent._init = False
+            ent._dirty = set()
+            ent._data = data = {}
+            ent._last = last = {}
+            ent._page = None
+            ent._prefetched = {}
+            ent._unloaded = skip = set(unloaded)
+            for attr, battr, col, kind in converters:
+                if attr in skip:
+                    continue
+                value = row.get(attr)
+                if value is None:
+                    value = row.get(battr)
+                if value is None:
+                    if attr in deferred:
+                        skip.add(attr)
+                    else:
+                        # handles defaults and required columns
+                        col._init_(ent, model, attr, None, True)
+                    continue
+                if six.PY3 and isinstance(value, bytes):
+                    value = value.decode()
+                if kind == _LOAD_CONVERT:
+                    if isinstance(value, col._allowed):
+                        data[attr] = value
+                    else:
+                        try:
+                            data[attr] = col._from_redis(value)
+                        except (ValueError, TypeError) as e:
+                            raise InvalidColumnValue(*e.args)
+                elif kind == _LOAD_PKEY:
+                    data[attr] = int(value)
+                else:
+                    col._init_(ent, model, attr, value, True)
+                if not isinstance(value, six.string_types):
+                    value = col._to_redis(value)
+                last[attr] = value
+            ent._init = True
+            session.add(ent)
+            out.append(ent)
+        return out
+
+    @classmethod
+    def _check_values(cls, columns):
+        if not columns:
+            return [cls._pkey] + [c[0] for c in cls._converters if c[0] != cls._pkey]
+        known = set(c[0] for c in cls._converters)
+        for attr in columns:
+            if attr not in known:
+                raise QueryError("Cannot fetch values for %r, which is not a column with data"%(attr,))
+        return list(columns)
+
+    @classmethod
+    def _check_update(cls, values, expected=False):
+        # Validates and converts the column values passed to Query.update(),
+        # the same way that assigning them to an entity would.
+        out = {}
+        for attr, value in values.items():
+            col = cls._columns.get(attr)
+            if col is None or isinstance(col, OneToMany):
+                raise QueryError("Cannot update %r, which is not a column with data"%(attr,))
+            if attr == cls._pkey:
+                raise InvalidOperation("Cannot update primary key value")
+            if attr == cls._version and not expected:
+                raise InvalidOperation("Cannot update version value")
+            if value is None:
+                if col._required:
+                    raise InvalidOperation("%s.%s cannot be null"%(cls._namespace, attr))
+            else:
+                try:
+                    if not isinstance(value, col._allowed):
+                        value = col._from_redis(value)
+                except (ValueError, TypeError):
+                    raise InvalidColumnValue("Cannot convert %r into type %s"%(value, col._allowed))
+                col._validate(value)
+            out[attr] = value
+        return out
+
+    @classmethod
+    def _to_values(cls, columns, rows):
+        # Converts rows of data fetched from Redis into tuples of values for
+        # the provided columns, the same way that _from_rows() converts them.
+        converters = dict((c[0], c) for c in cls._converters)
+        converters = [converters[attr] for attr in columns]
+        model = cls._namespace
+        scratch = _Scratch()
+        for row in rows:
+            values = []
+            for attr, battr, col, kind in converters:
+                value = row.get(attr)
+                if value is None:
+                    value = row.get(battr)
+                if six.PY3 and isinstance(value, bytes):
+                    value = value.decode()
+                if value is None or kind == _LOAD_INIT:
+                    col._init_(scratch, model, attr, value, True)
+                    value = scratch._data.pop(attr)
+                elif kind == _LOAD_PKEY:
+                    value = int(value)
+                elif not isinstance(value, col._allowed):
+                    try:
+                        value = col._from_redis(value)
+                    except (ValueError, TypeError) as e:
+                        raise InvalidColumnValue(*e.args)
+                values.append(value)
+            yield tuple(values)
+
+    @classmethod
+    def _check_related(cls, related):
+        if isinstance(related, six.string_types):
+            related = [related]
+        for attr in related:
+            if not isinstance(cls._columns.get(attr), ManyToOne):
+                raise QueryError("Cannot fetch related entities for %r, which is not a ManyToOne or OneToOne column"%(attr,))
+        return list(related)
+
+    @classmethod
+    def _load_related(cls, rows, related):
+        # Replaces the foreign ids in the provided rows of entity data with the
+        # referenced entities, using one Model.get() call per foreign model.
+        ids = defaultdict(set)
+        for attr in related:
+            ftable = cls._columns[attr]._ftable
+            for row in rows:
+                if row.get(attr):
+                    ids[ftable].add(int(row[attr]))
+        known = {}
+        for ftable, fids in ids.items():
+            try:
+                fmodel = MODELS[ftable]
+            except KeyError:
+                raise ORMError("Missing foreign table %r referenced by %s"%(ftable, cls._namespace))
+            for ent in fmodel.get(sorted(fids)):
+                known[ftable, getattr(ent, ent._pkey)] = ent
+        for attr in related:
+            ftable = cls._columns[attr]._ftable
+            for row in rows:
+                if row.get(attr):
+                    # missing entities are left for the column to handle
+                    row[attr] = known.get((ftable, int(row[attr])), row[attr])
+
+    @classmethod
+    def _check_prefetch(cls, prefetch):
+        if isinstance(prefetch, six.string_types):
+            prefetch = [prefetch]
+        for attr in prefetch:
+            if not isinstance(cls._columns.get(attr), OneToMany):
+                raise QueryError("Cannot prefetch entities for %r, which is not a OneToMany column"%(attr,))
+        return list(prefetch)
+
+    def _load_digest(self, attr):
+        # Fetches the SHA1 digest of an unloaded deferred column that is being
+        # replaced, which is all that the data race check needs, instead of
+        # its (possibly large) value.
+        self._unloaded.discard(attr)
+        digest = _redis_digest_lua(_connect(self), ['%s:%s'%(self._pk, attr)])
+        if digest is not None:
+            if isinstance(digest, six.binary_type):
+                digest = digest.decode()
+            self._last[attr] = _Digest(digest)
+
+    @classmethod
+    def _load_prefetched(cls, entities, prefetch):
+        # Fetches the entities referring to each of the provided entities via
+        # the provided OneToMany columns, with one pipelined call for all of
+        # the index ranges, and one Model.get() call per OneToMany column.
+        pipe = _connect(cls).pipeline(False)
+        reverse = []
+        for attr in prefetch:
+            model, fattr = cls._columns[attr]._reverse()
+            reverse.append((attr, model, fattr))
+            index = '%s:%s:idx'%(model._namespace, fattr)
+            for ent in entities:
+                id = getattr(ent, ent._pkey)
+                pipe.zrangebyscore(index, id, id)
+        results = iter(pipe.execute())
+        for attr, model, fattr in reverse:
+            ids = [[int(id) for id in next(results)] for ent in entities]
+            known = {}
+            for ref in model.get(sorted(set(id for refs in ids for id in refs))):
+                known[getattr(ref, ref._pkey)] = ref
+            for ent, refs in zip(entities, ids):
+                refs = [known[id] for id in refs if id in known]
+                for ref in refs:
+                    # point back at the entity we already have
+                    if ref._data.get(fattr) == getattr(ent, ent._pkey):
+                        ref._data[fattr] = ent
+                ent._prefetched[attr] = refs
+
+    @staticmethod
+    def _set_page(entities):
+        # Entities loaded together keep (weak) references to each other, so
+        # that deferred columns can be fetched for all of them at once.
+        page = [weakref.ref(ent) for ent in entities]
+        for ent in entities:
+            ent._page = page
+
+    @classmethod
+    def _apply_changes(cls, old, new, full=False, delete=False, is_new=False, pipe=None, dirty=None):
+        changes, redis_data, args = cls._prepare_changes(old, new, full, delete, is_new, dirty)
+        conn = _connect(cls) if pipe is None else pipe
+        check = _run_writer(conn, args)
+        return changes, redis_data, check
+
+    @classmethod
+    def _prepare_changes(cls, old, new, full=False, delete=False, is_new=False, dirty=None):
+        # Returns the number of changed columns, the data as stored in Redis,
+        # and the _WriterArgs for the writer script.
+        # Unless this is a full write, only the columns in ``dirty`` (plus
+        # those that may have been modified in-place, and those indexed by
+        # keygen2 functions, which read the whole entity) are processed.
         pk = old.get(cls._pkey) or new.get(cls._pkey)
         if not pk:
             raise ColumnError("Missing primary key value")
 
         model = cls._namespace
         columns = cls._columns
+        attrs = columns
+        indexed = False
+        if dirty is not None and not (full or delete):
+            attrs = set(dirty)
+            attrs.update(cls._mutable)
+            attrs.update(cls._keygen2)
+            indexed = sorted(attrs)
         changes = 0
         keys = set()
         scores = {}
@@ -298,22 +726,38 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         prefix = []
         suffix = []
         geo = []
+        dwrite = {}
+        ddeleted = sorted(cls._deferred) if delete else []
         redis_data = {}
+        if indexed is not False:
+            # unprocessed columns are unchanged in Redis
+            redis_data = dict((attr, value) for attr, value in old.items()
+                if attr in columns and attr not in attrs)
 
         # update individual columns
-        for attr in cls._columns:
+        for attr in attrs:
+            if attr == cls._version:
+                continue
             ikey = None
             if attr in cls._unique:
                 ikey = "%s:%s:uidx"%(model, attr)
 
             ca = columns[attr]
             roval = old.get(attr)
-            oval = ca._from_redis(roval) if roval is not None else None
+            if isinstance(roval, _Digest):
+                # replaced without being fetched, see Model._load_digest()
+                oval = roval
+            else:
+                oval = ca._from_redis(roval) if roval is not None else None
 
             nval = new.get(attr)
             rnval = ca._to_redis(nval) if nval is not None else None
             if rnval is not None:
                 redis_data[attr] = rnval
+            if isinstance(ca, ManyToOne):
+                # compare references by id, referenced entities may not have
+                # been fetched
+                oval, nval = roval, rnval
 
             # Add/update standard index
             if ca._keygen and not delete and nval is not None and (ca._index or ca._prefix or ca._suffix):
@@ -379,6 +823,14 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
 
             changes += 1
 
+            # Deferred columns are stored outside of the entity hash
+            if attr in cls._deferred:
+                if nval is not None:
+                    dwrite[attr] = rnval
+                elif oval is not None and not delete:
+                    ddeleted.append(attr)
+                continue
+
             # Delete removed columns
             if nval is None and oval is not None:
                 deleted.append(attr)
@@ -401,6 +853,8 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
 
         # Add/update multi-column unique constraint
         for uniq in cls._cunique:
+            if not any(c in attrs for c in uniq):
+                continue
             attr = ':'.join(uniq)
 
             odata = [old.get(c) for c in uniq]
@@ -413,7 +867,7 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
             if None not in ndata:
                 unique[attr] = _encode_unique_constraint(ndata)
 
-        for name in cls._geo:
+        for name in (() if delete else cls._geo):
             idx = cls._geo[name]
             val = idx.callback(AttrDict(new))
             if isinstance(val, dict):
@@ -425,19 +879,63 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                     raise ORMError("Lon/Lat pair for geo index is not a dictionary of {'lon': ..., 'lat': ...}")
 
         id_only = str(pk)
-        old_data = [] if is_new else ([(cls._pkey, str(pk))] + [(k, old.get(k)) for k in data if k in old])
-        redis_writer_lua(conn, cls._pkey, model, id_only, unique, udeleted,
-            deleted, data, list(keys), scores, prefix, suffix, geo, old_data,
-            delete)
+        version = cls._version
+        bump = version and not delete and (changes or full)
+        if bump:
+            data[version] = redis_data[version] = str(int(old.get(version) or 0) + 1)
+        elif version and old.get(version) is not None:
+            # nothing changed, concurrent writers keep a valid version
+            redis_data[version] = old[version]
+
+        if is_new:
+            old_data = []
+        elif bump:
+            # only the version needs to be unchanged
+            old_data = [(cls._pkey, str(pk)), (version, old.get(version))]
+        elif version:
+            old_data = [(cls._pkey, str(pk))]
+        else:
+            old_data = ([(cls._pkey, str(pk))] + [(k, old.get(k)) for k in data if k in old]
+                + [cls._race_pair(k, old.get(k)) for k in dwrite if k in old])
+        args = _WriterArgs(pkey=cls._pkey, namespace=model, id=id_only,
+            unique=unique, udelete=udeleted, delete=deleted, data=data,
+            keys=list(keys), scored=scores, prefix=prefix, suffix=suffix,
+            geo=geo, old_data=old_data, is_delete=delete, deferred=dwrite,
+            ddelete=ddeleted, rebuild=full and not is_new, indexed=indexed,
+            stream=cls._async_indexes)
+
+        return changes, redis_data, args
 
-        return changes, redis_data
+    @classmethod
+    def _race_pair(cls, attr, value):
+        # Returns the (column, value) pair that the writer script checks is
+        # unchanged in Redis. Deferred columns are compared by SHA1 digest,
+        # so their previous (possibly large) values aren't sent.
+        if attr not in cls._deferred:
+            return (attr, value)
+        if isinstance(value, _Digest):
+            return (attr, str(value), 1)
+        if value is not None:
+            if isinstance(value, six.text_type):
+                value = value.encode('utf-8')
+            value = sha1(value).hexdigest()
+        return (attr, value, 1)
 
     def to_dict(self):
         '''
         Returns a copy of all data assigned to columns in this entity. Useful
         for returning items to JSON-enabled APIs. If you want to copy an
         entity, you should look at the ``.copy()`` method.
+
+        .. note:: Columns that were not fetched as part of a
+          ``Model.get(..., columns=[...])`` or ``Query.only(...)`` call are not
+          included.
+        .. note:: Entities referenced by ``ManyToOne`` and ``OneToOne`` columns
+          that haven't been fetched yet will be fetched.
         '''
+        for attr, value in list(self._data.items()):
+            if isinstance(value, six.integer_types) and isinstance(self._columns[attr], ManyToOne):
+                getattr(self, attr)
         return dict(self._data)
 
     def save(self, full=False, force=False):
@@ -447,7 +945,84 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
 
         If the underlying entity was deleted and you want to re-save the entity,
         you can pass ``force=True`` to force a full re-save of the entity.
+
+        .. note:: Entities that were loaded with only some of their columns
+          will fetch their remaining columns before saving.
         '''
+        batch = _pipelined()
+        if batch is not None:
+            # written at the end of the pipelined_saves() block
+            pipe = batch._pipeline(self)
+            state = (self._last, self._new, self._data.get(self._version))
+            was_new, ret, data, args = self._save_args(full, force)
+            written = batch._written.setdefault(id(self), set())
+            if args.old_data and not self._version:
+                # also check the columns written by earlier saves in the
+                # block, which fail if any of those writes failed
+                args = args._replace(old_data=args.old_data + [
+                    self._race_pair(attr, self._last.get(attr)) for attr in sorted(written)])
+            written.update(args.data)
+            written.update(args.delete)
+            written.update(args.deferred or ())
+            written.update(args.ddelete)
+            check = _run_writer(pipe, args)
+            snapshot = dict(self._data)
+            # later saves in the block are checked against this write
+            self._last = data
+            self._new = False
+            self._modified = False
+            self._dirty = set()
+            if self._version in data:
+                self._data[self._version] = int(data[self._version])
+            batch._queue(self, pipe, check, lambda: self._save_finish(was_new, data, snapshot),
+                lambda: self._restore_state(state))
+            return ret
+
+        was_new, ret, data, check = self._save_prepare(full, force)
+        self._save_finish(was_new, data)
+        return ret
+
+    def atomic_incr(self, attr, amount=1):
+        '''
+        Atomically adds ``amount`` to the ``Integer`` or ``Float`` column
+        ``attr`` of this (saved) entity in Redis, like ``Model.incr()``, and
+        updates this entity with the new value, which is returned. Concurrent
+        increments from other writers don't cause data races. The entity's
+        ``Version`` column (if any) is updated too, unless another writer
+        changed the entity since it was loaded.
+        '''
+        if self._new:
+            raise InvalidOperation("Cannot increment a column on a new entity")
+        if attr in self._dirty:
+            raise InvalidOperation("Cannot increment modified column %r"%(attr,))
+        value, version = self._incr(getattr(self, self._pkey), attr, amount)
+        if value is None:
+            raise EntityDeletedError("Entity %s deleted by another writer"%(self._pk,),
+                self._namespace, getattr(self, self._pkey))
+        # keep the value as Redis formatted it, so the next save's race
+        # check compares the same string
+        self._last[attr] = value
+        self._data[attr] = value = self._columns[attr]._from_redis(value)
+        last = self._last.get(self._version)
+        if version and last is not None and int(version) == int(last) + 1:
+            # only our increment changed the entity since it was loaded
+            self._last[self._version] = version
+            self._data[self._version] = int(version)
+        return value
+
+    def _save_prepare(self, full, force, pipe=None):
+        # Runs the pre-commit hooks and sends the changes to Redis (or queues
+        # them in the provided pipeline, returning a function to check the
+        # result of the write).
+        was_new, ret, data, args = self._save_args(full, force)
+        conn = _connect(self) if pipe is None else pipe
+        return was_new, ret, data, _run_writer(conn, args)
+
+    def _save_args(self, full, force):
+        # Runs the pre-commit hooks, returning the _WriterArgs to write the
+        # changes.
+        if self._unloaded:
+            self._load_unloaded()
         # handle the pre-commit hooks
         was_new = self._new
         if was_new:
@@ -455,19 +1030,40 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         else:
             self._before_update()
 
-        new = self.to_dict()
-        ret, data = self._apply_changes(
-            self._last, new, full or self._new or force, is_new=self._new or force)
+        new = dict(self._data)
+        ret, data, args = self._prepare_changes(
+            self._last, new, full or self._new or force, is_new=self._new or force,
+            dirty=self._dirty)
+        return was_new, ret, data, args
+
+    def _restore_state(self, state):
+        # Restores the state of an entity whose queued write failed, leaving
+        # all of its columns to be compared by the next save.
+        self._last, self._new, version = state
+        if self._version:
+            self._data[self._version] = version
+        self._modified = True
+        self._dirty = set(self._columns)
+
+    def _save_finish(self, was_new, data, written=None):
+        # ``written`` is the entity's data when a pipelined write was queued,
+        # columns changed since then are left to be saved.
         self._last = data
+        if self._version in data:
+            self._data[self._version] = int(data[self._version])
         self._new = False
-        self._modified = False
+        if written is None:
+            self._dirty = set()
+        else:
+            self._dirty = set(attr for attr in self._dirty
+                if self._data.get(attr) != written.get(attr))
+        self._modified = bool(self._dirty)
         self._deleted = False
         # handle the post-commit hooks
         if was_new:
             self._after_insert()
         else:
             self._after_update()
-        return ret
 
     def delete(self, **kwargs):
         '''
@@ -480,25 +1076,45 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
             # handle any foreign key references + cascade options
             _on_delete(self)
 
+        if self._unloaded:
+            self._load_unloaded()
         session.forget(self)
-        self._apply_changes(self._last, {}, delete=True)
+        hooks = kwargs.get('skip_on_delete_i_really_mean_it') is not SKIP_ON_DELETE
+        batch = _pipelined()
+        if batch is not None:
+            # written at the end of the pipelined_saves() block
+            pipe = batch._pipeline(self)
+            state = (self._deleted, self._modified)
+            check = self._apply_changes(self._last, {}, delete=True, pipe=pipe)[2]
+            batch._queue(self, pipe, check, self._after_delete if hooks else (lambda: None),
+                lambda: self._restore_deleted(state))
+        else:
+            self._apply_changes(self._last, {}, delete=True)
         self._modified = True
         self._deleted = True
         # handle the post-commit hooks
-        if kwargs.get('skip_on_delete_i_really_mean_it') is not SKIP_ON_DELETE:
+        if hooks and batch is None:
             self._after_delete()
 
+    def _restore_deleted(self, state):
+        # Restores the state of an entity whose queued delete wasn't written.
+        self._deleted, self._modified = state
+        session.add(self)
+
     def copy(self):
         '''
         Creates a shallow copy of the given entity (any entities that can be
         retrieved from a OneToMany relationship will not be copied).
         '''
-        x = self.to_dict()
+        if self._unloaded:
+            # all remaining columns, deferred or not, in one round trip
+            _load_columns([self], sorted(self._unloaded))
+        x = dict(self._data)
         x.pop(self._pkey)
         return self.__class__(**x)
 
     @classmethod
-    def get(cls, ids):
+    def get(cls, ids, columns=None, related=None, prefetch=None):
         '''
         Will fetch one or more entities of this type from the session or
         Redis.
@@ -510,6 +1126,33 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
 
         Passing a list or a tuple will return multiple entities, in the same
         order that the ids were passed.
+
+        If you only need some of the columns of your entities, you can pass
+        a list of column names as ``columns``, and only those columns (and the
+        primary key) will be fetched from Redis::
+
+            MyModel.get([1, 6, 2, 4], columns=['name', 'email'])
+
+        The remaining columns will be fetched the first time that any of them
+        are accessed or modified, or when the entity is saved or deleted.
+        Deferred columns are only fetched by ``Model.get()`` when they are
+        explicitly listed in ``columns``.
+
+        If you are going to access entities referenced by ``ManyToOne`` or
+        ``OneToOne`` columns, you can pass those column names as ``related``,
+        and all referenced entities will be fetched with one ``Model.get()``
+        call per referenced model, instead of one call per entity::
+
+            Comment.get([1, 6, 2, 4], related=['author'])
+
+        Similarly, you can pass ``OneToMany`` column names as ``prefetch``, and
+        the referring entities for all of the returned entities will be
+        fetched at once, to be returned when those columns are accessed::
+
+            Project.get([1, 6, 2, 4], prefetch=['tasks'])
+
+        .. note:: Entities already known by the session are returned as-is,
+          with whatever columns they have already loaded.
         '''
         conn = _connect(cls)
         # prepare the ids
@@ -517,29 +1160,517 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         if single:
             ids = [ids]
         pks = ['%s:%s'%(cls._namespace, id) for id in map(int, ids)]
+        fetch = unloaded = None
+        dfetch = ()
+        if columns is not None:
+            fetch, dfetch, unloaded = cls._projection(columns)
+        if related:
+            related = cls._check_related(related)
+        if prefetch:
+            prefetch = cls._check_prefetch(prefetch)
         # get from the session, if possible
         out = list(map(session.get, pks))
         # if we couldn't get an instance from the session, load from Redis
         if None in out:
-            pipe = conn.pipeline(True)
-            idxs = []
+            idxs = [i for i, data in enumerate(out) if data is None]
+            size = cls._fetch_chunk_size or len(idxs)
+            chunks = [idxs[i:i+size] for i in range(0, len(idxs), size)]
+
+            def fetch_chunk(chunk):
+                pipe = conn.pipeline(cls._fetch_transaction)
+                for i in chunk:
+                    if fetch:
+                        pipe.hmget(pks[i], fetch)
+                    else:
+                        pipe.hgetall(pks[i])
+                    for attr in dfetch:
+                        pipe.get('%s:%s'%(pks[i], attr))
+                return pipe.execute()
+
             # Fetch missing data
-            for i, data in enumerate(out):
-                if data is None:
-                    idxs.append(i)
-                    pipe.hgetall(pks[i])
-            # Update output list
-            for i, data in zip(idxs, pipe.execute()):
-                if data:
-                    if six.PY3:
-                        data = dict((k.decode(), v.decode()) for k, v in data.items())
-                    out[i] = cls(_loading=True, **data)
+            for chunk, results in zip(chunks, _iter_fetched(fetch_chunk, chunks, cls._fetch_overlap)):
+                results = iter(results)
+                rows = []
+                # Update output list
+                for i in chunk:
+                    data = next(results)
+                    dvalues = [next(results) for attr in dfetch]
+                    if fetch:
+                        # the primary key is always stored, so a missing primary
+                        # key means that the entity doesn't exist
+                        if data[0] is None:
+                            continue
+                        data = dict(zip(fetch + dfetch, list(data) + dvalues))
+                    if data:
+                        rows.append((i, data))
+                if related:
+                    rows = [(i, _decoded(data)) for i, data in rows]
+                    cls._load_related([data for i, data in rows], related)
+                loaded = cls._from_rows([data for i, data in rows], unloaded or ())
+                for (i, data), ent in zip(rows, loaded):
+                    out[i] = ent
+                if cls._deferred and len(loaded) > 1:
+                    cls._set_page(loaded)
             # Get rid of missing models
             out = [x for x in out if x]
+        if prefetch and out:
+            cls._load_prefetched(out, prefetch)
         if single:
             return out[0] if out else None
         return out
 
+    @classmethod
+    def bulk_create(cls, rows, batch_size=1000):
+        '''
+        Creates and saves new entities from an iterable of dictionaries of
+        column values, ``batch_size`` entities at a time. The ids for each
+        batch are allocated with a single ``INCRBY``, and each batch (entity
+        data, indexes, and unique constraints) is written by a single call to
+        Redis::
+
+            users = User.bulk_create({'email_address': e} for e in addresses)
+
+        Returns the list of saved entities. Rows that would violate a unique
+        constraint are not saved; after all batches have been written, a
+        ``BulkError`` is raised whose ``.errors`` attribute lists the
+        ``(entity, exception)`` pairs for those rows.
+
+        .. note:: Insert hooks are called for every entity, but created
+          entities are not kept in the session.
+        '''
+        conn = _connect(cls)
+        key = '%s:%s:'%(cls._namespace, cls._pkey)
+        rows = iter(rows)
+        out = []
+        errors = []
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            last = conn.incrby(key, len(batch))
+            ents = [cls(_id=id, **row) for id, row in
+                zip(range(last - len(batch) + 1, last + 1), batch)]
+            args = []
+            prepared = []
+            for ent in ents:
+                session.forget(ent)
+                ent._before_insert()
+                ret, data, wargs = cls._prepare_changes(ent._last, dict(ent._data), True, is_new=True)
+                args.extend(_writer_args(wargs))
+                prepared.append((ent, data, wargs))
+
+            results = _redis_bulk_writer_lua(conn, [], [len(args) // len(ents)] + args)
+            for (ent, data, wargs), result in zip(prepared, results):
+                try:
+                    _check_writer_result(result, wargs)
+                except ORMError as e:
+                    errors.append((ent, e))
+                    continue
+                ent._save_finish(True, data)
+                out.append(ent)
+
+        if errors:
+            raise BulkError("%i of %i rows could not be saved"%(
+                len(errors), len(out) + len(errors)), errors)
+        return out
+
+    @classmethod
+    def upsert_many(cls, rows, key, batch_size=1000):
+        '''
+        Creates or updates entities from an iterable of dictionaries of column
+        values, matching rows to existing entities by the value of the
+        ``unique`` column ``key``, ``batch_size`` rows at a time::
+
+            Product.upsert_many(catalog_rows, key='sku')
+
+        Each batch looks up existing ids with one ``HMGET`` of the unique
+        index, fetches the existing entities with one round trip, allocates
+        ids for new rows with one ``INCRBY``, and writes all of its rows
+        (entity data, indexes, and unique constraints) with a single call to
+        Redis. Only the columns present in a row are changed on existing
+        entities; passing ``None`` removes the value.
+
+        Returns the list of the ids of the created or updated entities, in
+        the order of the rows. Rows that can't be written (invalid values,
+        unique constraint violations, entities modified during the upsert, or
+        a ``key`` value repeated in a batch) are reported together as
+        ``(row, exception)`` pairs in a ``BulkError`` raised after all other
+        rows have been written.
+
+        .. note:: Hooks are not called, and entities already loaded into the
+          session are not changed.
+        '''
+        col = cls._columns.get(key)
+        if key not in cls._unique:
+            raise QueryError("Can only upsert by a unique column, not %r"%(key,))
+        conn = _connect(cls)
+        ukey = '%s:%s:uidx'%(cls._namespace, key)
+        idkey = '%s:%s:'%(cls._namespace, cls._pkey)
+        rows = iter(rows)
+        out = []
+        errors = []
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            checked = []
+            seen = set()
+            for row in batch:
+                out.append(None)
+                try:
+                    if row.get(key) is None:
+                        raise InvalidOperation("Missing value for upsert key %r"%(key,))
+                    values = cls._check_update(row)
+                    value = col._to_redis(values[key])
+                    if value in seen:
+                        raise UniqueKeyViolation("Value %r for %s repeated in batch"%(value, ukey))
+                except ORMError as e:
+                    errors.append((row, e))
+                    continue
+                seen.add(value)
+                checked.append((len(out) - 1, row, values))
+            if not checked:
+                continue
+
+            # fetch the entities that already exist
+            ids = conn.hmget(ukey, [col._to_redis(values[key]) for i, row, values in checked])
+            pipe = conn.pipeline(False)
+            for (i, row, values), id in zip(checked, ids):
+                if id:
+                    pk = '%s:%s'%(cls._namespace, int(id))
+                    pipe.hgetall(pk)
+                    for attr in sorted(values):
+                        if attr in cls._deferred:
+                            pipe.get('%s:%s'%(pk, attr))
+            results = iter(pipe.execute())
+            prepared = []
+            new = []
+            for (i, row, values), id in zip(checked, ids):
+                if id:
+                    hrow = next(results)
+                    deferred = [attr for attr in sorted(values) if attr in cls._deferred]
+                    drow = dict((attr, next(results)) for attr in deferred)
+                    if hrow:
+                        prepared.append((i, row, cls._update_row(hrow, drow, values)[1]))
+                        continue
+                # the unique index may reference a just-deleted entity
+                new.append((i, row, values))
+
+            if new:
+                last = conn.incrby(idkey, len(new))
+                for id, (i, row, values) in zip(range(last - len(new) + 1, last + 1), new):
+                    try:
+                        ent = cls(_id=id, **dict((attr, value)
+                            for attr, value in values.items() if value is not None))
+                        session.forget(ent)
+                        wargs = cls._prepare_changes(ent._last, dict(ent._data), True, is_new=True)[2]
+                    except ORMError as e:
+                        errors.append((row, e))
+                        continue
+                    prepared.append((i, row, wargs))
+            if not prepared:
+                continue
+
+            args = []
+            for i, row, wargs in prepared:
+                args.extend(_writer_args(wargs))
+            results = _redis_bulk_writer_lua(conn, [], [len(args) // len(prepared)] + args)
+            for (i, row, wargs), result in zip(prepared, results):
+                try:
+                    _check_writer_result(result, wargs)
+                except ORMError as e:
+                    errors.append((row, e))
+                    continue
+                out[i] = int(wargs.id)
+
+        if errors:
+            raise BulkError("%i of %i rows could not be written"%(
+                len(errors), len(out)), errors)
+        return out
+
+    @classmethod
+    def delete_many(cls, ids, batch_size=1000):
+        '''
+        Deletes the entities with the provided ids, performing the
+        ``on_delete`` actions of all columns referencing them, and returns the
+        number of those entities that existed::
+
+            # remove a tenant, along with everything that cascades from it
+            Tenant.delete_many([tenant_id])
+
+        References are found with one round trip to Redis per ``batch_size``
+        ids for each referencing column, and referencing entities are
+        deleted or updated ``batch_size`` at a time without creating any
+        entities. If a ``'restrict'`` reference is found, ``RestrictError``
+        is raised before anything is deleted.
+
+        Entities that can't be updated by a ``'set null'`` or ``'set
+        default'`` action are reported together as ``(id, exception)`` pairs
+        in a ``BulkError`` raised after all other changes have been written.
+
+        .. note:: Delete and update hooks are not called.
+        '''
+        # breadth-first search for everything to delete and update
+        ids = sorted(set(int(id) for id in ids))
+        deleting = {cls._namespace: set(ids)}
+        pending = [(cls, ids)]
+        updating = defaultdict(set)
+        while pending:
+            model, mids = pending.pop(0)
+            for tbl, attr, action in MODELS_REFERENCED.get(model._namespace, ()):
+                if action == 'no action':
+                    continue
+                refs = MODELS[tbl]._referencing(attr, mids, batch_size)
+                if not refs:
+                    continue
+                if action == 'restrict':
+                    raise RestrictError(
+                        "Cannot delete entities %s with pks %s, %i foreign references from %s.%s exist"%(
+                            model._namespace, mids[:10], len(refs), tbl, attr))
+                elif action == 'cascade':
+                    seen = deleting.setdefault(tbl, set())
+                    refs.difference_update(seen)
+                    if refs:
+                        seen.update(refs)
+                        pending.append((MODELS[tbl], sorted(refs)))
+                else:
+                    updating[tbl, attr, action].update(refs)
+
+        deleted = 0
+        for tbl, tids in sorted(deleting.items()):
+            if tbl == cls._namespace:
+                # only count the entities we were asked to delete
+                for i in range(0, len(ids), batch_size):
+                    deleted += cls._delete_ids(ids[i:i+batch_size])
+                tids = tids - set(ids)
+            tids = sorted(tids)
+            for i in range(0, len(tids), batch_size):
+                MODELS[tbl]._delete_ids(tids[i:i+batch_size])
+
+        errors = []
+        for (tbl, attr, action), tids in sorted(updating.items()):
+            # Careful not to resurrect deleted entities
+            tids = sorted(tids - deleting.get(tbl, set()))
+            model = MODELS[tbl]
+            default = model._columns[attr]._default
+            for i in range(0, len(tids), batch_size):
+                chunk = tids[i:i+batch_size]
+                if action == 'set null' or default in (None, NULL):
+                    groups = [(chunk, None)]
+                elif callable(default):
+                    groups = [([id], default()) for id in chunk]
+                else:
+                    groups = [(chunk, default)]
+                for gids, value in groups:
+                    errors.extend(model._update_ids(gids,
+                        model._check_update({attr: value}))[1])
+        if errors:
+            raise BulkError("%i referencing entities could not be updated"%(
+                len(errors),), errors)
+        return deleted
+
+    @classmethod
+    def _referencing(cls, attr, ids, batch_size):
+        # Returns the set of ids of entities whose ManyToOne or OneToOne
+        # column ``attr`` references one of the provided ids, using one
+        # round trip per batch_size ids.
+        conn = _connect(cls)
+        key = '%s:%s:idx'%(cls._namespace, attr)
+        out = set()
+        for i in range(0, len(ids), batch_size):
+            pipe = conn.pipeline(False)
+            for id in ids[i:i+batch_size]:
+                pipe.zrangebyscore(key, id, id)
+            for refs in pipe.execute():
+                out.update(int(ref) for ref in refs)
+        return out
+
+    @classmethod
+    def _delete_ids(cls, ids):
+        # Deletes the entities with the provided ids, along with their index
+        # and unique entries, with one round trip to fetch the entities and
+        # one call to the writer script. Entities are not constructed, and
+        # no on_delete actions or delete hooks are run. Returns the number of
+        # entities that existed.
+        if not ids:
+            return 0
+        conn = _connect(cls)
+        pipe = conn.pipeline(False)
+        for id in ids:
+            pipe.hgetall('%s:%s'%(cls._namespace, id))
+        args = []
+        deleted = 0
+        for id, row in zip(ids, pipe.execute()):
+            deleted += bool(row)
+            # missing entities may still have index data to clean up
+            old = _decoded(row) if row else {}
+            old[cls._pkey] = str(id)
+            wargs = cls._prepare_changes(old, {}, delete=True)[2]
+            args.extend(_writer_args(wargs))
+        _redis_bulk_writer_lua(conn, [], [len(args) // len(ids)] + args)
+
+        for id in ids:
+            ent = session.get('%s:%s'%(cls._namespace, id))
+            if ent is not None:
+                session.forget(ent)
+                ent._modified = True
+                ent._deleted = True
+        return deleted
+
+    @classmethod
+    def _update_ids(cls, ids, values):
+        # Sets the provided (already checked) column values on the entities
+        # with the provided ids, with one round trip to fetch the entities and
+        # one call to the writer script. Only the updated columns are compared
+        # and re-indexed (all columns are converted, as keygens, unique
+        # constraints and geo callbacks may read any of them). Returns the
+        # number of entities updated, and a list of (id, exception) pairs for
+        # failed updates.
+        conn = _connect(cls)
+        deferred = [attr for attr in values if attr in cls._deferred]
+        pipe = conn.pipeline(False)
+        for id in ids:
+            pk = '%s:%s'%(cls._namespace, id)
+            pipe.hgetall(pk)
+            for attr in deferred:
+                pipe.get('%s:%s'%(pk, attr))
+        results = iter(pipe.execute())
+        args = []
+        updating = []
+        for id in ids:
+            row = next(results)
+            dvalues = [next(results) for attr in deferred]
+            if not row:
+                # deleted since the query was run
+                continue
+            wargs = cls._update_row(row, dict(zip(deferred, dvalues)), values)[1]
+            args.extend(_writer_args(wargs))
+            updating.append(wargs)
+        if not updating:
+            return 0, []
+
+        results = _redis_bulk_writer_lua(conn, [], [len(args) // len(updating)] + args)
+        updated = 0
+        errors = []
+        for wargs, result in zip(updating, results):
+            try:
+                _check_writer_result(result, wargs)
+            except ORMError as e:
+                errors.append((int(wargs.id), e))
+                continue
+            updated += 1
+        return updated, errors
+
+    @classmethod
+    def _update_row(cls, row, drow, values):
+        # Returns the data of an entity fetched from Redis, and the
+        # _WriterArgs to set the provided (already checked) column values on
+        # it.
+        old = _decoded(row)
+        for attr, value in drow.items():
+            if value is not None:
+                old[attr] = value.decode() if six.PY3 and isinstance(value, bytes) else value
+        # keygens and geo index callbacks get all of the entity's data
+        columns = cls._columns
+        new = dict((attr, columns[attr]._from_redis(value))
+            for attr, value in old.items() if attr in columns)
+        for attr, value in values.items():
+            if value is None:
+                new.pop(attr, None)
+            else:
+                new[attr] = value
+        return old, cls._prepare_changes(old, new, dirty=values)[2]
+
+    @classmethod
+    def update_if(cls, id, expected, changes):
+        '''
+        Atomically sets the column values in ``changes`` on the entity with
+        the provided id, but only if its current column values are those in
+        ``expected`` (``None`` meaning that the column has no value). Returns
+        ``True`` if the entity was updated, ``False`` otherwise::
+
+            # claim a job, unless another worker claimed it first
+            if Job.update_if(job_id, {'state': u'queued'}, {'state': u'running'}):
+                run(job_id)
+
+        Only the changed columns are re-indexed. Update hooks are not called,
+        and entities already loaded into the session are not changed.
+        '''
+        changes = cls._check_update(changes)
+        expected = cls._check_update(expected, True)
+        conn = _connect(cls)
+        pk = '%s:%s'%(cls._namespace, id)
+        deferred = sorted(attr for attr in set(changes) | set(expected)
+            if attr in cls._deferred)
+        pipe = conn.pipeline(False)
+        pipe.hgetall(pk)
+        for attr in deferred:
+            pipe.get('%s:%s'%(pk, attr))
+        results = pipe.execute()
+        if not results[0]:
+            return False
+        old, args = cls._update_row(results[0], dict(zip(deferred, results[1:])), changes)
+        columns = cls._columns
+        for attr, value in expected.items():
+            # compare values as they would be loaded from Redis
+            col = columns[attr]
+            if value is not None:
+                value = col._from_redis(col._to_redis(value))
+            current = old.get(attr)
+            if (current if current is None else col._from_redis(current)) != value:
+                return False
+
+        # the writer script checks that the values are still those we compared
+        args = args._replace(old_data=args.old_data +
+            [cls._race_pair(attr, old.get(attr)) for attr in sorted(expected)])
+        try:
+            _run_writer(conn, args)
+        except DataRaceError:
+            return False
+        return True
+
+    @classmethod
+    def incr(cls, id, attr, amount=1):
+        '''
+        Atomically adds ``amount`` to the ``Integer`` or ``Float`` column
+        ``attr`` of the entity with the provided id in Redis (a missing value
+        counts as 0), updating its index. Returns the new value, or ``None`` if
+        the entity doesn't exist::
+
+            views = Page.incr(page_id, 'views')
+
+        Columns that are unique, deferred, or have prefix, suffix, or
+        custom-keygen indexes can't be incremented. If the model has a
+        ``Version`` column, the version is incremented too.
+        '''
+        value = cls._incr(id, attr, amount)[0]
+        if value is None:
+            return None
+        return cls._columns[attr]._from_redis(value)
+
+    @classmethod
+    def _incr(cls, id, attr, amount):
+        # Increments the column, returning the new value and version as
+        # stored in Redis (both None if the entity doesn't exist).
+        col = cls._columns.get(attr)
+        if not isinstance(col, (Integer, Float)):
+            raise ColumnError("Can only increment Integer and Float columns, not %r"%(attr,))
+        if col._unique or col._deferred or col._prefix or col._suffix or (
+                col._index and col._keygen.__name__ != '_numeric_keygen') or any(
+                attr in uniq for uniq in cls._cunique):
+            raise ColumnError("Cannot atomically increment column %r"%(attr,))
+        if not isinstance(amount, col._allowed) or isinstance(amount, bool):
+            raise InvalidColumnValue("Cannot increment %r by %r"%(attr, amount))
+        result = _redis_incr_lua(_connect(cls), [], [
+            cls._namespace, id, cls._pkey, attr, col._to_redis(amount),
+            'float' if isinstance(col, Float) else 'int', '1' if col._index else '',
+            '1' if cls._async_indexes else '', cls._version or ''])
+        if result is None:
+            return None, None
+        value, version = [v.decode() if isinstance(v, six.binary_type) else v
+            for v in result]
+        return str(value), str(version) if version else None
+
     @classmethod
     def get_by(cls, **kwargs):
         '''
@@ -638,21 +1769,261 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         '''
         return Query(cls)
 
-_redis_writer_lua = _script_load('''
+class _Scratch(object):
+    # Stands in for an entity when converting column values without one.
+    __slots__ = ['_data']
+    def __init__(self):
+        self._data = {}
+
+def _decoded(row):
+    # Decodes the keys and values of a row of data fetched from Redis.
+    if six.PY2:
+        return row
+    return dict((k.decode() if isinstance(k, bytes) else k,
+                 v.decode() if isinstance(v, bytes) else v) for k, v in row.items())
+
+def _load_columns(entities, attrs):
+    # Fetches the provided unloaded columns for all of the provided entities
+    # (all of the same model) in a single round trip.
+    model = entities[0].__class__
+    deferred = [attr for attr in attrs if attr in model._deferred]
+    attrs = [attr for attr in attrs if attr not in model._deferred]
+    pipe = _connect(model).pipeline(False)
+    for ent in entities:
+        if attrs:
+            pipe.hmget(ent._pk, attrs)
+        for attr in deferred:
+            pipe.get('%s:%s'%(ent._pk, attr))
+    results = iter(pipe.execute())
+    for ent in entities:
+        values = list(next(results)) if attrs else []
+        values.extend(next(results) for attr in deferred)
+        for attr, value in zip(attrs + deferred, values):
+            if attr not in ent._unloaded:
+                continue
+            ent._unloaded.discard(attr)
+            if six.PY3 and value is not None:
+                value = value.decode()
+            ent._columns[attr]._init_(ent, model._namespace, attr, value, True)
+            if value is not None:
+                ent._last[attr] = value
+
+# The writer function is shared by the single and bulk writer scripts below.
+_WRITER_LUA = '''
+-- [1] string.format("%s", d) will truncate d to the first null value, so we
+--     can't rely on string.format() where we can reasonably expect nulls.
+
+-- updates the index entries of one entity, using the known index data from
+-- its last write
+local function reindex(namespace, id, nkeys, scored, prefix, suffix, geo,
+                       is_delete, rebuild, indexed)
+-- known index data from the last write, update util.clean_index_lua when
+-- changed
+local idata = redis.call('HGET', namespace .. '::', id)
+if idata then
+    idata = cjson.decode(idata)
+else
+    idata = {}
+end
+while #idata < 5 do
+    idata[#idata + 1] = {}
+end
+if is_delete then
+    nkeys, scored, prefix, suffix, geo = {}, {}, {}, {}, {}
+end
+
+-- only index entries that were removed or added since the last write are
+-- touched, except for full writes, which re-add all entries
+local function members(items)
+    local set = {}
+    for i, item in ipairs(items) do
+        if type(item) == 'table' then
+            if item[1] and item[2] then
+                set[item[1] .. '\0' .. item[2]] = true
+            end
+        else
+            set[item] = true
+        end
+    end
+    return set
+end
+local function known(items)
+    if rebuild then
+        return {}
+    end
+    return members(items)
+end
+local _changes = 0
+
+-- when only some columns were processed, index data for the other columns
+-- is kept as-is
+local kscored = {}
+local kept = {{}, {}}
+if indexed then
+    local changed = members(indexed)
+    local function keep(col)
+        return not changed[string.match(col, '^[^:]*')]
+    end
+    for i, key in ipairs(idata[1]) do
+        if keep(key) then
+            nkeys[#nkeys + 1] = key
+        end
+    end
+    for i, key in ipairs(idata[2]) do
+        if keep(key) then
+            kscored[#kscored + 1] = key
+        end
+    end
+    for pos = 3, 4 do
+        for i, data in ipairs(idata[pos]) do
+            if type(data) == 'table' and data[1] and data[2] and keep(data[1]) then
+                table.insert(kept[pos - 2], {data[1], data[2]})
+            end
+        end
+    end
+end
+
+-- update key index data
+local new = members(nkeys)
+for i, key in ipairs(idata[1]) do
+    if not new[key] then
+        redis.call('SREM', string.format('%s:%s:idx', namespace, key), id)
+        -- see note [1]
+        redis.call('SREM', namespace .. ':' .. key .. ':idx', id)
+        _changes = _changes + 1
+    end
+end
+local old = known(idata[1])
+for i, key in ipairs(nkeys) do
+    if not old[key] then
+        redis.call('SADD', namespace .. ':' .. key .. ':idx', id)
+        _changes = _changes + 1
+    end
+end
+
+-- update scored index data, scores may have changed
+local nscored = kscored
+for key, score in pairs(scored) do
+    nscored[#nscored + 1] = key
+end
+new = members(nscored)
+for i, key in ipairs(idata[2]) do
+    if not new[key] then
+        redis.call('ZREM', string.format('%s:%s:idx', namespace, key), id)
+        -- see note [1]
+        redis.call('ZREM', namespace .. ':' .. key .. ':idx', id)
+        _changes = _changes + 1
+    end
+end
+for key, score in pairs(scored) do
+    redis.call('ZADD', namespace .. ':' .. key .. ':idx', score, id)
+    _changes = _changes + 1
+end
+
+-- update prefix and suffix data
+local nprefix = kept[1]
+local nsuffix = kept[2]
+for i, index in ipairs({{'pre', prefix, nprefix, 3}, {'suf', suffix, nsuffix, 4}}) do
+    local suf, items, nitems, pos = unpack(index)
+    for i, data in ipairs(items) do
+        nitems[#nitems + 1] = {data[1], data[2]}
+    end
+    new = members(nitems)
+    for i, data in ipairs(idata[pos]) do
+        if type(data) == 'table' and data[1] and data[2] and not new[data[1] .. '\0' .. data[2]] then
+            local key = string.format('%s:%s:%s', namespace, data[1], suf)
+            local mem = string.format('%s\0%s', data[2], id)
+            redis.call('ZREM', key, mem)
+            -- see note [1]
+            local key = namespace .. ':' .. data[1] .. ':' .. suf
+            local mem = data[2] .. '\0' .. id
+            redis.call('ZREM', key, mem)
+            _changes = _changes + 1
+        end
+    end
+    old = known(idata[pos])
+    for i, data in ipairs(items) do
+        if not old[data[1] .. '\0' .. data[2]] then
+            local key = namespace .. ':' .. data[1] .. ':' .. suf
+            local mem = data[2] .. '\0' .. id
+            redis.call('ZADD', key, data[3], mem)
+            _changes = _changes + 1
+        end
+    end
+end
+
+-- update geo data, positions may have changed
+local ngeo = {}
+for i, data in ipairs(geo) do
+    ngeo[#ngeo + 1] = data[1]
+end
+new = members(ngeo)
+for i, data in ipairs(idata[5]) do
+    if not new[data] then
+        redis.call('ZREM', namespace .. ':' .. data .. ':geo', id)
+        _changes = _changes + 1
+    end
+end
+for i, data in ipairs(geo) do
+    local key = namespace .. ':' .. data[1] .. ':geo'
+    redis.call('GEOADD', key, data[2], data[3], id)
+    _changes = _changes + 1
+end
+
+if is_delete then
+    redis.call('HDEL', namespace .. '::', id)
+    return cjson.encode({changes=_changes})
+end
+
+-- update known index data
+local encoded = cjson.encode({nkeys, nscored, nprefix, nsuffix, ngeo})
+redis.call('HSET', namespace .. '::', id, encoded)
+return cjson.encode({changes=_changes})
+end
+
+-- mode is nil to check and write, 'check' to only run the checks, 'apply'
+-- to write without checking, or 'release' to only record the unique values
+-- to be removed. claimed tracks unique values claimed and released by other
+-- entities being written by the same call.
+local function write(ARGV, mode, claimed)
 local namespace = ARGV[1]
 local id = ARGV[2]
 local row_key = string.format('%s:%s', namespace, id)
-local is_delete = cjson.decode(ARGV[12])
+-- everything else is sent as a single JSON payload, see _writer_args()
+local unique, udelete, deleted, data, nkeys, scored, prefix, suffix, geo,
+      is_delete, old_data, ddata, ddeleted, rebuild, indexed, stream = unpack(cjson.decode(ARGV[3]))
 
--- [1] string.format("%s", d) will truncate d to the first null value, so we
---     can't rely on string.format() where we can reasonably expect nulls.
+if mode == 'release' then
+    for col, value in pairs(udelete) do
+        local key = string.format('%s:%s:uidx', namespace, col)
+        if redis.call('HGET', key, value) == id then
+            claimed[key .. '\0' .. value] = false
+        end
+    end
+    return
+end
 
-if not is_delete then
+if not is_delete and mode ~= 'apply' then
     -- check to make sure we don't have a data race condition
     local updated = {}
-    for i, pair in ipairs(cjson.decode(ARGV[13])) do
-        local odata = redis.call('HGET', row_key, pair[1])
-        if odata ~= pair[2] then
+    for i, pair in ipairs(old_data) do
+        local odata
+        if pair[3] then
+            -- deferred columns are stored in their own keys, and compared by
+            -- digest, see Model._race_pair()
+            odata = redis.call('GET', row_key .. ':' .. pair[1])
+            if odata then
+                odata = redis.sha1hex(odata)
+            end
+        else
+            odata = redis.call('HGET', row_key, pair[1])
+        end
+        local expected = pair[2]
+        if expected == cjson.null then
+            -- the column is expected to be missing
+            expected = false
+        end
+        if odata ~= expected then
             table.insert(updated, pair[1])
         end
     end
@@ -663,21 +2034,35 @@ end
 
 -- check and update unique column constraints
 for i, write in ipairs({false, true}) do
-    for col, value in pairs(cjson.decode(ARGV[3])) do
-        local key = string.format('%s:%s:uidx', namespace, col)
-        if write then
-            redis.call('HSET', key, value, id)
-        else
-            local known = redis.call('HGET', key, value)
-            if known ~= id and known ~= false then
-                return cjson.encode({unique=col})
+    if mode ~= (write and 'check' or 'apply') then
+        for col, value in pairs(unique) do
+            local key = string.format('%s:%s:uidx', namespace, col)
+            if write then
+                redis.call('HSET', key, value, id)
+            else
+                local known
+                if claimed then
+                    known = claimed[key .. '\0' .. value]
+                end
+                if known == nil then
+                    known = redis.call('HGET', key, value)
+                end
+                if known ~= id and known ~= false then
+                    return cjson.encode({unique=col})
+                end
+                if claimed then
+                    claimed[key .. '\0' .. value] = id
+                end
             end
         end
     end
 end
+if mode == 'check' then
+    return
+end
 
 -- remove deleted unique constraints
-for col, value in pairs(cjson.decode(ARGV[4])) do
+for col, value in pairs(udelete) do
     local key = string.format('%s:%s:uidx', namespace, col)
     local known = redis.call('HGET', key, value)
     if known == id then
@@ -686,119 +2071,161 @@ for col, value in pairs(cjson.decode(ARGV[4])) do
 end
 
 -- remove deleted columns
-local deleted = cjson.decode(ARGV[5])
 if #deleted > 0 then
     redis.call('HDEL', string.format('%s:%s', namespace, id), unpack(deleted))
 end
 
 -- update changed/added columns
-local data = cjson.decode(ARGV[6])
 if #data > 0 then
     redis.call('HMSET', row_key, unpack(data))
 end
 
--- remove old index data, update util.clean_index_lua when changed
-local idata = redis.call('HGET', namespace .. '::', id)
-local _changes = 0
-if idata then
-    idata = cjson.decode(idata)
-    while #idata < 5 do
-        idata[#idata + 1] = {}
-    end
-    for i, key in ipairs(idata[1]) do
-        redis.call('SREM', string.format('%s:%s:idx', namespace, key), id)
-        -- see note [1]
-        redis.call('SREM', namespace .. ':' .. key .. ':idx', id)
-        _changes = _changes + 1
-    end
-    for i, key in ipairs(idata[2]) do
-        redis.call('ZREM', string.format('%s:%s:idx', namespace, key), id)
-        -- see note [1]
-        redis.call('ZREM', namespace .. ':' .. key .. ':idx', id)
-        _changes = _changes + 1
-    end
-    for i, data in ipairs(idata[3]) do
-        local key = string.format('%s:%s:pre', namespace, data[1])
-        local mem = string.format('%s\0%s', data[2], id)
-        redis.call('ZREM', key, mem)
-        -- see note [1]
-        local key = namespace .. ':' .. data[1] .. ':pre'
-        local mem = data[2] .. '\0' .. id
-        redis.call('ZREM', key, mem)
-        _changes = _changes + 1
-    end
-    for i, data in ipairs(idata[4]) do
-        if data[1] and data[2] then
-            local key = string.format('%s:%s:suf', namespace, data[1])
-            local mem = string.format('%s\0%s', data[2], id)
-            redis.call('ZREM', key, mem)
-            -- see note [1]
-            local key = namespace .. ':' .. data[1] .. ':suf'
-            local mem = data[2] .. '\0' .. id
-            redis.call('ZREM', key, mem)
-            _changes = _changes + 1
-        end
-    end
-    for i, data in ipairs(idata[5]) do
-        local key = namespace .. ':' .. data .. ':geo'
-        redis.call('ZREM', key, id)
-        _changes = _changes + 1
+-- update and remove deferred columns
+for i=1, #ddata, 2 do
+    redis.call('SET', row_key .. ':' .. ddata[i], ddata[i+1])
+end
+if #ddeleted > 0 then
+    for i, col in ipairs(ddeleted) do
+        ddeleted[i] = row_key .. ':' .. col
     end
+    redis.call('DEL', unpack(ddeleted))
 end
 
 if is_delete then
-    redis.call('DEL', string.format('%s:%s', namespace, id))
-    redis.call('HDEL', namespace .. '::', id)
-    return cjson.encode({changes=_changes})
+    redis.call('DEL', row_key)
 end
 
--- add new key index data
-local nkeys = cjson.decode(ARGV[7])
-for i, key in ipairs(nkeys) do
-    redis.call('SADD', namespace .. ':' .. key .. ':idx', id)
+if stream then
+    -- the index entries are updated later by IndexWorker, in write order
+    redis.call('XADD', namespace .. '::stream', '*', 'id', id, 'index', stream)
+    return cjson.encode({changes=0})
 end
+return reindex(namespace, id, nkeys, scored, prefix, suffix, geo, is_delete,
+               rebuild, indexed)
+end
+'''
 
--- add new scored index data
-local nscored = {}
-for key, score in pairs(cjson.decode(ARGV[8])) do
-    redis.call('ZADD', namespace .. ':' .. key .. ':idx', score, id)
-    nscored[#nscored + 1] = key
+_redis_writer_lua = _script_load(_WRITER_LUA + '''
+return write(ARGV)
+''')
+
+_redis_atomic_writer_lua = _script_load(_WRITER_LUA + '''
+-- ARGV[1] is the number of arguments for each entity, followed by the
+-- arguments for all of the entities. Nothing is written unless all of the
+-- entities pass their checks.
+local count = tonumber(ARGV[1])
+local entities = {}
+for i = 2, #ARGV, count do
+    entities[#entities + 1] = {unpack(ARGV, i, i + count - 1)}
 end
+local claimed = {}
+for i, args in ipairs(entities) do
+    write(args, 'release', claimed)
+end
+local results = {}
+local failed = false
+for i, args in ipairs(entities) do
+    results[i] = write(args, 'check', claimed) or ''
+    failed = failed or results[i] ~= ''
+end
+if not failed then
+    for i, args in ipairs(entities) do
+        results[i] = write(args, 'apply')
+    end
+end
+return results
+''')
 
--- add new prefix data
-local nprefix = {}
-for i, data in ipairs(cjson.decode(ARGV[9])) do
-    local key = namespace .. ':' .. data[1] .. ':pre'
-    local mem = data[2] .. '\0' .. id
-    redis.call('ZADD', key, data[3], mem)
-    nprefix[#nprefix + 1] = {data[1], data[2]}
+_redis_bulk_writer_lua = _script_load(_WRITER_LUA + '''
+-- ARGV[1] is the number of arguments for each entity, followed by the
+-- arguments for all of the entities
+local count = tonumber(ARGV[1])
+local results = {}
+for i = 2, #ARGV, count do
+    results[#results + 1] = write({unpack(ARGV, i, i + count - 1)})
 end
+return results
+''')
 
--- add new suffix data
-local nsuffix = {}
-for i, data in ipairs(cjson.decode(ARGV[10])) do
-    local key = namespace .. ':' .. data[1] .. ':suf'
-    local mem = data[2] .. '\0' .. id
-    redis.call('ZADD', key, data[3], mem)
-    nsuffix[#nsuffix + 1] = {data[1], data[2]}
+_redis_index_lua = _script_load(_WRITER_LUA + '''
+-- applies (and removes) up to ARGV[2] of the oldest index changes queued in
+-- the stream of namespace ARGV[1], in the order they were written
+local namespace = ARGV[1]
+local stream = namespace .. '::stream'
+local records = redis.call('XRANGE', stream, '-', '+', 'COUNT', ARGV[2])
+for i, record in ipairs(records) do
+    -- fields are: id, <id>, index, <index changes>
+    local fields = record[2]
+    reindex(namespace, fields[2], unpack(cjson.decode(fields[4])))
+    redis.call('XDEL', stream, record[1])
 end
+return #records
+''')
 
--- add new geo data
-local ngeo = {}
-for i, data in ipairs(cjson.decode(ARGV[11])) do
-    local key = namespace .. ':' .. data[1] .. ':geo'
-    redis.call('GEOADD', key, data[2], data[3], id)
-    nsuffix[#nsuffix + 1] = data[1]
+_redis_incr_lua = _script_load('''
+local namespace = ARGV[1]
+local id = ARGV[2]
+local row_key = namespace .. ':' .. id
+local col = ARGV[4]
+if redis.call('HEXISTS', row_key, ARGV[3]) == 0 then
+    return nil
+end
+
+local value
+if ARGV[6] == 'float' then
+    value = redis.call('HINCRBYFLOAT', row_key, col, ARGV[5])
+else
+    value = redis.call('HINCRBY', row_key, col, ARGV[5])
+end
+-- saves of entities loaded before the increment must fail their check
+local version = ''
+if ARGV[9] ~= '' then
+    version = redis.call('HINCRBY', row_key, ARGV[9], 1)
 end
 
-if not is_delete then
-    -- update known index data
-    local encoded = cjson.encode({nkeys, nscored, nprefix, nsuffix, ngeo})
-    redis.call('HSET', namespace .. '::', id, encoded)
+if ARGV[7] == '1' and ARGV[8] == '1' then
+    -- the index entry is updated later by IndexWorker, see write()
+    redis.call('XADD', namespace .. '::stream', '*', 'id', id, 'index',
+        cjson.encode({{}, {[col]=tostring(value)}, {}, {}, {}, false, false, {col}}))
+elseif ARGV[7] == '1' then
+    -- update the scored index, and the known index data if necessary
+    redis.call('ZADD', namespace .. ':' .. col .. ':idx', value, id)
+    local idata = redis.call('HGET', namespace .. '::', id)
+    if idata then
+        idata = cjson.decode(idata)
+    else
+        idata = {}
+    end
+    while #idata < 5 do
+        idata[#idata + 1] = {}
+    end
+    local known = false
+    for i, key in ipairs(idata[2]) do
+        if key == col then
+            known = true
+        end
+    end
+    if not known then
+        table.insert(idata[2], col)
+        redis.call('HSET', namespace .. '::', id, cjson.encode(idata))
+    end
 end
-return cjson.encode({changes=#nkeys + #nscored + #nprefix + #nsuffix + #ngeo + _changes})
+return {value, version}
 ''')
 
+_redis_digest_lua = _script_load('''
+local value = redis.call('GET', KEYS[1])
+if value then
+    return redis.sha1hex(value)
+end
+return nil
+''')
+
+class _Digest(str):
+    # The SHA1 digest of a deferred column's value in Redis, kept in place of
+    # the value in Model._last when the value wasn't fetched.
+    __slots__ = ()
+
 def _fix_bytes(d):
     if six.PY2:
         raise TypeError
@@ -806,28 +2233,78 @@ def _fix_bytes(d):
         return d.decode('latin-1')
     raise TypeError
 
+# The arguments for one entity's call to the writer script, as returned by
+# Model._prepare_changes().
+_WriterArgs = namedtuple('_WriterArgs', 'pkey namespace id unique udelete '
+    'delete data keys scored prefix suffix geo old_data is_delete deferred '
+    'ddelete rebuild indexed stream')
+
 def redis_writer_lua(conn, pkey, namespace, id, unique, udelete, delete,
-                     data, keys, scored, prefix, suffix, geo, old_data, is_delete):
+                     data, keys, scored, prefix, suffix, geo, old_data, is_delete,
+                     deferred=None, ddelete=(), rebuild=False, indexed=False,
+                     stream=False):
     '''
     ... Actually write data to Redis. This is an internal detail. Please don't
     call me directly.
     '''
+    return _run_writer(conn, _WriterArgs(pkey, namespace, id, unique, udelete,
+        delete, data, keys, scored, prefix, suffix, geo, old_data, is_delete,
+        deferred, ddelete, rebuild, indexed, stream))
+
+def _run_writer(conn, wargs):
+    # Calls the writer script with the provided _WriterArgs, returning a
+    # function to check the result later if ``conn`` is a pipeline.
+    result = _redis_writer_lua(conn, [], _writer_args(wargs))
+
+    if isinstance(result, client.BasePipeline):
+        # we're in a pipelined write situation, don't parse the pipeline :P,
+        # but let the caller check the result later
+        return lambda result: _check_writer_result(result, wargs)
+
+    _check_writer_result(result, wargs)
+
+def _writer_args(wargs):
+    # Encodes the _WriterArgs for one entity's call to the writer script.
     ldata = []
-    for pair in data.items():
+    for pair in wargs.data.items():
         ldata.extend(pair)
+    ddata = []
+    for pair in (wargs.deferred or {}).items():
+        ddata.extend(pair)
 
-    for item in prefix:
+    for item in wargs.prefix:
         item.append(_prefix_score(item[-1]))
-    for item in suffix:
+    for item in wargs.suffix:
         item.append(_prefix_score(item[-1]))
 
-    data = [json.dumps(x, default=_fix_bytes) for x in
-            (unique, udelete, delete, ldata, keys, scored, prefix, suffix, geo, is_delete, old_data)]
-    result = _redis_writer_lua(conn, [], [namespace, id] + data)
-
-    if isinstance(result, client.BasePipeline):
-        # we're in a pipelined write situation, don't parse the pipeline :P
-        return
+    keys, scored, prefix, suffix, geo = (wargs.keys, wargs.scored,
+        wargs.prefix, wargs.suffix, wargs.geo)
+    stream = wargs.stream
+    if stream:
+        # index changes are added to the model's stream as-is, to be applied
+        # by IndexWorker
+        stream = json.dumps(
+            [keys, scored, prefix, suffix, geo, wargs.is_delete, wargs.rebuild,
+             wargs.indexed],
+            default=_fix_bytes, separators=(',', ':'))
+        keys, scored, prefix, suffix, geo = [], {}, [], [], []
+
+    # one payload keeps both the encoding here and the decoding in Lua to a
+    # single call
+    data = json.dumps(
+        [wargs.unique, wargs.udelete, wargs.delete, ldata, keys, scored, prefix,
+         suffix, geo, wargs.is_delete, wargs.old_data, ddata, list(wargs.ddelete),
+         wargs.rebuild, wargs.indexed, stream],
+        default=_fix_bytes, separators=(',', ':'))
+    return [wargs.namespace, wargs.id, data]
+
+def _check_writer_result(result, wargs):
+    # Raises the proper exception if the writer script called with the
+    # provided _WriterArgs failed.
+    if isinstance(result, Exception):
+        raise result
+
+    pkey, namespace, id, unique = wargs.pkey, wargs.namespace, wargs.id, wargs.unique
 
     if six.PY3:
         result = result.decode()
@@ -16,7 +16,8 @@ import uuid
 
 import six
 
-from .exceptions import QueryError
+from .columns import MODELS, MODELS_REFERENCED
+from .exceptions import QueryError, BulkError
 from .index import Geofilter, Pattern, Prefix, Suffix
 from .util import (_connect, session, dt2ts, t2ts, _script_load,
     STRING_SORT_KEYGENS, STRING_SORT_KEYGENS_STR)
@@ -30,18 +31,51 @@ NOT_NULL = (None, None)
 _STRING_SORT_KEYGENS = [ss.__name__ for ss in STRING_SORT_KEYGENS]
 ALLOWED_DIST = ('m', 'km', 'mi', 'ft')
 
+def _on_delete_hooks(model):
+    # Returns whether deleting entities of the model would call any hooks,
+    # either on the entities themselves, or on entities deleted or updated
+    # by on_delete actions referencing them.
+    from rom import Model
+    def hooked(model, hooks):
+        return any(
+            six.get_unbound_function(getattr(model, hook)) is not
+            six.get_unbound_function(getattr(Model, hook))
+            for hook in hooks)
+
+    deletes = ('_before_delete', '_after_delete')
+    updates = ('_before_update', '_after_update')
+    if hooked(model, deletes):
+        return True
+    seen = set([model._namespace])
+    pending = [model]
+    while pending:
+        for tbl, attr, action in MODELS_REFERENCED.get(pending.pop()._namespace, ()):
+            ref = MODELS[tbl]
+            if action == 'cascade':
+                if hooked(ref, deletes):
+                    return True
+                if tbl not in seen:
+                    seen.add(tbl)
+                    pending.append(ref)
+            elif action in ('set null', 'set default') and hooked(ref, updates):
+                return True
+    return False
+
 class Query(object):
     '''
     This is a query object. It behaves a lot like other query objects. Every
     operation performed on Query objects returns a new Query object. The old
     Query object *does not* have any updated filters.
     '''
-    __slots__ = '_model _filters _order_by _limit'.split()
-    def __init__(self, model, filters=(), order_by=None, limit=None):
+    __slots__ = '_model _filters _order_by _limit _only _related _prefetch'.split()
+    def __init__(self, model, filters=(), order_by=None, limit=None, only=None, related=None, prefetch=None):
         self._model = model
         self._filters = filters
         self._order_by = order_by
         self._limit = limit
+        self._only = only
+        self._related = related
+        self._prefetch = prefetch
 
     def _check(self, column, value=None, which='order_by'):
         column = column.strip('-').partition(':')[0]
@@ -69,14 +103,17 @@ class Query(object):
 
     def replace(self, **kwargs):
         '''
-        Copy the Query object, optionally replacing the filters, order_by, or
-        limit information on the copy.
+        Copy the Query object, optionally replacing the filters, order_by,
+        limit, only, related, or prefetch information on the copy.
         '''
         data = {
             'model': self._model,
             'filters': self._filters,
             'order_by': self._order_by,
             'limit': self._limit,
+            'only': self._only,
+            'related': self._related,
+            'prefetch': self._prefetch,
         }
         data.update(**kwargs)
         return Query(**data)
@@ -286,6 +323,194 @@ class Query(object):
         '''
         return self.replace(limit=(offset, count))
 
+    def only(self, *columns):
+        '''
+        Will limit the columns fetched for the entities returned by the query
+        to those provided (the primary key is always fetched)::
+
+            # only fetches the email and created_at columns
+            User.query.order_by('-created_at').only('email', 'created_at').all()
+
+        Any other column will be fetched from Redis the first time one of them
+        is accessed or modified, or when the entity is saved or deleted. See
+        ``Model.get()`` for details. Calling ``.only()`` without arguments
+        will fetch all columns again.
+        '''
+        for column in columns:
+            self._check(column)
+        return self.replace(only=columns or None)
+
+    def select_related(self, *columns):
+        '''
+        Will fetch the entities referenced by the provided ``ManyToOne`` or
+        ``OneToOne`` columns for each page of results with one
+        ``Model.get()`` call per referenced model, instead of one call per
+        entity::
+
+            # fetches all comment authors with a single call
+            Comment.query.filter(post=5).select_related('author').all()
+
+        Calling ``.select_related()`` without arguments will stop prefetching
+        referenced entities.
+        '''
+        return self.replace(related=self._model._check_related(columns) or None)
+
+    def prefetch_related(self, *columns):
+        '''
+        Will fetch the entities referring to each page of results via the
+        provided ``OneToMany`` columns with one pipelined call for all of the
+        references, and one ``Model.get()`` call per column, instead of
+        calls per entity::
+
+            # fetches the tasks for all projects at once
+            for project in Project.query.order_by('name').prefetch_related('tasks'):
+                print(project.name, [task.name for task in project.tasks])
+
+        Prefetched entities are returned by the ``OneToMany`` column until the
+        entity is refreshed. Calling ``.prefetch_related()`` without arguments
+        will stop prefetching referring entities.
+        '''
+        return self.replace(prefetch=self._model._check_prefetch(columns) or None)
+
+    def values(self, *columns, **kwargs):
+        '''
+        Returns an iterator over dictionaries of the provided column values for
+        the entities matching the query (all columns with data if none are
+        provided). Values are converted to Python types like they are for
+        entities, but no entities are created, so the session isn't used::
+
+            for row in User.query.filter(active=True).values('email', 'created_at'):
+                writer.writerow([row['email'], row['created_at']])
+
+        Results are fetched ``pagesize`` entities at a time (default 100), so
+        memory use is bounded regardless of the number of results. Entities
+        referenced by ``ManyToOne`` and ``OneToOne`` columns are not fetched,
+        their ids are returned instead. Additional keyword arguments:
+
+            * *pagesize* - the number of entities to fetch at a time
+            * *timeout* - how long to keep the cached query result (see
+              ``iter_result()``)
+        '''
+        columns = self._model._check_values(columns)
+        return (dict(zip(columns, values)) for values in self._iter_values(columns, **kwargs))
+
+    def values_list(self, *columns, **kwargs):
+        '''
+        Like ``.values()``, but returns an iterator over tuples of column values
+        in the order the columns were provided. If you pass ``flat=True`` with
+        a single column, individual values will be returned instead of tuples::
+
+            emails = set(User.query.filter(active=True).values_list('email', flat=True))
+        '''
+        flat = kwargs.pop('flat', False)
+        if flat and len(columns) != 1:
+            raise QueryError("values_list(..., flat=True) requires exactly one column")
+        columns = self._model._check_values(columns)
+        values = self._iter_values(columns, **kwargs)
+        if flat:
+            return (value[0] for value in values)
+        return values
+
+    def ids(self):
+        '''
+        Returns the list of primary keys of the entities matching the query,
+        without fetching any entities::
+
+            user_ids = User.query.filter(active=True).order_by('created_at').ids()
+        '''
+        if not self._filters and not self._order_by:
+            return list(self.iter_ids())
+        return [int(id) for id in self._search()]
+
+    def iter_ids(self, timeout=30, pagesize=100):
+        '''
+        Iterate over the primary keys of the entities matching the query,
+        fetching ``pagesize`` ids at a time from the cached query result,
+        without fetching any entities. See ``iter_result()`` for the meaning
+        of ``timeout``::
+
+            for id in User.query.filter(active=True).iter_ids(pagesize=1000):
+                queue.put(id)
+        '''
+        for ids in self._iter_id_pages(timeout, pagesize):
+            for id in ids:
+                yield id
+
+    def delete(self, batch_size=1000, timeout=30):
+        '''
+        Deletes all entities matching the query, returning the number of
+        entities deleted. Entities are deleted ``batch_size`` at a time, each
+        batch with one round trip to fetch the entities and one call to Redis
+        to remove them along with their index and unique entries, without
+        creating any entities::
+
+            # delete all sessions that haven't been used in the last day
+            Session.query.filter(last_used=(None, time.time()-86400)).delete()
+
+        If other models have ``on_delete`` actions referencing this model, each
+        batch is deleted with ``Model.delete_many()``, which also deletes
+        (or updates) the referencing entities. If this model, or any model
+        whose entities would be deleted or updated by ``on_delete`` actions,
+        defines delete (or update) hooks, the matching entities are fetched
+        and deleted one at a time with ``.delete()`` instead.
+        '''
+        model = self._model
+        per_entity = _on_delete_hooks(model)
+        referenced = any(action != 'no action' for tbl, attr, action in
+            MODELS_REFERENCED.get(model._namespace, ()))
+        deleted = 0
+        for ids in self._iter_id_pages(timeout, batch_size):
+            if per_entity:
+                for ent in model.get(ids):
+                    if ent is not None:
+                        ent.delete()
+                        deleted += 1
+            elif referenced:
+                deleted += model.delete_many(ids, batch_size)
+            else:
+                deleted += model._delete_ids(ids)
+        return deleted
+
+    def update(self, values=None, batch_size=1000, timeout=30, **kwargs):
+        '''
+        Sets the provided column values on all entities matching the query,
+        returning the number of entities updated. Values can be passed as
+        keyword arguments, or as a dictionary (for columns named ``values``,
+        ``batch_size``, or ``timeout``). Passing ``None`` removes the value::
+
+            # deactivate all users that haven't logged in for a year
+            User.query.filter(last_login=(None, time.time()-365*86400)) \\
+                .update(active=False)
+
+        Entities are updated ``batch_size`` at a time, each batch with one
+        round trip to fetch the entities and one call to Redis to write the
+        updated columns, along with their index and unique entries, without
+        creating any entities.
+
+        Entities that can't be updated (because of a unique constraint
+        violation, or because they were modified during the update) are
+        reported together as ``(id, exception)`` pairs in a ``BulkError``
+        raised after all other entities have been updated.
+
+        .. note:: Update hooks are not called, and entities already loaded
+          into the session are not changed.
+        '''
+        model = self._model
+        values = dict(values or {}, **kwargs)
+        if not values:
+            raise QueryError("You must provide at least one column to update")
+        values = model._check_update(values)
+        updated = 0
+        errors = []
+        for ids in self._iter_id_pages(timeout, batch_size):
+            count, errs = model._update_ids(ids, values)
+            updated += count
+            errors.extend(errs)
+        if errors:
+            raise BulkError("%i of %i entities could not be updated"%(
+                len(errors), updated + len(errors)), errors)
+        return updated
+
     def count(self):
         '''
         Will return the total count of the objects that match the specified
@@ -313,6 +538,10 @@ class Query(object):
         return self._model._gindex.search(
             _connect(self._model), self._filters, self._order_by, *limit)
 
+    def _get(self, ids):
+        return self._model.get(ids, columns=self._only, related=self._related,
+            prefetch=self._prefetch)
+
     def iter_result(self, timeout=30, pagesize=100, no_hscan=False):
         '''
         Iterate over the results of your query instead of getting them all with
@@ -356,7 +585,7 @@ class Query(object):
             # No need to fill up memory with paginated items hanging around the
             # session. Remove all entities from the session that are not
             # already modified (were already in the session and modified).
-            for ent in self._model.get(ids):
+            for ent in self._get(ids):
                 if not ent._modified:
                     session.forget(ent)
                 yield ent
@@ -377,7 +606,7 @@ class Query(object):
         while ids and i <= max_id and remaining > 0:
             ids = list(range(i, i + 100))
             i += 100
-            for ent in self._model.get(ids):
+            for ent in self._get(ids):
                 # Same session comment as from _iter_results()
                 if not ent._modified:
                     session.forget(ent)
@@ -394,17 +623,23 @@ class Query(object):
         ns = self._model._namespace + ':'
         tkey = ns + str(uuid.uuid4())
         pkey = self._model._pkey
+        fetch, unloaded = '', ()
+        if self._only:
+            # deferred columns are fetched per page when first accessed
+            fetch, _, unloaded = self._model._projection(self._only)
+            fetch = json.dumps(fetch)
 
         remaining = max(limit[1], 0)
         cursor = 0
         ids = ''
         while cursor != '0' and remaining > 0:
-            result = _scan_fetch_index_hash(conn, [ns, tkey], [cursor, json.dumps(ids or '')])
+            result = _scan_fetch_index_hash(conn, [ns, tkey], [cursor, json.dumps(ids or ''), fetch])
             if isinstance(result, six.binary_type):
                 result = result.decode('utf-8')
             cursor, data = json.loads(result)
 
             ids = []
+            page = []
             for mdata in data:
                 # Turn the flattened data into a dict so we can instantiate the
                 # result and/or fetch the object from the session.
@@ -415,10 +650,20 @@ class Query(object):
 
                 # Try to get the shared entity from the session, even though
                 # we just fetched the data from Redis.
-                ent = session.get(ns + id)
-                if not ent:
-                    ent = self._model(_loading=True, **mdata)
+                page.append(session.get(ns + id) or mdata)
+
+            rows = [ent for ent in page if isinstance(ent, dict)]
+            if self._related:
+                self._model._load_related(rows, self._related)
+            loaded = iter(self._model._from_rows(rows, unloaded))
+            page = [next(loaded) if isinstance(ent, dict) else ent for ent in page]
 
+            if self._model._deferred:
+                self._model._set_page([ent for ent in page if ent._unloaded])
+            if self._prefetch and page:
+                self._model._load_prefetched(page, self._prefetch)
+
+            for ent in page:
                 # Same session comment as from _iter_results()
                 if not ent._modified:
                     session.forget(ent)
@@ -443,7 +688,7 @@ class Query(object):
         while i <= max_id and remaining > 0:
             ids = conn.zrangebyscore(index, i, i+99)
             i += 100
-            for ent in self._model.get(ids):
+            for ent in self._get(ids):
                 # Same session comment as from _iter_results()
                 if not ent._modified:
                     session.forget(ent)
@@ -451,6 +696,83 @@ class Query(object):
                     remaining -= 1
                     yield ent
 
+    def _iter_id_pages(self, timeout=30, pagesize=100):
+        # Yields pages of the ids matching this query, respecting any limits,
+        # without fetching any entities.
+        conn = _connect(self._model)
+        limit = self._limit or (0, 2**64)
+        start = max(limit[0], 0)
+        remaining = max(limit[1], 0)
+        model = self._model
+        key = None
+        if self._filters or self._order_by:
+            key = self.cached_result(timeout)
+        elif model._columns[model._pkey]._index:
+            # the primary key index is ordered by id
+            key = '%s:%s:idx'%(model._namespace, model._pkey)
+            timeout = None
+
+        if key:
+            last = None
+            while remaining > 0:
+                count = min(remaining, pagesize)
+                if timeout:
+                    conn.expire(key, timeout)
+                if last is None or timeout:
+                    ids = conn.zrange(key, start, start+count-1)
+                else:
+                    # page through the live primary key index by id, so that
+                    # entities deleted along the way don't cause us to skip
+                    # any others
+                    ids = conn.zrangebyscore(key, '(%s'%(last,), 'inf', 0, count)
+                if not ids:
+                    break
+                start += len(ids)
+                remaining -= len(ids)
+                last = int(ids[-1])
+                yield [int(id) for id in ids]
+            return
+
+        ns = model._namespace + ':'
+        tkey = ns + str(uuid.uuid4())
+        fetch = json.dumps([model._pkey])
+        cursor = 0
+        ids = ''
+        while cursor != '0' and remaining > 0:
+            result = _scan_fetch_index_hash(conn, [ns, tkey], [cursor, json.dumps(ids or ''), fetch])
+            if isinstance(result, six.binary_type):
+                result = result.decode('utf-8')
+            cursor, data = json.loads(result)
+            ids = [int(row[1]) for row in data]
+            page = ids[start:remaining + start]
+            start = max(start - len(ids), 0)
+            remaining -= len(page)
+            if page:
+                yield page
+
+    def _iter_values(self, columns, timeout=30, pagesize=100):
+        model = self._model
+        conn = _connect(model)
+        fetch = [model._pkey] + [attr for attr in columns if attr not in model._deferred]
+        deferred = [attr for attr in columns if attr in model._deferred]
+        for ids in self._iter_id_pages(timeout, pagesize):
+            pipe = conn.pipeline(False)
+            for id in ids:
+                pk = '%s:%s'%(model._namespace, id)
+                pipe.hmget(pk, fetch)
+                for attr in deferred:
+                    pipe.get('%s:%s'%(pk, attr))
+            results = iter(pipe.execute())
+            rows = []
+            for id in ids:
+                row = next(results)
+                dvalues = [next(results) for attr in deferred]
+                # entities deleted since the query was run are skipped
+                if row[0] is not None:
+                    rows.append(dict(zip(fetch + deferred, list(row) + dvalues)))
+            for values in model._to_values(columns, rows):
+                yield values
+
     def __iter__(self):
         return self.iter_result()
 
@@ -491,7 +813,7 @@ class Query(object):
         '''
         if not self._filters and not self._order_by:
             return list(self)
-        return self._model.get(self._search())
+        return self._get(self._search())
 
     def all(self):
         '''
@@ -512,7 +834,7 @@ class Query(object):
             return None
         ids = self.limit(*lim)._search()
         if ids:
-            return self._model.get(ids[0])
+            return self._get(ids[0])
         return None
 
 _scan_fetch_index_hash = _script_load('''
@@ -528,6 +850,12 @@ end
 -- Make sure the temporary set goes away.
 redis.call('EXPIRE', KEYS[2], 30)
 
+-- Only fetch the requested columns, if provided
+local columns = false
+if #ARGV[3] > 0 then
+    columns = cjson.decode(ARGV[3])
+end
+
 local results = {}
 local pair = redis.call('HSCAN', hkey, ARGV[1])
 local cursor = pair[1]
@@ -539,7 +867,22 @@ while #contents > 0 do
     local id = table.remove(contents)
 
     if redis.call('SISMEMBER', tkey, id) == 0 then
-        local result = redis.call('HGETALL', namespace .. id)
+        local result
+        if columns then
+            result = {}
+            local values = redis.call('HMGET', namespace .. id, unpack(columns))
+            -- the primary key is first, and is missing for deleted entities
+            if values[1] then
+                for i, column in ipairs(columns) do
+                    if values[i] then
+                        table.insert(result, column)
+                        table.insert(result, values[i])
+                    end
+                end
+            end
+        else
+            result = redis.call('HGETALL', namespace .. id)
+        end
         if #result > 0 then
             table.insert(results, result)
         end
@@ -132,16 +132,80 @@ per model.::
         .order_by('-avg_rating') \\
         .all()
 
+
+Write-behind saves
+==================
+
+For data that can be written a moment later (counters, last-seen timestamps,
+...), a ``WriteBehind`` object saves entities from a background thread, taking
+the round trips to Redis off of your request path::
+
+    import rom.util
+
+    writer = rom.util.WriteBehind(batch_size=100, interval=.1)
+
+    user.last_seen = time.time()
+    rom.session.commit(write_behind=writer)
+
+    # at shutdown, write everything that is still waiting
+    writer.close()
+
+
+Asynchronous index updates
+==========================
+
+Models with the ``_async_indexes = True`` class attribute queue their index
+changes when entities are written, to be applied a moment later by an
+``IndexWorker``, which can run as a background thread or in its own process::
+
+    import rom.util
+
+    # in a thread
+    worker = rom.util.IndexWorker([Click, PageView])
+    worker.start()
+
+    # or in a dedicated process
+    rom.util.IndexWorker([Click, PageView], batch_size=1000).run()
+
+    # monitoring
+    changes, seconds = rom.util.index_lag(Click)
+
+
+Pipelined saves
+===============
+
+Inside a ``with rom.pipelined_saves():`` block, calls to ``.save()`` and
+``.delete()`` on entities of any model are queued, and sent in one pipeline
+per Redis connection at the end of the block. Any entities that could not be
+written are reported together in a ``BulkError``::
+
+    with rom.pipelined_saves() as batch:
+        for user in users:
+            user.visits += 1
+            user.save()
+        stale.delete()
+
+You can also add the writes to your own pipeline, and check the results after
+executing it::
+
+    pipe = conn.pipeline()
+    pipe.incr('visits')
+    with rom.pipelined_saves(pipe) as batch:
+        user.save()
+    batch.check(pipe.execute(raise_on_error=False))
+
 '''
 
 from __future__ import print_function
 from collections import deque
+from contextlib import contextmanager
 from datetime import datetime, date, time as dtime
 from hashlib import sha1
-from itertools import chain
+from itertools import chain, repeat
 import math
 import os
 import string
+import sys
 import threading
 import time
 import weakref
@@ -150,7 +214,7 @@ import warnings
 import redis
 import six
 
-from .exceptions import DataRaceError, ORMError
+from .exceptions import BulkError, DataRaceError, ORMError
 
 if six.PY3:
     import binascii
@@ -342,6 +406,8 @@ STRING_SORT_KEYGENS_STR = ', '.join(x.__name__ for x in STRING_SORT_KEYGENS)
 def _many_to_one_keygen(val):
     if val is None:
         return []
+    if isinstance(val, six.integer_types):
+        return {'': val}
     if hasattr(val, '_data') and hasattr(val, '_pkey'):
         return {'': val._data[val._pkey]}
     return {'': val.id}
@@ -410,6 +476,45 @@ def _encode_unique_constraint(data):
     ret = b'\0'.join(cleaned)
     return ret if six.PY2 else ret.decode('latin-1')
 
+class _Fetcher(threading.Thread):
+    # Runs fetch(chunk) in the background, for _iter_fetched().
+    def __init__(self, fetch, chunk):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fetch = fetch
+        self.chunk = chunk
+        self.result = self.error = None
+
+    def run(self):
+        try:
+            self.result = self.fetch(self.chunk)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def get(self):
+        self.join()
+        if self.error:
+            six.reraise(*self.error)
+        return self.result
+
+def _iter_fetched(fetch, chunks, overlap=False):
+    # Yields fetch(chunk) for each chunk. With overlap, the next chunk is
+    # fetched in a background thread while the caller handles the current
+    # chunk, so at most two chunks of results are held at a time.
+    if not overlap:
+        for chunk in chunks:
+            yield fetch(chunk)
+        return
+    pending = None
+    for chunk in chunks:
+        fetcher = _Fetcher(fetch, chunk)
+        fetcher.start()
+        if pending:
+            yield pending.get()
+        pending = fetcher
+    if pending:
+        yield pending.get()
+
 NULL_SESSION = False
 
 class Session(threading.local):
@@ -423,7 +528,13 @@ class Session(threading.local):
 
     .. note:: calling ``.flush()`` or ``.commit()`` doesn't cause all objects
         to be written simultanously. They are written one-by-one, with any
-        error causing the call to fail.
+        error causing the call to fail. If you pass ``fast=True``, all writes
+        are instead sent in one pipeline per Redis connection, and any errors
+        are collected and raised together as a ``BulkError``. If you pass
+        ``atomic=True``, all entities are checked and then written by a single
+        call to Redis, and either all of them are written, or none are. If you
+        pass ``write_behind=<WriteBehind>``, entities are queued to be written
+        by that ``WriteBehind``'s background thread.
     '''
     def _init(self):
         try:
@@ -480,7 +591,8 @@ class Session(threading.local):
         self.known = {}
         self.wknown = weakref.WeakValueDictionary()
 
-    def flush(self, full=False, all=False, force=False):
+    def flush(self, full=False, all=False, force=False, fast=False, write_behind=None,
+              atomic=False):
         '''
         Call ``.save()`` on all modified entities in the session. Use when you
         want to flush changes to Redis, but don't want to lose your local
@@ -490,9 +602,11 @@ class Session(threading.local):
         '''
         self._init()
 
-        return self.save(*self.known.values(), full=full, all=all, force=force)
+        return self.save(*self.known.values(), full=full, all=all, force=force,
+            fast=fast, write_behind=write_behind, atomic=atomic)
 
-    def commit(self, full=False, all=False, force=False):
+    def commit(self, full=False, all=False, force=False, fast=False, write_behind=None,
+               atomic=False):
         '''
         Call ``.save()`` on all modified entities in the session. Also forgets
         all known entities in the session, so this should only be called at
@@ -506,8 +620,22 @@ class Session(threading.local):
               entities that have been modified.
             * *full* - pass ``True`` to force-save all entities known, ignoring
               DataRaceError and EntityDeletedError exceptions
+            * *fast* - pass ``True`` to send all writes in one pipeline per
+              Redis connection instead of one round trip per entity. All
+              entities that can be saved will be saved, and a ``BulkError``
+              listing the entities that failed (and why) will be raised
+              afterwards if there were any failures.
+            * *write_behind* - pass a ``WriteBehind`` object to queue the
+              entities to be written from its background thread instead of
+              writing them now, returning the number of entities queued
+            * *atomic* - pass ``True`` to check all entities for unique
+              constraint violations and data races, and then write all of
+              them, with a single call to Redis. If any entity fails its
+              checks, no entities are written, and a ``BulkError`` listing the
+              entities that failed (and why) is raised. All entities must use
+              the same Redis connection.
         '''
-        changes = self.flush(full, all, force)
+        changes = self.flush(full, all, force, fast, write_behind, atomic)
         self.known = {}
         return changes
 
@@ -522,22 +650,28 @@ class Session(threading.local):
 
         And the entities will be flushed to Redis.
 
-        You can pass the keyword arguments ``full``, ``all``, and ``force`` with
-        the same meaning and semantics as the ``.commit()`` method.
+        You can pass the keyword arguments ``full``, ``all``, ``force``,
+        ``fast``, ``write_behind``, and ``atomic`` with the same meaning and
+        semantics as the ``.commit()`` method.
         '''
         from rom import Model
         full = kwargs.get('full')
         all = kwargs.get('all')
         force = kwargs.get('force')
+        write_behind = kwargs.get('write_behind')
+        atomic = kwargs.get('atomic')
         changes = 0
         items = deque()
         items.extend(objects)
+        entities = []
         while items:
             o = items.popleft()
             if isinstance(o, (list, tuple)):
                 items.extendleft(reversed(o))
             elif isinstance(o, Model):
-                if not o._deleted and (all or o._modified):
+                if kwargs.get('fast') or atomic or write_behind is not None:
+                    entities.append(o)
+                elif not o._deleted and (all or o._modified):
                     changes += o.save(full, force)
 
             else:
@@ -545,6 +679,90 @@ class Session(threading.local):
                     "Cannot save an object that is not an instance of a Model (you provided %r)"%(
                         o,))
 
+        if write_behind is not None:
+            return write_behind.save(entities, full=full, all=all, force=force)
+        if atomic:
+            return self._save_atomic(entities, full, all, force)
+        if entities:
+            changes += self._save_fast(entities, full, all, force)
+        return changes
+
+    def _save_fast(self, entities, full, all, force):
+        # Saves the entities with one pipeline per connection, running all of
+        # the pre-commit hooks in order before the writes, and all of the
+        # post-commit hooks in order after the writes.
+        from .model import _redis_writer_lua
+        pipes = {}
+        pending = []
+        errors = []
+        saving = 0
+        for o in entities:
+            if o._deleted or not (all or o._modified):
+                continue
+            saving += 1
+            conn = _connect(o)
+            if id(conn) not in pipes:
+                _load_script(conn, _redis_writer_lua)
+                pipes[id(conn)] = conn.pipeline(False)
+            try:
+                pending.append((o, o._save_prepare(full, force, pipes[id(conn)])))
+            except ORMError as e:
+                errors.append((o, e))
+
+        results = {}
+        for key, pipe in pipes.items():
+            results[key] = iter(_execute_scripts(pipe, _redis_writer_lua))
+
+        changes = 0
+        for o, (was_new, ret, data, check) in pending:
+            try:
+                check(next(results[id(_connect(o))]))
+            except (ORMError, redis.exceptions.RedisError) as e:
+                errors.append((o, e))
+                continue
+            o._save_finish(was_new, data)
+            changes += ret
+
+        if errors:
+            raise BulkError("%i of %i entities could not be saved"%(
+                len(errors), saving), errors)
+        return changes
+
+    def _save_atomic(self, entities, full, all, force):
+        # Saves the entities with one call to the atomic writer script, which
+        # writes nothing unless all of the entities pass their checks.
+        from .model import _redis_atomic_writer_lua, _writer_args, _check_writer_result
+        entities = [o for o in entities if not o._deleted and (all or o._modified)]
+        if not entities:
+            return 0
+        conn = _connect(entities[0])
+        if any(_connect(o) is not conn for o in entities):
+            raise ORMError("Atomic saves require all entities to use the same Redis connection")
+
+        pending = []
+        argv = []
+        for o in entities:
+            was_new, ret, data, args = o._save_args(full, force)
+            pending.append((o, was_new, ret, data, args))
+            argv.extend(_writer_args(args))
+        results = _redis_atomic_writer_lua(conn, [], [len(argv) // len(entities)] + argv)
+
+        errors = []
+        for (o, was_new, ret, data, args), result in zip(pending, results):
+            if result in ('', b''):
+                continue
+            try:
+                _check_writer_result(result, args)
+            except ORMError as e:
+                errors.append((o, e))
+        if errors:
+            raise BulkError("%i of %i entities failed their checks, no entities were saved"%(
+                len(errors), len(entities)), errors)
+
+        changes = 0
+        for o, was_new, ret, data, args in pending:
+            o._save_finish(was_new, data)
+            changes += ret
         return changes
 
     def refresh(self, *objects, **kwargs):
@@ -615,6 +833,510 @@ def use_rom_session():
 
 session = Session()
 
+_PIPELINED = threading.local()
+
+def _pipelined():
+    # Returns the PipelinedSaves collecting writes in this thread, if any.
+    return getattr(_PIPELINED, 'batch', None)
+
+class PipelinedSaves(object):
+    '''
+    Collects the writes queued by ``.save()`` and ``.delete()`` calls inside a
+    ``with pipelined_saves():`` block. After the writes have been executed,
+    ``.errors`` lists the ``(entity, exception)`` pairs for the entities that
+    could not be written.
+    '''
+    def __init__(self, pipe=None, raise_errors=True):
+        self.pipe = pipe
+        self.raise_errors = raise_errors
+        self.errors = []
+        self._pipes = {}
+        self._pending = []
+        # columns written by queued saves, by entity
+        self._written = {}
+
+    def _pipeline(self, obj):
+        # Returns the pipeline to queue the entity's write in, making sure the
+        # writer script is loaded first.
+        from .model import _redis_writer_lua
+        conn = _connect(obj)
+        if self.pipe is not None:
+            # the provided pipeline may not use the model's connection
+            _load_script(redis.Redis(connection_pool=self.pipe.connection_pool),
+                _redis_writer_lua)
+            return self.pipe
+        _load_script(conn, _redis_writer_lua)
+        if id(conn) not in self._pipes:
+            self._pipes[id(conn)] = conn.pipeline(False)
+        return self._pipes[id(conn)]
+
+    def _queue(self, obj, pipe, check, finish, undo=None):
+        # Remembers where the write was queued in the pipeline, how to check
+        # its result, what to do afterwards, and how to restore the entity's
+        # state from before the write if it failed.
+        self._pending.append((obj, pipe, len(pipe.command_stack) - 1, check, finish, undo))
+
+    def _abort(self, start):
+        # Drops the queued writes and restores the state of their entities,
+        # latest write first, when the pipelined_saves() block raised.
+        for obj, pipe, position, check, finish, undo in reversed(self._pending):
+            if undo:
+                undo()
+        self._pending = []
+        self._written = {}
+        if self.pipe is not None:
+            del self.pipe.command_stack[start:]
+
+    def _execute(self):
+        from .model import _redis_writer_lua
+        results = {}
+        for key, pipe in self._pipes.items():
+            try:
+                results[id(pipe)] = _execute_scripts(pipe, _redis_writer_lua)
+            except redis.exceptions.RedisError as e:
+                results[id(pipe)] = repeat(e)
+        self._resolve(results)
+
+    def _resolve(self, results):
+        count = len(self._pending)
+        failed = set()
+        for obj, pipe, position, check, finish, undo in self._pending:
+            result = results[id(pipe)]
+            result = result[position] if isinstance(result, list) else next(result)
+            try:
+                check(result)
+            except (ORMError, redis.exceptions.RedisError) as e:
+                self.errors.append((obj, e))
+                # later writes of the entity were based on this one
+                if undo and id(obj) not in failed:
+                    undo()
+                failed.add(id(obj))
+                continue
+            if id(obj) not in failed:
+                finish()
+        self._pending = []
+        if self.errors and self.raise_errors:
+            raise BulkError("%i of %i entities could not be saved"%(
+                len(self.errors), count), self.errors)
+
+    def check(self, results):
+        '''
+        Checks the results of the writes that were added to the pipeline
+        passed to ``pipelined_saves()``, given the results of executing that
+        pipeline with ``.execute(raise_on_error=False)``. Returns the list of
+        ``(entity, exception)`` pairs for entities that could not be written,
+        or raises them in a ``BulkError`` if ``raise_errors`` is true.
+        '''
+        results = list(results)
+        _check_loaded(self.pipe, results)
+        self._resolve({id(self.pipe): results})
+        return self.errors
+
+@contextmanager
+def pipelined_saves(pipe=None, raise_errors=True):
+    '''
+    Queues the writes of all ``.save()`` and ``.delete()`` calls on entities
+    in this thread until the end of the ``with`` block, then sends them in one
+    pipeline per Redis connection::
+
+        with rom.pipelined_saves() as batch:
+            user.save()
+            post.save()
+
+    Entities that could not be written (because of unique constraint
+    violations, data races, etc.) are raised together in a ``BulkError``
+    after all other writes have been checked, or only listed in the batch's
+    ``.errors`` if ``raise_errors`` is false. Pre-commit hooks are called
+    when the write is queued, and post-commit hooks after the write succeeded.
+    If an exception is raised inside the block, nothing is written, and the
+    entities are left as they were before the block.
+
+    If you pass your own ``pipe``, writes are added to it instead, and you
+    must execute it yourself, then pass the results to ``batch.check()``.
+
+    .. note:: Entities are checked for data races against the data they had
+      when the write was queued. Saving an entity more than once in a block
+      writes each save's changes in order, each checked against the previous.
+      Columns changed after a write was queued (even after the block, before
+      ``batch.check()``) are left to be saved.
+
+    .. note:: ``.delete()`` calls the pre-commit hook and resolves
+      ``on_delete`` actions when it is called (raising ``RestrictError``
+      immediately). The deletes and updates of referencing entities are
+      queued in the same batch, so they are only written with the deleted
+      entity, though the referencing entities are changed in memory at once.
+    '''
+    if _pipelined() is not None:
+        raise ORMError("pipelined_saves() blocks can't be nested")
+    batch = PipelinedSaves(pipe, raise_errors)
+    start = len(pipe.command_stack) if pipe is not None else 0
+    _PIPELINED.batch = batch
+    try:
+        yield batch
+    except BaseException:
+        batch._abort(start)
+        raise
+    finally:
+        _PIPELINED.batch = None
+    if pipe is None:
+        batch._execute()
+
+class WriteBehind(threading.Thread):
+    '''
+    Saves entities from a background thread. Entities passed to ``.save()``
+    (or to ``session.save()``, ``session.flush()``, or ``session.commit()``
+    with ``write_behind=<this object>``) are queued, and are written in
+    pipelined batches when ``batch_size`` entities are waiting, or
+    ``interval`` seconds after the oldest waiting entity was queued. Saving an
+    entity that is still waiting to be written only updates its pending write.
+
+    Arguments:
+
+        * *max_size* - the maximum number of entities waiting to be written,
+          ``.save()`` blocks while the queue is full (default 10000)
+        * *batch_size* - the number of entities to wait for before writing,
+          and the number of writes per pipeline (default 100)
+        * *interval* - the longest time in seconds that an entity waits to be
+          written (default .1)
+        * *on_error* - called as ``on_error(entity, exception)`` from the
+          background thread for every entity that could not be written (or
+          whose post-commit hook raised an exception). If not provided, or if
+          it raises an exception, errors are raised together as a
+          ``BulkError`` from the next call to ``.flush()`` or ``.close()``.
+          Entities that could not be written are left modified, with the
+          columns of the failed write to be saved again
+
+    .. note:: Pre-commit hooks are called when the entity is queued (but not
+      again when it is queued while still waiting to be written), and
+      post-commit hooks are called from the background thread after the entity
+      has been written.
+
+    .. warning:: Don't call ``.save()`` on an entity that is waiting to be
+      written by a ``WriteBehind``, queue it again instead.
+    '''
+    def __init__(self, max_size=10000, batch_size=100, interval=.1, on_error=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.max_size = max(max_size, 1)
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self.on_error = on_error
+        self.errors = []
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._order = []
+        self._since = None
+        self._flush = False
+        self._writing = False
+        self._closed = False
+        self.start()
+
+    def save(self, *objects, **kwargs):
+        '''
+        Queues the provided entities (or lists of entities) to be written,
+        returning the number of entities queued. Accepts the ``full``, ``all``,
+        and ``force`` keyword arguments with the same meaning as
+        ``session.commit()``.
+        '''
+        from rom import Model
+        queued = 0
+        items = deque()
+        items.extend(objects)
+        while items:
+            o = items.popleft()
+            if isinstance(o, (list, tuple)):
+                items.extendleft(reversed(o))
+            elif not isinstance(o, Model):
+                raise ORMError(
+                    "Cannot save an object that is not an instance of a Model (you provided %r)"%(
+                        o,))
+            elif not o._deleted and (kwargs.get('all') or o._modified):
+                self._queue(o, kwargs.get('full'), kwargs.get('force'))
+                queued += 1
+        return queued
+
+    def _queue(self, o, full, force):
+        if o._unloaded:
+            o._load_unloaded()
+        pk = o._pk
+        hooked = False
+        while True:
+            with self._cond:
+                while not self._closed and pk not in self._pending and len(self._pending) >= self.max_size:
+                    self._cond.wait()
+                if self._closed:
+                    raise ORMError("Cannot save entities with a closed WriteBehind")
+                if hooked or pk in self._pending:
+                    break
+                new = o._new
+            # pre-commit hooks are called once per write, like post-commit
+            # hooks, and without holding the lock, as they may save entities
+            if new:
+                o._before_insert()
+            else:
+                o._before_update()
+            hooked = True
+        with self._cond:
+            # changes since the last queued write are merged into it
+            if pk in self._pending:
+                _, _, dirty, pfull, pforce = self._pending[pk]
+                dirty.update(o._dirty)
+                full = full or pfull
+                force = force or pforce
+            else:
+                dirty = set(o._dirty)
+                self._order.append(pk)
+                if self._since is None:
+                    self._since = time.time()
+            self._pending[pk] = (o, dict(o._data), dirty, full, force)
+            o._dirty = set()
+            o._modified = False
+            self._cond.notify_all()
+
+    def _failed(self, o, dirty):
+        # Leaves the columns of a failed write to be saved again.
+        with self._cond:
+            o._dirty.update(dirty)
+            o._modified = True
+
+    def _ready(self):
+        # Whether the background thread should write or exit.
+        if not self._pending:
+            return self._closed
+        return (self._closed or self._flush or len(self._pending) >= self.batch_size
+            or time.time() >= self._since + self.interval)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    timeout = None
+                    if self._pending:
+                        timeout = max(self._since + self.interval - time.time(), 0)
+                    self._cond.wait(timeout)
+                if not self._pending:
+                    return
+                batch = [self._pending.pop(pk) for pk in self._order]
+                self._order = []
+                self._since = None
+                self._flush = False
+                self._writing = True
+                self._cond.notify_all()
+            try:
+                for i in range(0, len(batch), self.batch_size):
+                    chunk = batch[i:i+self.batch_size]
+                    try:
+                        self._write(chunk)
+                    except Exception as e:
+                        # keep writing later batches
+                        for item in chunk:
+                            self._failed(item[0], item[2])
+                        self._report([(item[0], e) for item in chunk])
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def _write(self, batch):
+        # Writes the queued entities with one pipeline per connection, like
+        # Session._save_fast(), leaving any changes made since the entities
+        # were queued for their next write.
+        from .model import _redis_writer_lua
+        pipes = {}
+        pending = []
+        errors = []
+        for o, data, dirty, full, force in batch:
+            conn = _connect(o)
+            if id(conn) not in pipes:
+                try:
+                    _load_script(conn, _redis_writer_lua)
+                except redis.exceptions.RedisError as e:
+                    self._failed(o, dirty)
+                    errors.append((o, e))
+                    continue
+                pipes[id(conn)] = conn.pipeline(False)
+            # the entity's state is shared with the threads saving it
+            with self._cond:
+                new = o._new
+                last = o._last
+            try:
+                ret, rdata, check = o._apply_changes(
+                    last, data, full or new or force, is_new=new or force,
+                    pipe=pipes[id(conn)], dirty=dirty)
+            except Exception as e:
+                self._failed(o, dirty)
+                errors.append((o, e))
+                continue
+            pending.append((o, new, dirty, rdata, check))
+
+        results = {}
+        for key, pipe in pipes.items():
+            try:
+                results[key] = iter(_execute_scripts(pipe, _redis_writer_lua))
+            except redis.exceptions.RedisError as e:
+                results[key] = repeat(e)
+
+        for o, new, dirty, rdata, check in pending:
+            try:
+                check(next(results[id(_connect(o))]))
+            except Exception as e:
+                self._failed(o, dirty)
+                errors.append((o, e))
+                continue
+            with self._cond:
+                o._last = rdata
+                if o._version in rdata:
+                    o._data[o._version] = int(rdata[o._version])
+                o._new = False
+            try:
+                if new:
+                    o._after_insert()
+                else:
+                    o._after_update()
+            except Exception as e:
+                # the entity was written, but is reported like a failed write
+                errors.append((o, e))
+        self._report(errors)
+
+    def _report(self, errors):
+        for o, e in errors:
+            if self.on_error:
+                try:
+                    self.on_error(o, e)
+                    continue
+                except Exception:
+                    # keep the background thread alive, report it with flush()
+                    pass
+            with self._cond:
+                self.errors.append((o, e))
+
+    def flush(self):
+        '''
+        Writes all waiting entities, returning after they have been written.
+        Raises a ``BulkError`` listing the entities that could not be written
+        since the last call to ``.flush()`` if no ``on_error`` callback was
+        provided.
+        '''
+        with self._cond:
+            self._flush = True
+            self._cond.notify_all()
+            while self._pending or self._writing:
+                self._cond.wait()
+            errors, self.errors = self.errors, []
+        if errors:
+            raise BulkError("%i entities could not be saved"%(len(errors),), errors)
+
+    def close(self):
+        '''
+        Writes all waiting entities and stops the background thread. Raises a
+        ``BulkError`` like ``.flush()``.
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.join()
+        self.flush()
+
+class IndexWorker(threading.Thread):
+    '''
+    Applies the index changes queued by writes to models with
+    ``_async_indexes = True``, in the order they were written. Call
+    ``.start()`` to run it as a background thread, or ``.run()`` to run it in
+    the calling thread (in its own process, for example). Any number of
+    workers can run for the same models, each call to Redis atomically applies
+    the oldest waiting changes of one model.
+
+    Arguments:
+
+        * *models* - the models whose index changes should be applied
+        * *batch_size* - the number of changes of a model to apply with each
+          call to Redis (default 1000)
+        * *interval* - how long in seconds to wait before looking for more
+          changes after all waiting changes were applied (default .1)
+        * *on_error* - called as ``on_error(model, exception)`` if changes of a
+          model could not be applied. If not provided, the exception is
+          raised, which stops a running worker
+    '''
+    def __init__(self, models, batch_size=1000, interval=.1, on_error=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.models = list(models)
+        for model in self.models:
+            if not model._async_indexes:
+                raise ORMError("Model %s does not have _async_indexes enabled"%(
+                    model._namespace,))
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self.on_error = on_error
+        self._closed = threading.Event()
+
+    def apply(self):
+        '''
+        Applies up to ``batch_size`` waiting index changes for each model,
+        returning the number of changes applied.
+        '''
+        from .model import _redis_index_lua
+        applied = 0
+        for model in self.models:
+            try:
+                applied += _redis_index_lua(_connect(model), [], [
+                    model._namespace, self.batch_size])
+            except redis.exceptions.RedisError as e:
+                if not self.on_error:
+                    raise
+                self.on_error(model, e)
+        return applied
+
+    def flush(self):
+        '''
+        Applies index changes until none are waiting, returning the number of
+        changes applied.
+        '''
+        applied = 0
+        while True:
+            count = self.apply()
+            if not count:
+                return applied
+            applied += count
+
+    def run(self):
+        while not self._closed.is_set():
+            if not self.apply():
+                self._closed.wait(self.interval)
+
+    def close(self, timeout=None):
+        '''
+        Stops the worker, waiting up to ``timeout`` seconds for a running
+        background thread to exit.
+        '''
+        self._closed.set()
+        if self.ident is not None and threading.current_thread() is not self:
+            self.join(timeout)
+
+def index_lag(model):
+    '''
+    Returns ``(changes, seconds)`` for a model with ``_async_indexes = True``:
+    the number of index changes waiting to be applied by an ``IndexWorker``,
+    and how long in seconds the oldest of them has been waiting (according to
+    the Redis server's clock)::
+
+        changes, seconds = index_lag(Click)
+    '''
+    stream = model._namespace + '::stream'
+    pipe = _connect(model).pipeline(False)
+    pipe.execute_command('XLEN', stream)
+    pipe.execute_command('XRANGE', stream, '-', '+', 'COUNT', 1)
+    pipe.time()
+    changes, oldest, now = pipe.execute()
+    if not oldest:
+        return 0, 0
+    written = oldest[0][0]
+    if isinstance(written, bytes):
+        written = written.decode()
+    # stream entry ids start with the millisecond timestamp of the write
+    written = int(written.partition('-')[0]) / 1000.
+    return changes, max(now[0] + now[1] / 1000000. - written, 0)
+
 def refresh_indices(model, block_size=100):
     '''
     This utility function will iterate over all entities of a provided model,
@@ -800,8 +1522,47 @@ def _script_load(script):
         return conn.execute_command(
             "EVAL", script, len(keys), *(keys+args))
 
+    # so the script can be loaded before being called in a pipeline
+    call.script = script
     return call
 
+# scripts loaded with _load_script(), by connection pool
+_LOADED_SCRIPTS = weakref.WeakKeyDictionary()
+
+def _load_script(conn, call):
+    # Loads the script of a function returned by _script_load() so that it
+    # can be called in a pipeline, once per connection pool.
+    loaded = _LOADED_SCRIPTS.setdefault(conn.connection_pool, set())
+    if call.script not in loaded:
+        conn.execute_command('SCRIPT', 'LOAD', call.script)
+        loaded.add(call.script)
+
+def _no_script(result):
+    return isinstance(result, redis.exceptions.ResponseError) and any(
+        str(result).startswith(nsm) for nsm in NO_SCRIPT_MESSAGES)
+
+def _check_loaded(pipe, results):
+    # Forgets the scripts loaded for the pipeline's connection pool if any of
+    # its results is a NOSCRIPT error (after SCRIPT FLUSH, or a restart), so
+    # they are loaded again by the next pipelined write.
+    if any(_no_script(result) for result in results):
+        _LOADED_SCRIPTS.pop(pipe.connection_pool, None)
+
+def _execute_scripts(pipe, call):
+    # Executes a pipeline of calls to the provided function returned by
+    # _script_load(), returning errors as results. Calls that failed because
+    # the script wasn't loaded are run again after loading it.
+    stack = list(pipe.command_stack)
+    results = pipe.execute(raise_on_error=False)
+    retry = [i for i, result in enumerate(results) if _no_script(result)]
+    if retry:
+        _check_loaded(pipe, results)
+        _load_script(redis.Redis(connection_pool=pipe.connection_pool), call)
+        pipe.command_stack.extend(stack[i] for i in retry)
+        for i, result in zip(retry, pipe.execute(raise_on_error=False)):
+            results[i] = result
+    return results
+
 _scan_index_lua = _script_load('''
 local page = redis.call('HSCAN', KEYS[1], ARGV[1], 'COUNT', ARGV[2] or 100)
 local clear = {}
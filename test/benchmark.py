@@ -0,0 +1,126 @@
+'''
+Rom - the Redis object mapper for Python
+
+Copyright 2013-2016 Josiah Carlson
+
+Released under the LGPL license version 2.1 and version 3 (you can choose
+which you'd like to be bound under).
+
+Benchmarks for rom internals, run with:
+
+    PYTHONPATH=`pwd` python test/benchmark.py [rows]
+
+Uses (and cleans up) keys prefixed with ``RomBench`` in Redis db 15.
+'''
+
+from __future__ import print_function
+from datetime import datetime
+import sys
+import time
+
+import redis
+import six
+
+from rom import model, util
+
+util.CONNECTION = redis.Redis(db=15)
+connect = util._connect
+
+from rom import *
+
+
+class RomBenchEntity(Model):
+    name = Text(index=True, keygen=SIMPLE)
+    email = Text()
+    score = Float(index=True)
+    count = Integer()
+    active = Boolean()
+    created = DateTime()
+    data = Json(default=dict)
+
+
+def cleanup():
+    c = connect(None)
+    keys = c.keys('RomBench*')
+    if keys:
+        c.delete(*keys)
+
+def timed(label, rows, callback, repeat=3):
+    best = None
+    for i in range(repeat):
+        session.rollback()
+        t = time.time()
+        callback()
+        t = time.time() - t
+        best = t if best is None else min(best, t)
+    session.rollback()
+    print("%-40s %10.0f rows/sec"%(label, rows / max(best, 1e-9)))
+
+def bench_load(rows):
+    for i in range(rows):
+        RomBenchEntity(name=u'name %i'%i, email=u'user%i@example.com'%i,
+            score=i / 3.0, count=i, active=bool(i & 1),
+            created=datetime(2016, 1, 1), data={'i': i, 'tags': ['a', 'b']})
+    session.commit(all=True)
+    session.rollback()
+
+    conn = connect(None)
+    ids = list(range(1, rows + 1))
+    pipe = conn.pipeline(False)
+    for id in ids:
+        pipe.hgetall('RomBenchEntity:%s'%id)
+    raw = pipe.execute()
+
+    def init_load():
+        # the loading path used before Model._from_rows()
+        for data in raw:
+            if six.PY3:
+                data = dict((k.decode(), v.decode()) for k, v in data.items())
+            RomBenchEntity(_loading=True, **data)
+
+    def fast_load():
+        RomBenchEntity._from_rows(raw)
+
+    def get_pages():
+        for i in range(0, rows, 100):
+            RomBenchEntity.get(ids[i:i+100])
+
+    print("Hydrating %i entities from raw HGETALL replies:"%(rows,))
+    timed("Model.__init__()", rows, init_load)
+    timed("Model._from_rows()", rows, fast_load)
+    print("Fetching %i entities from Redis in pages of 100:"%(rows,))
+    timed("Model.get()", rows, get_pages)
+
+def bench_save(rows):
+    ents = RomBenchEntity.get(list(range(1, rows + 1)))
+    conn = connect(None)
+    prepared = []
+    for ent in ents:
+        ent.count += 1
+        prepared.append(RomBenchEntity._prepare_changes(
+            ent._last, dict(ent._data), False)[2])
+
+    def encode():
+        for args in prepared:
+            model._writer_args(args)
+
+    def write():
+        for args in prepared:
+            model._redis_writer_lua(conn, [], model._writer_args(args))
+
+    print("Writing %i single-column updates:"%(rows,))
+    timed("_writer_args()", rows, encode)
+    # repeated writes would only hit the data race check
+    timed("_writer_args() + writer script", rows, write, repeat=1)
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    cleanup()
+    try:
+        bench_load(rows)
+        bench_save(rows)
+    finally:
+        cleanup()
+
+if __name__ == '__main__':
+    main()
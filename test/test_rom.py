@@ -12,7 +12,10 @@ from __future__ import print_function
 import base64
 from datetime import datetime, timedelta
 from decimal import Decimal as _Decimal
+from hashlib import sha1
+import os
 import sys
+import threading
 import time
 import unittest
 import warnings
@@ -1318,6 +1321,24 @@ class TestORM(unittest.TestCase):
         RomTestKeygen2(a='hello world', b='how are you').save()
         self.assertEqual(RomTestKeygen2.query.filter(a='hello').filter(a='are').count(), 1)
 
+    def test_keygen2_dirty(self):
+        # keygen2 columns are re-indexed when the columns they read change
+        class RomTestKeygen2Dirty(Model):
+            a = Text()
+            b = Text()
+            ab = Text(index=True, keygen2=lambda n, e: {'%s-%s'%(e['a'], e['b']): None})
+
+        x = RomTestKeygen2Dirty(a=u'x', b=u'y', ab=u'')
+        x.save()
+        x.b = u'q'
+        x.save()
+        query = RomTestKeygen2Dirty.query
+        self.assertEqual(query.filter(ab=u'x-q').count(), 1)
+        self.assertEqual(query.filter(ab=u'x-y').count(), 0)
+        RomTestKeygen2Dirty.query.filter(ab=u'x-q').update(a=u'z')
+        self.assertEqual(query.filter(ab=u'z-q').count(), 1)
+        self.assertEqual(query.filter(ab=u'x-q').count(), 0)
+
     def test_multiindex(self):
         def kg(val):
             keys = dict.fromkeys(val.split())
@@ -1400,6 +1421,9 @@ class TestORM(unittest.TestCase):
         self.assertEqual(a.query.filter(tags='restaurant').near('basic', 1, 0, 60, 'km').count(), 0)
         self.assertEqual(a.query.filter(tags='restaurant').near('basic', 0, 1, 60, 'km').count(), 0)
 
+        a.delete()
+        self.assertFalse(conn.exists('RomTestGeo:basic:geo'))
+
     def _test_filter_performance(self):
         import time
         class RomTestFilterPerformance(Model):
@@ -1456,6 +1480,1394 @@ class TestORM(unittest.TestCase):
         b = RomTestEmptyKeygen.get(aid)
         self.assertTrue(b.col)
 
+    def test_projection(self):
+        class RomTestProjection(Model):
+            a = Integer(index=True)
+            b = Text(unique=True)
+            c = Json(default=dict)
+
+        x = RomTestProjection(a=1, b=u'one', c={'large': 'data'})
+        x.save()
+        xid = x.id
+        RomTestProjection(a=2, b=u'two').save()
+        session.rollback()
+
+        p = RomTestProjection.get(xid, columns=['a'])
+        self.assertEqual(p._unloaded, set(['b', 'c']))
+        self.assertEqual(p.to_dict(), {'id': xid, 'a': 1})
+        # accessing a column that wasn't fetched loads the rest
+        self.assertEqual(p.c, {'large': 'data'})
+        self.assertFalse(p._unloaded)
+        self.assertEqual(p.b, u'one')
+        session.rollback()
+
+        # saving a partial entity shouldn't lose any data or indexes
+        p = RomTestProjection.get(xid, columns='a')
+        p.a = 3
+        p.save()
+        session.rollback()
+        self.assertEqual(RomTestProjection.get_by(b=u'one').to_dict(),
+            {'id': xid, 'a': 3, 'b': u'one', 'c': {'large': 'data'}})
+        self.assertEqual(len(RomTestProjection.get_by(a=3)), 1)
+        session.rollback()
+
+        # updating an unfetched unique column cleans out the old value
+        p = RomTestProjection.get(xid, columns=['a'])
+        p.b = u'three'
+        p.save()
+        session.rollback()
+        self.assertEqual(RomTestProjection.get_by(b=u'one'), None)
+        self.assertEqual(RomTestProjection.get_by(b=u'three').id, xid)
+        session.rollback()
+
+        self.assertEqual(RomTestProjection.get([xid, 100], columns=['b'])[0].b, u'three')
+        self.assertRaises(QueryError, lambda: RomTestProjection.get(xid, columns=['d']))
+        self.assertRaises(QueryError, lambda: RomTestProjection.query.only('d'))
+        session.rollback()
+
+        q = RomTestProjection.query.filter(a=(0, 10)).order_by('a').only('b')
+        self.assertEqual([e.b for e in q.all()], [u'two', u'three'])
+        self.assertEqual(q.first()._unloaded, set(['a', 'c']))
+        session.rollback()
+        for ents in (list(RomTestProjection.query.only('a')),
+                     list(RomTestProjection.query.only('a').iter_result(no_hscan=True))):
+            self.assertEqual(len(ents), 2)
+            self.assertTrue(all(e._unloaded == set(['b', 'c']) for e in ents))
+            session.rollback()
+
+    def test_deferred_columns(self):
+        self.assertRaises(ColumnError, lambda: Text(deferred=True, unique=True))
+        self.assertRaises(ColumnError, lambda: Text(deferred=True, index=True, keygen=FULL_TEXT))
+
+        class RomTestDeferred(Model):
+            name = Text(index=True, keygen=FULL_TEXT)
+            body = Json(deferred=True)
+            notes = Text(deferred=True)
+
+        conn = connect(None)
+        a = RomTestDeferred(name=u'a', body={'x': 1}, notes=u'hello')
+        b = RomTestDeferred(name=u'b', body={'x': 2})
+        session.commit()
+        aid, bid = a.id, b.id
+        self.assertEqual(sorted(conn.hkeys(a._pk)), [b'id', b'name'])
+        self.assertTrue(conn.exists(a._pk + ':body'))
+        self.assertFalse(conn.exists(b._pk + ':notes'))
+        session.rollback()
+
+        a, b = RomTestDeferred.get([aid, bid])
+        self.assertEqual(a._unloaded, set(['body', 'notes']))
+        self.assertEqual(a.to_dict(), {'id': aid, 'name': u'a'})
+        # accessing a deferred column fetches it for the whole page
+        self.assertEqual(a.body, {'x': 1})
+        self.assertEqual(b._unloaded, set(['notes']))
+        self.assertEqual(b.body, {'x': 2})
+        self.assertEqual(b.notes, None)
+
+        # updates and deletions only touch the deferred keys
+        a.notes = None
+        b.notes = u'world'
+        b.name = u'c'
+        session.commit()
+        session.rollback()
+        self.assertFalse(conn.exists(a._pk + ':notes'))
+        self.assertEqual(RomTestDeferred.get(bid).notes, u'world')
+        self.assertEqual(RomTestDeferred.query.filter(name=u'c').first().body, {'x': 2})
+        session.rollback()
+
+        # data races are detected on deferred columns too
+        b1 = RomTestDeferred.get(bid)
+        b1.body
+        session.rollback()
+        b2 = RomTestDeferred.get(bid)
+        b2.body = {'x': 3}
+        b2.save()
+        b1.body = {'x': 4}
+        self.assertRaises(DataRaceError, b1.save)
+        session.rollback()
+        # previous deferred values are checked by digest, not sent in full
+        b2.notes = u'\u2603' * 1000
+        b2.save()
+        b2.notes = u'world'
+        args = RomTestDeferred._prepare_changes(b2._last, dict(b2._data), dirty=b2._dirty)[2]
+        self.assertEqual(args[12][-1], ('notes', sha1((u'\u2603' * 1000).encode('utf-8')).hexdigest(), 1))
+        b2.save()
+        self.assertEqual(RomTestDeferred.get(bid).notes, u'world')
+        session.rollback()
+
+        # replacing an unloaded deferred column only fetches its digest
+        b3 = RomTestDeferred.get(bid)
+        self.assertTrue('notes' in b3._unloaded)
+        b3.notes = u'replaced'
+        self.assertFalse('notes' in b3._unloaded)
+        self.assertEqual(b3._last['notes'], sha1(b'world').hexdigest())
+        b3.save()
+        session.rollback()
+        self.assertEqual(RomTestDeferred.get(bid).notes, u'replaced')
+        session.rollback()
+        b4 = RomTestDeferred.get(bid)
+        b4.notes = u'mine'
+        conn.set('%s:notes'%(b4._pk,), u'theirs')
+        self.assertRaises(DataRaceError, b4.save)
+        session.rollback()
+
+        # explicitly requested deferred columns are fetched immediately
+        b = RomTestDeferred.get(bid, columns=['body'])
+        self.assertEqual(b._unloaded, set(['name', 'notes']))
+        self.assertEqual(b.body, {'x': 3})
+        session.rollback()
+
+        c = RomTestDeferred.get(bid).copy()
+        self.assertEqual(c.to_dict()['notes'], u'world')
+        c.save()
+        session.rollback()
+        ents = list(RomTestDeferred.query)
+        self.assertEqual(len(ents), 3)
+        self.assertTrue(all('body' in e._unloaded for e in ents))
+        ents[0].body
+        self.assertFalse(any('body' in e._unloaded for e in ents))
+        for ent in ents:
+            ent.delete()
+        self.assertEqual(conn.keys(RomTestDeferred._namespace + ':*:body'), [])
+        self.assertEqual(conn.keys(RomTestDeferred._namespace + ':*:notes'), [])
+
+    def test_select_related(self):
+        class RomTestRelatedUser(Model):
+            name = Text()
+
+        class RomTestRelatedComment(Model):
+            author = ManyToOne('RomTestRelatedUser', 'no action')
+            editor = ManyToOne('RomTestRelatedUser', 'no action')
+            rank = Integer(index=True)
+
+        users = [RomTestRelatedUser(name=u'u%i'%i) for i in range(3)]
+        for i in range(10):
+            RomTestRelatedComment(author=users[i%3], editor=users[0], rank=i)
+        session.commit()
+        session.rollback()
+
+        calls = []
+        get = RomTestRelatedUser.get
+        RomTestRelatedUser.get = classmethod(
+            lambda cls, ids, **kwargs: calls.append(ids) or get(ids, **kwargs))
+        try:
+            comments = RomTestRelatedComment.get(list(range(1, 11)), related=['author', 'editor'])
+            self.assertEqual(len(calls), 1)
+            self.assertEqual([c.author.name for c in comments], [u'u%i'%(i%3) for i in range(10)])
+            self.assertTrue(all(c.editor is comments[0].author for c in comments))
+            session.rollback()
+
+            del calls[:]
+            q = RomTestRelatedComment.query.select_related('author', 'editor')
+            for fetch in (lambda: q.order_by('rank').all(), lambda: list(q),
+                          lambda: list(q.iter_result(no_hscan=True))):
+                self.assertEqual(len(fetch()), 10)
+                self.assertEqual(len(calls), 1)
+                del calls[:]
+                session.rollback()
+        finally:
+            del RomTestRelatedUser.get
+
+        self.assertRaises(QueryError, lambda: RomTestRelatedComment.query.select_related('rank'))
+        self.assertRaises(QueryError, lambda: RomTestRelatedComment.get(1, related=['missing']))
+
+    def test_lazy_references(self):
+        class RomTestLazyUser(Model):
+            name = Text()
+
+        class RomTestLazyComment(Model):
+            author = ManyToOne('RomTestLazyUser', 'no action')
+            rank = Integer(index=True)
+
+        u1 = RomTestLazyUser(name=u'u1')
+        u2 = RomTestLazyUser(name=u'u2')
+        c = RomTestLazyComment(author=u1, rank=1)
+        session.commit()
+        session.rollback()
+
+        calls = []
+        get = RomTestLazyUser.get
+        RomTestLazyUser.get = classmethod(
+            lambda cls, ids, **kwargs: calls.append(ids) or get(ids, **kwargs))
+        try:
+            c = RomTestLazyComment.get(c.id)
+            self.assertEqual(c.author_id, u1.id)
+            c.rank = 2
+            c.save()
+            self.assertEqual(calls, [])
+            self.assertEqual(c.author.name, u'u1')
+            self.assertEqual(c.author_id, u1.id)
+            self.assertEqual(len(calls), 1)
+        finally:
+            del RomTestLazyUser.get
+        session.rollback()
+
+        # references can be assigned by id
+        c = RomTestLazyComment.get(c.id)
+        c.author = u2.id
+        self.assertEqual(c.author_id, u2.id)
+        c.save()
+        session.rollback()
+        self.assertEqual([x.id for x in RomTestLazyComment.get_by(author=u2.id)], [c.id])
+        self.assertEqual(RomTestLazyComment.get_by(author=u1.id), [])
+        self.assertEqual(RomTestLazyComment.get(c.id).to_dict()['author'].name, u'u2')
+        self.assertEqual(RomTestLazyComment.get(c.id, columns=['rank']).author_id, u2.id)
+
+    def test_prefetch_related(self):
+        class RomTestPrefetchProject(Model):
+            name = Text()
+            tasks = OneToMany('RomTestPrefetchTask')
+
+        class RomTestPrefetchTask(Model):
+            project = ManyToOne('RomTestPrefetchProject', 'no action')
+            rank = Integer(index=True)
+
+        projects = [RomTestPrefetchProject(name=u'p%i'%i) for i in range(5)]
+        for i in range(12):
+            RomTestPrefetchTask(project=projects[i%4], rank=i)
+        session.commit()
+        expected = [[t.id for t in p.tasks] for p in projects]
+        self.assertEqual(expected[4], [])
+        session.rollback()
+
+        calls = []
+        get = RomTestPrefetchTask.get
+        RomTestPrefetchTask.get = classmethod(
+            lambda cls, ids, **kwargs: calls.append(ids) or get(ids, **kwargs))
+        try:
+            q = RomTestPrefetchProject.query.prefetch_related('tasks')
+            for fetch in (lambda: RomTestPrefetchProject.get([p.id for p in projects], prefetch='tasks'),
+                          lambda: list(q), lambda: list(q.iter_result(no_hscan=True))):
+                ents = sorted(fetch(), key=lambda p: p.id)
+                self.assertEqual([[t.id for t in p.tasks] for p in ents], expected)
+                self.assertEqual(len(calls), 1)
+                # the back references point at the prefetched entities
+                self.assertTrue(ents[0].tasks[0].project is ents[0])
+                del calls[:]
+                session.rollback()
+        finally:
+            del RomTestPrefetchTask.get
+
+        self.assertRaises(QueryError, lambda: RomTestPrefetchProject.query.prefetch_related('name'))
+
+    def test_fast_loader(self):
+        class RomTestLoader(Model):
+            i = Integer(index=True)
+            f = Float(default=1.5)
+            b = Boolean()
+            s = String()
+            t = Text(required=True)
+            j = Json(default=dict)
+            d = DateTime()
+            e = Decimal()
+            other = ManyToOne('RomTestLoader', 'no action')
+            deferred = Text(deferred=True)
+
+        class RomTestLoaderInit(Model):
+            a = Integer()
+            def __init__(self, **kwargs):
+                Model.__init__(self, **kwargs)
+                self.extra = True
+
+        x = RomTestLoader(i=1, b=True, s=b'\xff', t=u'\u00fc', j={'a': [1]},
+            d=datetime(2000, 1, 1), e=_Decimal('1.25'), deferred=u'x')
+        x.save()
+        y = RomTestLoader(i=2, t=u'y', other=x)
+        y.save()
+        z = RomTestLoaderInit(a=1)
+        z.save()
+        session.rollback()
+
+        conn = connect(None)
+        for ent in (x, y):
+            data = conn.hgetall(ent._pk)
+            if six.PY3:
+                data = dict((k.decode(), v.decode()) for k, v in data.items())
+            slow = RomTestLoader(_loading=True, **data)
+            session.rollback()
+            fast = RomTestLoader.get(ent.id)
+            self.assertEqual(fast._data, slow._data)
+            self.assertEqual(fast._last, slow._last)
+            self.assertEqual(fast._unloaded, slow._unloaded)
+            self.assertFalse(fast._new or fast._modified)
+            self.assertTrue(session.get(fast._pk) is fast)
+            session.rollback()
+
+        self.assertTrue(RomTestLoaderInit.get(z.id).extra)
+
+    def test_values(self):
+        class RomTestValues(Model):
+            name = Text(index=True, keygen=SIMPLE)
+            score = Float(default=0.0)
+            data = Json(default=dict)
+            ref = ManyToOne('RomTestValues', 'no action')
+            notes = Text(deferred=True)
+
+        for i in range(5):
+            RomTestValues(name=u'n%i'%i, score=i * 1.5, data={'i': i})
+        session.commit()
+        x = RomTestValues(name=u'x', ref=RomTestValues.get(1), notes=u'note')
+        x.save()
+        session.rollback()
+
+        q = RomTestValues.query.order_by('name')
+        self.assertEqual(list(q.values_list('name', 'score', pagesize=2)),
+            [(u'n%i'%i, i * 1.5) for i in range(5)] + [(u'x', 0.0)])
+        self.assertEqual(list(q.limit(1, 2).values_list('name', flat=True)), [u'n1', u'n2'])
+        self.assertEqual(list(q.values('data', 'ref', 'notes'))[-2:], [
+            {'data': {'i': 4}, 'ref': None, 'notes': None},
+            {'data': {}, 'ref': 1, 'notes': u'note'}])
+        self.assertEqual(list(q.limit(5, 1).values())[0],
+            {'id': x.id, 'name': u'x', 'score': 0.0, 'data': {}, 'ref': 1, 'notes': u'note'})
+        # no entities are created or added to the session
+        self.assertEqual(len(session.known) + len(session.wknown), 0)
+        self.assertEqual(sorted(RomTestValues.query.values_list('id', flat=True)),
+            list(range(1, 7)))
+        self.assertEqual(len(list(RomTestValues.query.limit(2, 10).values_list('id'))), 4)
+
+        self.assertRaises(QueryError, lambda: q.values('missing'))
+        self.assertRaises(QueryError, lambda: q.values_list('name', 'score', flat=True))
+
+    def test_ids(self):
+        class RomTestIds(Model):
+            rank = Integer(index=True)
+
+        class RomTestIdsIndexed(Model):
+            id = PrimaryKey(index=True)
+
+        for i in range(25):
+            RomTestIds(rank=-i)
+            RomTestIdsIndexed()
+        session.commit()
+        session.rollback()
+
+        q = RomTestIds.query.order_by('rank')
+        expected = list(range(25, 0, -1))
+        self.assertEqual(q.ids(), expected)
+        self.assertEqual(list(q.iter_ids(pagesize=7)), expected)
+        self.assertEqual(q.limit(5, 10).ids(), expected[5:15])
+        self.assertEqual(list(q.limit(5, 10).iter_ids(pagesize=3)), expected[5:15])
+        self.assertEqual(sorted(RomTestIds.query.ids()), sorted(expected))
+        self.assertEqual(list(RomTestIdsIndexed.query.iter_ids(pagesize=4)), list(range(1, 26)))
+        self.assertEqual(RomTestIdsIndexed.query.limit(20, 10).ids(), list(range(21, 26)))
+        self.assertEqual(len(session.known) + len(session.wknown), 0)
+
+    def test_chunked_get(self):
+        class RomTestChunked(Model):
+            _fetch_chunk_size = 3
+            _fetch_transaction = False
+            rank = Integer(index=True)
+            notes = Text(deferred=True)
+
+        for i in range(10):
+            RomTestChunked(rank=i, notes=u'n%i'%i)
+        session.commit()
+        session.rollback()
+
+        ids = [12, 1, 5, 3, 11, 7, 2, 10, 4, 6, 9, 8]
+        expected = [id for id in ids if id <= 10]
+        for overlap in (False, True):
+            RomTestChunked._fetch_overlap = overlap
+            ents = RomTestChunked.get(ids)
+            self.assertEqual([e.id for e in ents], expected)
+            self.assertEqual([e.rank for e in ents], [id - 1 for id in expected])
+            # deferred columns are fetched per chunk (the first chunk is
+            # 12, 1, 5, with 12 missing)
+            self.assertEqual(ents[0].notes, u'n0')
+            self.assertEqual([e.id for e in ents if 'notes' not in e._unloaded], [1, 5])
+            self.assertEqual(len(RomTestChunked.query.order_by('rank').all()), 10)
+            session.rollback()
+
+    def test_fast_commit(self):
+        calls = []
+        class RomTestFast(Model):
+            name = Text(unique=True)
+            rank = Integer(index=True)
+            def _before_insert(self):
+                calls.append(('before', self.rank))
+            def _after_insert(self):
+                calls.append(('after', self.rank))
+
+        ents = [RomTestFast(name=u'n%i'%i, rank=i) for i in range(5)]
+        self.assertEqual(session.commit(fast=True), sum(
+            1 for e in ents for c in ('id', 'name', 'rank')))
+        self.assertEqual(calls, [('before', i) for i in range(5)] + [('after', i) for i in range(5)])
+        self.assertEqual(RomTestFast.query.order_by('rank').ids(), [e.id for e in ents])
+        self.assertFalse(any(e._modified or e._new for e in ents))
+        session.rollback()
+
+        a, b, c = RomTestFast.get([1, 2, 3])
+        a.name = u'n3'
+        b.rank = 10
+        c.rank = 11
+        # another writer updates c
+        session.rollback()
+        c2 = RomTestFast.get(3)
+        c2.rank = 12
+        c2.save()
+        session.rollback()
+        try:
+            session.save(a, b, c, fast=True)
+        except BulkError as e:
+            self.assertEqual([ent for ent, err in e.errors], [a, c])
+            self.assertTrue(isinstance(e.errors[0][1], UniqueKeyViolation))
+            self.assertTrue(isinstance(e.errors[1][1], DataRaceError))
+        else:
+            self.fail("BulkError not raised")
+        self.assertTrue(a._modified and c._modified)
+        self.assertFalse(b._modified)
+        session.rollback()
+        self.assertEqual(RomTestFast.get(2).rank, 10)
+        self.assertEqual(RomTestFast.get(3).rank, 12)
+        self.assertEqual(RomTestFast.get(1).name, u'n0')
+        session.rollback()
+
+        # the writer script is loaded once per connection pool, and again
+        # when writes fail because it was flushed
+        conn = connect(None)
+        self.assertTrue(util._LOADED_SCRIPTS.get(conn.connection_pool))
+        conn.script_flush()
+        d = RomTestFast(name=u'n5', rank=5)
+        self.assertEqual(session.commit(fast=True), 3)
+        session.rollback()
+        self.assertEqual(RomTestFast.get(d.id).rank, 5)
+        session.rollback()
+
+    def test_bulk_create(self):
+        calls = []
+        class RomTestBulk(Model):
+            name = Text(unique=True)
+            rank = Integer(index=True)
+            def _before_insert(self):
+                calls.append(('before', self.rank))
+            def _after_insert(self):
+                calls.append(('after', self.rank))
+
+        RomTestBulk(name=u'taken', rank=-1).save()
+        session.rollback()
+        del calls[:]
+        rows = [{'name': u'n%i'%i, 'rank': i} for i in range(7)]
+        rows[4]['name'] = u'taken'
+        try:
+            RomTestBulk.bulk_create(iter(rows), batch_size=3)
+        except BulkError as e:
+            self.assertEqual(len(e.errors), 1)
+            ent, err = e.errors[0]
+            self.assertEqual(ent.rank, 4)
+            self.assertTrue(isinstance(err, UniqueKeyViolation))
+        else:
+            self.fail("BulkError not raised")
+        self.assertEqual(len(calls), 13)
+        self.assertFalse(session.known)
+
+        self.assertEqual(RomTestBulk.query.filter(rank=(0, None)).order_by('rank').ids(),
+            [2, 3, 4, 5, 7, 8])
+        self.assertEqual(RomTestBulk.get_by(name=u'n6').rank, 6)
+        self.assertEqual(RomTestBulk.get_by(name=u'taken').rank, -1)
+        self.assertEqual(RomTestBulk.query.count(), 7)
+
+        ents = RomTestBulk.bulk_create([{'name': u'x'}, {'name': u'y'}])
+        self.assertEqual([e.id for e in ents], [9, 10])
+        self.assertFalse(any(e._modified or e._new for e in ents))
+        self.assertEqual(RomTestBulk(name=u'z').id, 11)
+
+    def test_id_blocks(self):
+        class RomTestIdBlock(Model):
+            _id_block_size = 10
+            name = Text()
+
+        c = connect(None)
+        ents = [RomTestIdBlock(name=u'%i'%i) for i in range(5)]
+        self.assertEqual([e.id for e in ents], [1, 2, 3, 4, 5])
+        self.assertEqual(int(c.get('RomTestIdBlock:id:')), 10)
+        self.assertTrue(all(e._modified for e in ents))
+        session.commit()
+        session.rollback()
+        self.assertEqual(RomTestIdBlock.get(3).name, u'2')
+
+        ids = []
+        def create():
+            for i in range(20):
+                ids.append(RomTestIdBlock().id)
+        threads = [threading.Thread(target=create) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        session.rollback()
+        self.assertEqual(sorted(ids), list(range(6, 66)))
+        self.assertEqual(int(c.get('RomTestIdBlock:id:')), 70)
+
+        # bulk_create() reserves its own ids past the current block
+        ent, = RomTestIdBlock.bulk_create([{'name': u'bulk'}])
+        self.assertEqual(ent.id, 71)
+        self.assertEqual(RomTestIdBlock().id, 66)
+        session.rollback()
+
+        # forked processes reserve their own blocks
+        if hasattr(os, 'fork'):
+            r, w = os.pipe()
+            pid = os.fork()
+            if not pid:
+                try:
+                    os.write(w, str(RomTestIdBlock().id).encode())
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            os.close(w)
+            child = int(os.read(r, 20))
+            os.close(r)
+            self.assertEqual(child, 72)
+            self.assertEqual(RomTestIdBlock().id, 67)
+            session.rollback()
+
+        # as do other connections
+        RomTestIdBlock._conn = redis.Redis(db=14)
+        try:
+            self.assertEqual(RomTestIdBlock().id, 1)
+        finally:
+            session.rollback()
+            RomTestIdBlock._conn.delete('RomTestIdBlock:id:')
+            del RomTestIdBlock._conn
+        self.assertEqual(RomTestIdBlock().id, 82)
+        session.rollback()
+
+    def test_id_blocks_shared_pk(self):
+        class RomTestIdBlockA(Model):
+            _id_block_size = 10
+        class RomTestIdBlockB(Model):
+            _id_block_size = 10
+
+        c = connect(None)
+        self.assertEqual([RomTestIdBlockA().id for i in range(3)], [1, 2, 3])
+        self.assertEqual([RomTestIdBlockB().id for i in range(3)], [1, 2, 3])
+        self.assertEqual(RomTestIdBlockA().id, 4)
+        self.assertEqual(int(c.get('RomTestIdBlockA:id:')), 10)
+        self.assertEqual(int(c.get('RomTestIdBlockB:id:')), 10)
+        session.rollback()
+
+    def test_index_diff(self):
+        class RomTestIndexDiff(Model):
+            text = Text(index=True, keygen=FULL_TEXT, prefix=True)
+            rank = Integer(index=True)
+            other = Text()
+
+        c = connect(None)
+        x = RomTestIndexDiff(text=u'hello world', rank=1, other=u'a')
+        x.save()
+        self.assertEqual(RomTestIndexDiff.query.filter(text=u'hello').ids(), [x.id])
+
+        # unchanged index entries aren't rewritten
+        c.delete('RomTestIndexDiff:text:hello:idx')
+        x.other = u'b'
+        x.save()
+        self.assertFalse(c.exists('RomTestIndexDiff:text:hello:idx'))
+        x.text = u'goodbye world'
+        x.rank = 2
+        x.save()
+        self.assertFalse(c.exists('RomTestIndexDiff:text:hello:idx'))
+        self.assertTrue(c.exists('RomTestIndexDiff:text:goodbye:idx'))
+        self.assertEqual(RomTestIndexDiff.query.filter(text=u'world').ids(), [x.id])
+        self.assertEqual(RomTestIndexDiff.query.filter(rank=2).ids(), [x.id])
+        self.assertEqual(RomTestIndexDiff.query.filter(rank=1).ids(), [])
+        self.assertEqual(RomTestIndexDiff.query.startswith(text=u'good').count(), 1)
+        self.assertEqual(RomTestIndexDiff.query.startswith(text=u'hell').count(), 0)
+
+        # full saves re-add all index entries
+        c.delete('RomTestIndexDiff:text:world:idx')
+        x.save(full=True)
+        self.assertEqual(RomTestIndexDiff.query.filter(text=u'world').ids(), [x.id])
+
+        x.delete()
+        self.assertEqual(c.keys('RomTestIndexDiff:*idx'), [])
+        self.assertEqual(c.keys('RomTestIndexDiff:text:pre'), [])
+
+    def test_dirty_columns(self):
+        calls = []
+        class CountedText(Text):
+            def _to_redis(self, value):
+                calls.append(self._attr)
+                return Text._to_redis(self, value)
+
+        class RomTestDirty(Model):
+            a = CountedText(index=True, keygen=FULL_TEXT)
+            b = CountedText(unique=True)
+            c = CountedText(prefix=True, keygen=SIMPLE)
+            d = CountedText()
+            rank = Integer(index=True)
+            data = Json(default=dict)
+
+        x = RomTestDirty(a=u'hello world', b=u'b', c=u'cat', d=u'd', rank=1)
+        x.save()
+        session.rollback()
+        x = RomTestDirty.get(x.id)
+        del calls[:]
+        x.d = u'changed'
+        x.save()
+        self.assertEqual(calls, ['d'])
+        self.assertFalse(x._dirty)
+
+        # in-place modifications are still saved
+        x.data['key'] = 'value'
+        x.rank = 2
+        x.save()
+        session.rollback()
+        x = RomTestDirty.get(x.id)
+        self.assertEqual(x.data, {'key': 'value'})
+        self.assertEqual(x.d, u'changed')
+
+        # indexes of unchanged columns are kept
+        x.a = u'goodbye world'
+        x.save()
+        session.rollback()
+        query = RomTestDirty.query
+        self.assertEqual(query.filter(a=u'goodbye').ids(), [x.id])
+        self.assertEqual(query.filter(a=u'hello').ids(), [])
+        self.assertEqual(query.filter(rank=2).ids(), [x.id])
+        self.assertEqual(query.startswith(c=u'ca').ids(), [x.id])
+        self.assertEqual(RomTestDirty.get_by(b=u'b').id, x.id)
+        self.assertRaises(UniqueKeyViolation, RomTestDirty(b=u'b').save)
+        session.rollback()
+
+    def test_dirty_custom_mutable(self):
+        class ListColumn(Column):
+            _allowed = list
+            def _to_redis(self, value):
+                return ','.join(value)
+            def _from_redis(self, value):
+                if isinstance(value, bytes):
+                    value = value.decode()
+                return value.split(',') if value else []
+
+        class RomTestDirtyList(Model):
+            items = ListColumn()
+            name = Text()
+
+        self.assertEqual(RomTestDirtyList._mutable, set(['items']))
+        x = RomTestDirtyList(items=['a'], name=u'x')
+        x.save()
+        session.rollback()
+        x = RomTestDirtyList.get(x.id)
+        x.items.append('b')
+        x.save()
+        session.rollback()
+        self.assertEqual(RomTestDirtyList.get(x.id).items, ['a', 'b'])
+        session.rollback()
+
+    def test_write_behind(self):
+        calls = []
+        class RomTestWriteBehind(Model):
+            name = Text(unique=True)
+            count = Integer()
+            def _before_insert(self):
+                calls.append('before')
+            def _after_insert(self):
+                calls.append('after')
+
+        writer = util.WriteBehind(batch_size=10, interval=60)
+        x = RomTestWriteBehind(name=u'x', count=0)
+        for i in range(5):
+            x.count += 1
+            self.assertEqual(session.commit(write_behind=writer), 1)
+        self.assertEqual(writer._order, [x._pk])
+        # hooks are called once per write
+        self.assertEqual(calls, ['before'])
+        self.assertFalse(x._modified)
+        self.assertFalse(connect(None).exists(x._pk))
+        writer.flush()
+        self.assertEqual(calls, ['before', 'after'])
+        session.rollback()
+        self.assertEqual(RomTestWriteBehind.get(x.id).count, 5)
+        session.rollback()
+
+        # batches are written once batch_size entities are waiting
+        ents = [RomTestWriteBehind(count=i) for i in range(10)]
+        writer.save(ents)
+        for i in range(100):
+            if not ents[-1]._new:
+                break
+            time.sleep(.01)
+        self.assertEqual(RomTestWriteBehind.get(ents[-1].id).count, 9)
+        session.rollback()
+
+        y = RomTestWriteBehind(name=u'x')
+        writer.save(y)
+        try:
+            writer.flush()
+        except BulkError as e:
+            self.assertEqual(e.errors[0][0], y)
+            self.assertTrue(isinstance(e.errors[0][1], UniqueKeyViolation))
+        else:
+            self.fail("BulkError not raised")
+        # failed writes leave the entity to be saved again
+        self.assertTrue(y._modified and y._new)
+        self.assertTrue('name' in y._dirty)
+        writer.close()
+        y.count = 2
+        self.assertRaises(ORMError, writer.save, y)
+        session.rollback()
+
+        errors = []
+        writer = util.WriteBehind(interval=0, on_error=lambda ent, err: errors.append(ent))
+        y.count = 1
+        writer.save(y)
+        writer.close()
+        self.assertEqual(errors, [y])
+        session.rollback()
+
+        # failing callbacks and hooks don't stop the background thread, and
+        # only the affected entities are reported
+        class RomTestWriteBehindHook(Model):
+            name = Text(unique=True)
+            def _after_insert(self):
+                if self.name == u'bad':
+                    raise KeyError(self.name)
+
+        def on_error(ent, err):
+            raise ValueError
+        writer = util.WriteBehind(batch_size=10, interval=60, on_error=on_error)
+        a = RomTestWriteBehindHook(name=u'bad')
+        b = RomTestWriteBehindHook(name=u'good')
+        c = RomTestWriteBehindHook(name=u'good')
+        writer.save(a, b, c)
+        try:
+            writer.flush()
+        except BulkError as e:
+            self.assertEqual([ent for ent, err in e.errors], [a, c])
+            self.assertTrue(isinstance(e.errors[0][1], KeyError))
+            self.assertTrue(isinstance(e.errors[1][1], UniqueKeyViolation))
+        else:
+            self.fail("BulkError not raised")
+        self.assertTrue(writer.is_alive())
+        self.assertFalse(a._new or b._new)
+        self.assertTrue(c._new and c._modified)
+        self.assertEqual(RomTestWriteBehindHook.query.count(), 2)
+        c.name = u'fixed'
+        c.save()
+        self.assertEqual(RomTestWriteBehindHook.query.count(), 3)
+        writer.close()
+        session.rollback()
+
+        # pre-commit hooks may queue other entities with the same writer
+        writer = util.WriteBehind(batch_size=10, interval=60)
+        class RomTestWriteBehindNested(Model):
+            name = Text()
+            def _before_insert(self):
+                if self.name == u'parent':
+                    writer.save(RomTestWriteBehindNested(name=u'child'))
+        RomTestWriteBehindNested(name=u'parent')
+        self.assertEqual(session.commit(write_behind=writer), 1)
+        writer.close()
+        self.assertEqual(RomTestWriteBehindNested.query.count(), 2)
+        session.rollback()
+
+    def test_query_delete(self):
+        class RomTestQueryDelete(Model):
+            id = PrimaryKey(index=True)
+            name = Text(unique=True)
+            tags = Text(index=True, keygen=FULL_TEXT, prefix=True)
+            rank = Integer(index=True)
+            blob = Text(deferred=True)
+
+        c = connect(None)
+        ents = [RomTestQueryDelete(name=u'n%i'%i, tags=u'tag%i all'%(i % 3),
+            rank=i, blob=u'blob') for i in range(25)]
+        session.commit()
+        known = ents[3]
+        query = RomTestQueryDelete.query
+        self.assertEqual(query.filter(tags=u'tag0').delete(batch_size=4), 9)
+        self.assertTrue(known._deleted)
+        self.assertEqual(query.filter(tags=u'tag0').count(), 0)
+        self.assertEqual(query.filter(tags=u'all').count(), 16)
+        self.assertEqual(query.startswith(tags=u'tag0').count(), 0)
+        self.assertEqual(query.filter(rank=(0, 3)).ids(), [2, 3])
+        self.assertFalse(c.exists('RomTestQueryDelete:1:blob'))
+        self.assertFalse(c.hexists('RomTestQueryDelete::', 1))
+        RomTestQueryDelete(name=u'n0').save()
+        session.rollback()
+
+        # deleting everything pages through the primary key index
+        self.assertEqual(query.delete(batch_size=5), 17)
+        self.assertEqual(query.count(), 0)
+        self.assertEqual(c.keys('RomTestQueryDelete:*:?*'), [])
+        self.assertFalse(c.exists('RomTestQueryDelete::'))
+
+        class RomTestQueryDeleteRef(Model):
+            ref = ManyToOne('RomTestQueryDelete', on_delete='cascade')
+
+        for i in range(3):
+            RomTestQueryDeleteRef(ref=RomTestQueryDelete(name=u'r%i'%i, rank=i))
+        session.commit()
+        self.assertEqual(query.filter(rank=(1, None)).delete(), 2)
+        self.assertEqual(RomTestQueryDeleteRef.query.count(), 1)
+        session.rollback()
+
+        # hooks of entities deleted or updated by on_delete actions are called
+        calls = []
+        class RomTestQueryDeleteHooked(Model):
+            ref = ManyToOne('RomTestQueryDeleteRef', on_delete='cascade')
+            def _after_delete(self):
+                calls.append(self.id)
+        class RomTestQueryDeleteUpdated(Model):
+            ref = ManyToOne('RomTestQueryDelete', on_delete='set null')
+            def _before_update(self):
+                calls.append(None)
+
+        from rom.query import _on_delete_hooks
+        self.assertTrue(_on_delete_hooks(RomTestQueryDelete))
+        self.assertTrue(_on_delete_hooks(RomTestQueryDeleteRef))
+        self.assertFalse(_on_delete_hooks(RomTestQueryDeleteUpdated))
+        ref = RomTestQueryDeleteRef.query.all()[0]
+        RomTestQueryDeleteHooked(ref=ref)
+        session.commit()
+        self.assertEqual(query.delete(), 1)
+        self.assertEqual(RomTestQueryDeleteHooked.query.count(), 0)
+        RomTestQueryDeleteUpdated(ref=RomTestQueryDelete(name=u'u'))
+        session.commit()
+        self.assertEqual(query.delete(), 1)
+        self.assertEqual(calls[-1], None)
+        session.rollback()
+
+    def test_query_update(self):
+        class RomTestQueryUpdate(Model):
+            name = Text(unique=True)
+            tags = Text(index=True, keygen=FULL_TEXT, prefix=True, suffix=True)
+            rank = Integer(index=True)
+            flag = Boolean(index=True)
+            blob = Text(deferred=True)
+
+        for i in range(10):
+            RomTestQueryUpdate(name=u'n%i'%i, tags=u'old', rank=i, flag=False, blob=u'b')
+        session.commit()
+        query = RomTestQueryUpdate.query
+        self.assertEqual(query.filter(rank=(5, None)).update(
+            tags=u'new stuff', flag=True, blob=u'c', batch_size=2), 5)
+        self.assertEqual(sorted(query.filter(flag=True).ids()), [6, 7, 8, 9, 10])
+        self.assertEqual(query.filter(tags=u'old').count(), 5)
+        self.assertEqual(query.filter(tags=u'new').count(), 5)
+        self.assertEqual(query.startswith(tags=u'ne').count(), 5)
+        self.assertEqual(query.endswith(tags=u'uff').count(), 5)
+        self.assertEqual(query.startswith(tags=u'ol').count(), 5)
+        self.assertEqual(RomTestQueryUpdate.get(10).blob, u'c')
+        self.assertEqual(RomTestQueryUpdate.get(1).blob, u'b')
+        session.rollback()
+
+        self.assertEqual(query.filter(rank=(0, 1)).update({'rank': 20, 'blob': None}), 2)
+        self.assertEqual(sorted(query.filter(rank=20).ids()), [1, 2])
+        self.assertEqual(RomTestQueryUpdate.get(1).blob, None)
+        session.rollback()
+
+        # unique constraints are enforced per entity
+        try:
+            query.filter(rank=20).update(name=u'same')
+        except BulkError as e:
+            self.assertEqual([id for id, err in e.errors], [2])
+            self.assertTrue(isinstance(e.errors[0][1], UniqueKeyViolation))
+        else:
+            self.fail("BulkError not raised")
+        self.assertEqual(RomTestQueryUpdate.get_by(name=u'same').id, 1)
+        self.assertEqual(RomTestQueryUpdate.get_by(name=u'n0'), None)
+        self.assertEqual(RomTestQueryUpdate.get_by(name=u'n1').id, 2)
+        self.assertRaises(QueryError, query.update, missing=1)
+        self.assertRaises(InvalidOperation, query.update, id=1)
+        self.assertRaises(InvalidColumnValue, query.update, rank='x')
+        session.rollback()
+
+    def test_atomic_updates(self):
+        class RomTestAtomic(Model):
+            name = Text(unique=True)
+            count = Integer(index=True)
+            score = Float()
+            state = Text(index=True, keygen=FULL_TEXT)
+            code = Integer(unique=True)
+
+        x = RomTestAtomic(name=u'x', state=u'queued')
+        x.save()
+        self.assertEqual(RomTestAtomic.incr(x.id, 'count'), 1)
+        self.assertEqual(RomTestAtomic.incr(x.id, 'score', 1.5), 1.5)
+        self.assertEqual(RomTestAtomic.incr(x.id, 'score', 2), 3.5)
+        self.assertEqual(RomTestAtomic.incr(100, 'count'), None)
+        self.assertRaises(ColumnError, RomTestAtomic.incr, x.id, 'code')
+        self.assertRaises(ColumnError, RomTestAtomic.incr, x.id, 'name')
+        self.assertRaises(InvalidColumnValue, RomTestAtomic.incr, x.id, 'count', 1.5)
+
+        def incr():
+            for i in range(20):
+                RomTestAtomic.incr(x.id, 'count')
+        threads = [threading.Thread(target=incr) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(x.atomic_incr('count', 10), 111)
+        self.assertEqual(x.count, 111)
+        x.state = u'seen'
+        x.save()
+        # Redis formats incremented floats itself
+        self.assertEqual(x.atomic_incr('score', 1.5), 5.0)
+        self.assertEqual(connect(None).hget(x._pk, 'score'), b'5')
+        x.score = 6.0
+        x.save()
+        self.assertEqual(connect(None).hget(x._pk, 'score'), b'6.0')
+        self.assertEqual(RomTestAtomic.query.filter(count=(100, None)).ids(), [x.id])
+        x.delete()
+        self.assertEqual(RomTestAtomic.query.filter(count=(None, None)).count(), 0)
+        self.assertRaises(InvalidOperation, RomTestAtomic(name=u'y').atomic_incr, 'count')
+        session.rollback()
+
+        y = RomTestAtomic(name=u'y', state=u'queued')
+        y.save()
+        self.assertTrue(RomTestAtomic.update_if(y.id, {'state': u'queued', 'count': None},
+            {'state': u'running', 'count': 1}))
+        self.assertFalse(RomTestAtomic.update_if(y.id, {'state': u'queued'}, {'state': u'running'}))
+        self.assertFalse(RomTestAtomic.update_if(100, {'state': u'queued'}, {'state': u'running'}))
+        RomTestAtomic.incr(y.id, 'score', 1)
+        self.assertTrue(RomTestAtomic.update_if(y.id, {'score': 1.0}, {'score': None}))
+        session.rollback()
+        y = RomTestAtomic.get(y.id)
+        self.assertEqual((y.state, y.count, y.score), (u'running', 1, None))
+        self.assertEqual(RomTestAtomic.query.filter(state=u'running').ids(), [y.id])
+        self.assertEqual(RomTestAtomic.query.filter(state=u'queued').ids(), [])
+        session.rollback()
+
+    def test_version(self):
+        class RomTestVersion(Model):
+            version = Version()
+            title = Text()
+            body = Text()
+            count = Integer(index=True)
+
+        def two_versions():
+            class RomTestVersion2(Model):
+                v1 = Version()
+                v2 = Version()
+        self.assertRaises(ColumnError, two_versions)
+        x = RomTestVersion(title=u't', body=u'b' * 1000)
+        self.assertEqual(x.version, None)
+        x.save()
+        self.assertEqual(x.version, 1)
+        self.assertRaises(InvalidOperation, setattr, x, 'version', 5)
+
+        x.body = u'c' * 1000
+        args = RomTestVersion._prepare_changes(x._last, dict(x._data), dirty=x._dirty)[2]
+        self.assertEqual(args[12], [('id', '1'), ('version', '1')])
+        x.save()
+        self.assertEqual(x.version, 2)
+        session.rollback()
+
+        # any concurrent save is a data race
+        y = RomTestVersion.get(x.id)
+        x.title = u'x'
+        y.body = u'y'
+        y.save()
+        self.assertEqual(y.version, 3)
+        # saves without changes don't invalidate other holders' versions
+        self.assertEqual(y.save(), 0)
+        self.assertEqual(y.version, 3)
+        self.assertEqual(int(connect(None).hget(y._pk, 'version')), 3)
+        self.assertRaises(DataRaceError, x.save)
+        x.refresh(force=True)
+        self.assertEqual((x.version, x.title, x.body), (3, u't', u'y'))
+        x.delete()
+        self.assertRaises(EntityDeletedError, y.save, full=True)
+        session.rollback()
+
+        z = RomTestVersion(title=u'z')
+        z.save()
+        RomTestVersion.incr(z.id, 'count')
+        self.assertEqual(RomTestVersion.query.filter(count=1).update(title=u'zz'), 1)
+        self.assertTrue(RomTestVersion.update_if(z.id, {'version': 3}, {'title': u'zzz'}))
+        self.assertFalse(RomTestVersion.update_if(z.id, {'version': 3}, {'title': u'z4'}))
+        self.assertRaises(InvalidOperation, RomTestVersion.query.update, version=1)
+        session.rollback()
+        z = RomTestVersion.get(z.id)
+        self.assertEqual((z.version, z.title, z.count), (4, u'zzz', 1))
+        session.rollback()
+
+        # increments invalidate stale saves, but not the incrementing entity
+        z = RomTestVersion.get(z.id)
+        self.assertEqual(z.atomic_incr('count'), 2)
+        self.assertEqual(z.version, 5)
+        session.rollback()
+        stale = RomTestVersion.get(z.id)
+        RomTestVersion.incr(z.id, 'count')
+        stale.count = 10
+        self.assertRaises(DataRaceError, stale.save)
+        z.title = u'z5'
+        self.assertRaises(DataRaceError, z.save)
+        session.rollback()
+        z = RomTestVersion.get(z.id)
+        self.assertEqual((z.version, z.title, z.count), (6, u'zzz', 3))
+        z.atomic_incr('count')
+        z.title = u'z6'
+        z.save()
+        self.assertEqual(z.version, 8)
+        session.rollback()
+
+    def test_atomic_commit(self):
+        class RomTestAtomicA(Model):
+            name = Text(unique=True)
+            rank = Integer(index=True)
+        class RomTestAtomicB(Model):
+            label = Text(index=True, keygen=FULL_TEXT)
+
+        a1 = RomTestAtomicA(name=u'a1', rank=1)
+        a2 = RomTestAtomicA(name=u'a2', rank=2)
+        b = RomTestAtomicB(label=u'hello')
+        self.assertEqual(session.commit(atomic=True), 8)
+        self.assertFalse(any(e._modified or e._new for e in (a1, a2, b)))
+        self.assertEqual(RomTestAtomicB.query.filter(label=u'hello').ids(), [b.id])
+
+        # swapping unique values between entities works
+        a1.name, a2.name = u'a2', u'a1'
+        session.save(a1, a2, atomic=True)
+        session.rollback()
+        self.assertEqual(RomTestAtomicA.get_by(name=u'a1').id, a2.id)
+
+        # nothing is written if any entity fails its checks
+        a1, a2 = RomTestAtomicA.get([a1.id, a2.id])
+        b = RomTestAtomicB.get(b.id)
+        a1.rank = 10
+        b.label = u'goodbye'
+        a3 = RomTestAtomicA(name=u'new', rank=3)
+        a4 = RomTestAtomicA(name=u'new', rank=4)
+        a2.name = u'a2'
+        try:
+            session.commit(atomic=True)
+        except BulkError as e:
+            self.assertEqual(sorted(ent.id for ent, err in e.errors), [a2.id, a4.id])
+            self.assertTrue(all(isinstance(err, UniqueKeyViolation) for ent, err in e.errors))
+        else:
+            self.fail("BulkError not raised")
+        self.assertTrue(a1._modified and b._modified and a3._new)
+        session.rollback()
+        self.assertEqual(RomTestAtomicA.get(a1.id).rank, 1)
+        self.assertEqual(RomTestAtomicB.get(b.id).label, u'hello')
+        self.assertEqual(RomTestAtomicA.get(a3.id), None)
+        session.rollback()
+
+        c = RomTestAtomicA.get(a1.id)
+        c.rank = 5
+        d = RomTestAtomicA.get(a2.id)
+        d.rank = 6
+        session.rollback()
+        RomTestAtomicA.incr(c.id, 'rank')
+        self.assertRaises(BulkError, session.save, c, d, atomic=True)
+        session.rollback()
+        self.assertEqual(RomTestAtomicA.get(a2.id).rank, 2)
+        session.rollback()
+
+    def test_pipelined_saves(self):
+        calls = []
+        class RomTestPipelinedA(Model):
+            name = Text(unique=True)
+            rank = Integer(index=True)
+            def _after_insert(self):
+                calls.append(('insert', self.name))
+            def _after_delete(self):
+                calls.append(('delete', self.name))
+        class RomTestPipelinedB(Model):
+            label = Text()
+
+        c = connect(None)
+        with pipelined_saves() as batch:
+            a = RomTestPipelinedA(name=u'a', rank=1)
+            a.save()
+            b = RomTestPipelinedB(label=u'b')
+            b.save()
+            self.assertFalse(c.exists(a._pk))
+            self.assertEqual(calls, [])
+        self.assertEqual(batch.errors, [])
+        self.assertEqual(calls, [('insert', u'a')])
+        self.assertFalse(a._new or b._new)
+        session.rollback()
+        self.assertEqual(RomTestPipelinedB.get(b.id).label, u'b')
+
+        # errors are collected, other writes go through
+        a = RomTestPipelinedA.get(a.id)
+        session.rollback()
+        RomTestPipelinedA.get(a.id).rank = 5
+        session.commit()
+        a.rank = 2
+        a2 = RomTestPipelinedA(name=u'a')
+        a3 = RomTestPipelinedA(name=u'a3')
+        try:
+            with pipelined_saves():
+                a.save()
+                a2.save()
+                a3.save()
+        except BulkError as e:
+            self.assertEqual([ent for ent, err in e.errors], [a, a2])
+            self.assertTrue(isinstance(e.errors[0][1], DataRaceError))
+            self.assertTrue(isinstance(e.errors[1][1], UniqueKeyViolation))
+        else:
+            self.fail("BulkError not raised")
+        self.assertTrue(a._modified and a2._new)
+        self.assertFalse(a3._new)
+        session.rollback()
+
+        # nothing is written if the block raises
+        def fail():
+            with pipelined_saves():
+                a3.delete()
+                raise KeyError
+        self.assertRaises(KeyError, fail)
+        self.assertTrue(c.exists(a3._pk))
+        self.assertEqual(util._pipelined(), None)
+        self.assertFalse(a3._deleted)
+        self.assertTrue(session.known.get(a3._pk) is a3)
+
+        # ... and the entities can still be saved afterwards
+        def fail():
+            with pipelined_saves():
+                a3.rank = 7
+                a3.save()
+                a3.rank = 8
+                a3.save()
+                raise KeyError
+        self.assertRaises(KeyError, fail)
+        self.assertTrue(a3._modified)
+        self.assertEqual(c.hget(a3._pk, 'rank'), None)
+        a3.save()
+        session.rollback()
+        self.assertEqual(RomTestPipelinedA.get(a3.id).rank, 8)
+        session.rollback()
+
+        # writes can be added to an existing pipeline
+        pipe = c.pipeline()
+        pipe.set('RomTestPipelinedKey', '1')
+        with pipelined_saves(pipe, raise_errors=False) as batch:
+            RomTestPipelinedA.get(a3.id).delete()
+            a4 = RomTestPipelinedA(name=u'a')
+            a4.save()
+        pipe.get('RomTestPipelinedKey')
+        results = pipe.execute(raise_on_error=False)
+        self.assertEqual(results[-1], b'1')
+        errors = batch.check(results)
+        self.assertEqual([ent for ent, err in errors], [a4])
+        self.assertFalse(c.exists(a3._pk))
+        self.assertEqual(calls[-1], ('delete', u'a3'))
+        session.rollback()
+
+        # repeated saves of an entity are written in order
+        with pipelined_saves():
+            a5 = RomTestPipelinedA(name=u'a5', rank=1)
+            a5.save()
+            a5.rank = 2
+            a5.save()
+            a5.rank = 3
+            a5.save()
+        self.assertEqual(calls[-1], ('insert', u'a5'))
+        session.rollback()
+        self.assertEqual(RomTestPipelinedA.get(a5.id).rank, 3)
+        self.assertEqual(RomTestPipelinedA.query.filter(rank=3).ids(), [a5.id])
+
+        # a failed write leaves the entity to be saved again
+        RomTestPipelinedA.get(a5.id).name = u'other'
+        session.commit()
+        try:
+            with pipelined_saves():
+                a5.name = u'a6'
+                a5.save()
+                a5.rank = 6
+                a5.save()
+        except BulkError as e:
+            self.assertEqual([ent for ent, err in e.errors], [a5, a5])
+        else:
+            self.fail("BulkError not raised")
+        self.assertTrue(a5._modified)
+        self.assertEqual(a5._last['name'], u'a5')
+        a5.refresh(force=True)
+        self.assertEqual((a5.name, a5.rank), (u'other', 3))
+        session.rollback()
+
+        # changes made before the results are checked are kept
+        pipe = c.pipeline()
+        with pipelined_saves(pipe) as batch:
+            a5.rank = 7
+            a5.save()
+        a5.name = u'a7'
+        self.assertEqual(batch.check(pipe.execute(raise_on_error=False)), [])
+        self.assertTrue(a5._modified)
+        self.assertEqual(a5._dirty, set(['name']))
+        self.assertEqual(c.hget(a5._pk, 'rank'), b'7')
+        a5.save()
+        self.assertEqual(c.hget(a5._pk, 'name'), b'a7')
+        session.rollback()
+
+        # on_delete actions are queued with the delete
+        class RomTestPipelinedRef(Model):
+            ref = ManyToOne('RomTestPipelinedB', on_delete='cascade')
+        b2 = RomTestPipelinedB(label=u'b2')
+        b2.save()
+        ref = RomTestPipelinedRef(ref=b2)
+        ref.save()
+        session.rollback()
+        pipe = c.pipeline()
+        with pipelined_saves(pipe) as batch:
+            RomTestPipelinedB.get(b2.id).delete()
+        self.assertTrue(c.exists(ref._pk) and c.exists(b2._pk))
+        self.assertEqual(batch.check(pipe.execute(raise_on_error=False)), [])
+        self.assertFalse(c.exists(ref._pk) or c.exists(b2._pk))
+        session.rollback()
+
+        # the script is loaded through the provided pipeline's connection
+        pipe = redis.Redis(db=15).pipeline()
+        with pipelined_saves(pipe) as batch:
+            RomTestPipelinedB(label=u'c').save()
+        self.assertEqual(batch.check(pipe.execute(raise_on_error=False)), [])
+        session.rollback()
+
+    def test_delete_many(self):
+        class RomTestManyTenant(Model):
+            name = Text(unique=True)
+
+        class RomTestManyUser(Model):
+            tenant = ManyToOne('RomTestManyTenant', on_delete='cascade')
+            parent = ManyToOne('RomTestManyUser', on_delete='cascade')
+            email = Text(unique=True)
+
+        class RomTestManyPost(Model):
+            author = ManyToOne('RomTestManyUser', on_delete='set null')
+            tenant = ManyToOne('RomTestManyTenant', on_delete='set default', default=1)
+
+        class RomTestManyLock(Model):
+            user = OneToOne('RomTestManyUser', on_delete='restrict')
+
+        c = connect(None)
+        keep, gone, other = [RomTestManyTenant(name=u't%i'%i) for i in range(3)]
+        session.commit()
+        users = [RomTestManyUser(tenant=gone, email=u'u%i'%i) for i in range(5)]
+        session.commit()
+        # cascades through a self-reference in another tenant
+        child = RomTestManyUser(tenant=other, parent=users[0], email=u'child')
+        kept = RomTestManyUser(tenant=other, email=u'kept')
+        posts = [RomTestManyPost(author=user, tenant=gone) for user in users + [kept]]
+        session.commit()
+        lock = RomTestManyLock(user=child)
+        lock.save()
+        session.rollback()
+
+        self.assertRaises(RestrictError, RomTestManyTenant.delete_many, [gone.id])
+        self.assertEqual(RomTestManyUser.query.count(), 7)
+        RomTestManyLock.get(lock.id).delete()
+
+        gone = RomTestManyTenant.get(gone.id)
+        self.assertEqual(RomTestManyTenant.delete_many([gone.id, 99], batch_size=2), 1)
+        self.assertTrue(gone._deleted)
+        self.assertEqual(RomTestManyTenant.query.count(), 2)
+        self.assertEqual(RomTestManyUser.query.ids(), [kept.id])
+        self.assertEqual(RomTestManyUser.get_by(email=u'u1'), None)
+        self.assertFalse(c.exists('RomTestManyUser:1'))
+        session.rollback()
+        self.assertEqual(RomTestManyPost.query.filter(author=NOT_NULL).ids(), [posts[-1].id])
+        self.assertEqual(RomTestManyPost.query.filter(tenant=keep.id).count(), 6)
+        self.assertEqual(RomTestManyPost.get(posts[0].id).author, None)
+        self.assertEqual(RomTestManyPost.get(posts[0].id).tenant_id, keep.id)
+        session.rollback()
+
+
+    def test_upsert_many(self):
+        class RomTestUpsert(Model):
+            sku = Text(unique=True)
+            name = Text(index=True, keygen=FULL_TEXT)
+            price = Float(index=True)
+            code = Integer(unique=True)
+            notes = Text(deferred=True)
+
+        existing = RomTestUpsert(sku=u'a', name=u'old', price=1.0, code=1, notes=u'n')
+        existing.save()
+        session.rollback()
+        self.assertRaises(QueryError, RomTestUpsert.upsert_many, [], key='name')
+
+        ids = RomTestUpsert.upsert_many([
+            {'sku': u'a', 'name': u'new', 'notes': u'm'},
+            {'sku': u'b', 'name': u'new', 'price': 2.0, 'code': 2},
+            {'sku': u'c', 'price': 3.0, 'code': 3},
+        ], key='sku', batch_size=2)
+        self.assertEqual(ids, [existing.id, 2, 3])
+        self.assertEqual(RomTestUpsert.query.count(), 3)
+        self.assertEqual(sorted(RomTestUpsert.query.filter(name=u'new').ids()), [1, 2])
+        self.assertEqual(RomTestUpsert.query.filter(name=u'old').count(), 0)
+        a = RomTestUpsert.get_by(sku=u'a')
+        self.assertEqual((a.price, a.code, a.notes), (1.0, 1, u'm'))
+        self.assertEqual(RomTestUpsert.get_by(code=3).sku, u'c')
+        session.rollback()
+
+        # conflicts are reported per row, everything else is written
+        rows = [
+            {'sku': u'c', 'code': 2},
+            {'sku': u'd', 'code': 1},
+            {'sku': u'e', 'price': 5.0},
+            {'sku': u'e', 'price': 6.0},
+            {'price': 7.0},
+            {'sku': u'b', 'price': None},
+        ]
+        try:
+            RomTestUpsert.upsert_many(rows, key='sku')
+        except BulkError as e:
+            failed = dict((rows.index(row), err) for row, err in e.errors)
+            self.assertEqual(sorted(failed), [0, 1, 3, 4])
+            self.assertTrue(isinstance(failed[0], UniqueKeyViolation))
+            self.assertTrue(isinstance(failed[3], UniqueKeyViolation))
+        else:
+            self.fail("expected BulkError")
+        self.assertEqual(RomTestUpsert.get_by(sku=u'c').code, 3)
+        self.assertEqual(RomTestUpsert.get_by(sku=u'd'), None)
+        self.assertEqual(RomTestUpsert.get_by(sku=u'e').price, 5.0)
+        self.assertEqual(RomTestUpsert.get_by(sku=u'b').price, None)
+        self.assertEqual(RomTestUpsert.query.filter(price=(None, None)).count(), 3)
+        session.rollback()
+
+
+    def test_async_indexes(self):
+        class RomTestAsyncIndex(Model):
+            _async_indexes = True
+            name = Text(index=True, keygen=FULL_TEXT, prefix=True)
+            email = Text(unique=True)
+            score = Integer(index=True)
+
+        class RomTestSyncIndex(Model):
+            name = Text(index=True, keygen=FULL_TEXT)
+
+        self.assertRaises(ORMError, util.IndexWorker, [RomTestSyncIndex])
+        worker = util.IndexWorker([RomTestAsyncIndex], batch_size=2)
+        query = RomTestAsyncIndex.query
+        self.assertEqual(util.index_lag(RomTestAsyncIndex), (0, 0))
+
+        a = RomTestAsyncIndex(name=u'hello world', email=u'a', score=1)
+        b = RomTestAsyncIndex(name=u'hello', email=u'b', score=2)
+        session.commit()
+        # data and unique constraints are written immediately
+        self.assertEqual(RomTestAsyncIndex.get_by(email=u'b').name, u'hello')
+        self.assertRaises(UniqueKeyViolation, RomTestAsyncIndex(email=u'a').save)
+        self.assertEqual(query.filter(name=u'hello').count(), 0)
+        changes, seconds = util.index_lag(RomTestAsyncIndex)
+        self.assertEqual(changes, 2)
+        self.assertTrue(0 <= seconds < 5)
+
+        b.name = u'world'
+        b.save()
+        RomTestAsyncIndex.incr(a.id, 'score', 10)
+        self.assertEqual(worker.flush(), 4)
+        self.assertEqual(util.index_lag(RomTestAsyncIndex), (0, 0))
+        self.assertEqual(query.filter(name=u'hello').ids(), [a.id])
+        self.assertEqual(sorted(query.filter(name=u'world').ids()), [a.id, b.id])
+        self.assertEqual(query.startswith(name=u'wor').count(), 2)
+        self.assertEqual(query.order_by('-score').ids(), [a.id, b.id])
+
+        b.delete()
+        self.assertEqual(query.filter(name=u'world').count(), 2)
+        worker.start()
+        for i in range(50):
+            if not util.index_lag(RomTestAsyncIndex)[0]:
+                break
+            time.sleep(.02)
+        worker.close()
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(query.filter(name=u'world').ids(), [a.id])
+        self.assertEqual(query.filter(score=(None, None)).ids(), [a.id])
+        session.rollback()
+
 
 def main():
     global_setup()